@@ -1,7 +1,8 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.utils.html import format_html
-from .models import CustomUser, Patient, Service, Bill, BillItem, MedicalRecord, MedicalReport
+from .media import report_file_url
+from .models import CustomUser, Patient, Service, Bill, BillItem, MedicalRecord, MedicalReport, Job, ReportBlob
 
 @admin.register(CustomUser)
 class CustomUserAdmin(UserAdmin):
@@ -12,6 +13,21 @@ class CustomUserAdmin(UserAdmin):
     list_filter = ('role', 'is_staff', 'is_superuser')
     search_fields = ('username', 'email', 'role', 'phone')
 
+def report_file_preview(report):
+    if report.file:
+        # Served by the access-checked view; the admin session authenticates it
+        file_url = report_file_url(report, signed=False)
+        if report.type == 'image' and report.thumbnail:
+            # The small derivative, not the original, which may be megabytes
+            return format_html(
+                '<a href="{}" target="_blank"><img src="{}" width="100" loading="lazy" /></a>',
+                file_url, report_file_url(report, 'thumbnail', signed=False)
+            )
+        if report.type == 'image':
+            return format_html('<a href="{}" target="_blank">View Image</a>', file_url)
+        return format_html('<a href="{}" target="_blank">View File</a>', file_url)
+    return "No file"
+
 class MedicalRecordInline(admin.TabularInline):
     model = MedicalRecord
     extra = 0
@@ -24,12 +40,7 @@ class MedicalReportInline(admin.TabularInline):
     fields = ('title', 'date', 'type', 'file', 'file_preview', 'uploadedBy')
     
     def file_preview(self, obj):
-        if obj.file and hasattr(obj.file, 'url'):
-            if obj.type == 'image':
-                return format_html('<a href="{}" target="_blank"><img src="{}" width="100" /></a>', obj.file.url, obj.file.url)
-            else:
-                return format_html('<a href="{}" target="_blank">View File</a>', obj.file.url)
-        return "No file"
+        return report_file_preview(obj)
     file_preview.short_description = 'Preview'
 
 @admin.register(Patient)
@@ -62,9 +73,13 @@ class BillItemInline(admin.TabularInline):
     model = BillItem
     extra = 0
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('service')
+
 @admin.register(Bill)
 class BillAdmin(admin.ModelAdmin):
     list_display = ('bill_number', 'patient', 'grand_total', 'status', 'date', 'created_by')
+    list_select_related = ('patient', 'created_by')
     list_filter = ('status', 'date')
     search_fields = ('bill_number', 'patient__name')
     readonly_fields = ('bill_number', 'date', 'grand_total')
@@ -84,6 +99,7 @@ class BillAdmin(admin.ModelAdmin):
 @admin.register(BillItem)
 class BillItemAdmin(admin.ModelAdmin):
     list_display = ('bill', 'service', 'quantity', 'price', 'total')
+    list_select_related = ('bill', 'service')
     search_fields = ('bill__bill_number', 'service__name')
     list_filter = ('bill__status',)
     readonly_fields = ('total',)
@@ -91,6 +107,7 @@ class BillItemAdmin(admin.ModelAdmin):
 @admin.register(MedicalRecord)
 class MedicalRecordAdmin(admin.ModelAdmin):
     list_display = ('patient', 'diagnosis', 'doctor', 'date')
+    list_select_related = ('patient',)
     list_filter = ('date', 'doctor')
     search_fields = ('patient__name', 'diagnosis', 'doctor')
     readonly_fields = ('date',)
@@ -106,15 +123,24 @@ class MedicalRecordAdmin(admin.ModelAdmin):
 @admin.register(MedicalReport)
 class MedicalReportAdmin(admin.ModelAdmin):
     list_display = ('patient', 'title', 'type', 'date', 'uploadedBy', 'file_preview')
+    list_select_related = ('patient',)
     list_filter = ('type', 'date', 'uploadedBy')
     search_fields = ('patient__name', 'title')
     readonly_fields = ('date', 'file_preview')
     
     def file_preview(self, obj):
-        if obj.file and hasattr(obj.file, 'url'):
-            if obj.type == 'image':
-                return format_html('<a href="{}" target="_blank"><img src="{}" width="100" /></a>', obj.file.url, obj.file.url)
-            else:
-                return format_html('<a href="{}" target="_blank">View File</a>', obj.file.url)
-        return "No file"
+        return report_file_preview(obj)
     file_preview.short_description = 'Preview'
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'task', 'status', 'attempts', 'run_at', 'locked_by', 'finished_at')
+    list_filter = ('status', 'task')
+    search_fields = ('task', 'locked_by')
+    readonly_fields = ('attempts', 'locked_by', 'locked_at', 'last_error', 'created_at', 'finished_at')
+
+@admin.register(ReportBlob)
+class ReportBlobAdmin(admin.ModelAdmin):
+    list_display = ('sha256', 'file', 'size', 'ref_count', 'created_at')
+    search_fields = ('sha256', 'file')
+    readonly_fields = ('sha256', 'file', 'size', 'ref_count', 'created_at')
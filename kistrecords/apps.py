@@ -6,4 +6,6 @@ class KistrecordsConfig(AppConfig):
     name = 'kistrecords'
     
     def ready(self):
+        import kistrecords.checks
         import kistrecords.signals
+        import kistrecords.tasks
@@ -0,0 +1,88 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings
+
+from . import cache as cache_utils
+
+
+def user_namespace(user_id):
+    return f'auth-user:{user_id}'
+
+
+class UserCache:
+    """A small per-process LRU of users resolved from access tokens.
+
+    Entries live for at most USER_CACHE_TTL seconds and only while the user's
+    version in the default cache is unchanged. That version is only seen by
+    every worker when the cache is shared between them, so the LRU is not used
+    at all with a per-process cache such as LocMemCache.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, cached_version, expires = entry
+            if cached_version != version or expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        # Each request gets its own instance, as views may change attributes
+        return copy.copy(user)
+
+    def set(self, key, version, user):
+        with self._lock:
+            self._entries[key] = (copy.copy(user), version, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard_user(self, user_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+
+
+def invalidate_user(user_id):
+    """Make every worker load the user from the database again."""
+    user_cache.discard_user(user_id)
+    cache_utils.bump_version(user_namespace(user_id))
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that loads each user at most once per token and
+    USER_CACHE_TTL seconds, instead of on every request."""
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        if user_id is None or not settings.USER_CACHE_TTL or not cache_utils.is_shared():
+            return super().get_user(validated_token)
+
+        key = (user_id, validated_token.get(api_settings.JTI_CLAIM))
+        version = cache_utils.get_version(user_namespace(user_id))
+        user = user_cache.get(key, version)
+        if user is None:
+            # The parent checks the user is still active and, if configured,
+            # that the password has not changed since the token was issued
+            user = super().get_user(validated_token)
+            user_cache.set(key, version, user)
+        return user
@@ -0,0 +1,104 @@
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+
+from .models import Bill, BillItem
+from . import rollups
+from .charts import bump_chart_versions
+from .signals import invalidate_dashboard
+
+CENTS = Decimal('0.01')
+
+
+class UnknownService(Exception):
+    def __init__(self, service_id):
+        super().__init__(f'Service with ID {service_id} not found')
+        self.service_id = service_id
+
+
+def service_ids(items_data):
+    return {item['serviceId'] for item in items_data}
+
+
+def build_bill(patient, data, services, created_by):
+    """Price a validated CreateBillRequestSerializer payload.
+
+    `services` maps service id to Service, as returned by
+    Service.objects.in_bulk(). Returns an unsaved Bill and its unsaved
+    BillItems; raises UnknownService for an item whose service is missing.
+    """
+    subtotal = Decimal('0')
+    items = []
+    for item in data['items']:
+        service = services.get(item['serviceId'])
+        if service is None:
+            raise UnknownService(item['serviceId'])
+
+        quantity = item['quantity']
+        item_total = service.price * quantity
+        subtotal += item_total
+        # bulk_create skips BillItem.save(), so the total is set here
+        items.append(BillItem(
+            service=service,
+            quantity=quantity,
+            price=service.price,
+            total=item_total
+        ))
+
+    discount_value = data['discountValue']
+    if data['discountType'] == 'percentage':
+        discount_amount = ((subtotal * discount_value) / 100).quantize(CENTS)
+    else:
+        discount_amount = discount_value
+
+    bill = Bill(
+        patient=patient,
+        discount_type=data['discountType'],
+        discount_value=discount_value,
+        discount_amount=discount_amount,
+        grand_total=subtotal - discount_amount,
+        created_by=created_by,
+        notes=data.get('notes', '')
+    )
+    return bill, items
+
+
+def insert_bills(entries):
+    """Insert (bill, items) pairs built by build_bill, with bill numbers
+    already assigned.
+
+    All bills and items go in with one bulk_create each. If that fails, each
+    bill is retried on its own so one bad row cannot sink the rest. Returns a
+    list with the IntegrityError for each failed entry, or None.
+    """
+    try:
+        with transaction.atomic():
+            bills = Bill.objects.bulk_create([bill for bill, _ in entries])
+            items = []
+            for bill, bill_items in entries:
+                for item in bill_items:
+                    item.bill = bill
+                    items.append(item)
+            BillItem.objects.bulk_create(items)
+            # bulk_create bypasses the post_save handlers in signals.py
+            rollups.record_bills_created(bills)
+            invalidate_dashboard()
+            bump_chart_versions({bill.patient_id for bill in bills})
+        return [None] * len(entries)
+    except IntegrityError:
+        for bill, _ in entries:
+            bill.pk = None
+
+    errors = []
+    for bill, bill_items in entries:
+        try:
+            with transaction.atomic():
+                bill.save()
+                for item in bill_items:
+                    item.bill = bill
+                BillItem.objects.bulk_create(bill_items)
+            errors.append(None)
+        except IntegrityError as e:
+            bill.pk = None
+            errors.append(e)
+    return errors
@@ -0,0 +1,149 @@
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ReportBlob
+from .previews import delete_previews
+
+READ_SIZE = 1024 * 1024
+
+
+def blob_name(digest, filename):
+    # Keep the extension so the file is still served with a sensible type
+    extension = Path(filename).suffix.lower()[:10]
+    return f"report_blobs/{digest[:2]}/{digest}{extension}"
+
+
+def file_digest(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for data in iter(lambda: source.read(READ_SIZE), b''):
+            checksum.update(data)
+    return checksum.hexdigest()
+
+
+def _move_into_storage(path, name):
+    try:
+        target = default_storage.path(name)
+    except NotImplementedError:
+        with open(path, 'rb') as source:
+            default_storage.save(name, File(source))
+        os.unlink(path)
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        # Replacing is safe: a file already there has the same content
+        os.replace(path, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(path, target)
+
+
+def _acquire(digest):
+    return ReportBlob.objects.filter(sha256=digest).update(ref_count=F('ref_count') + 1)
+
+
+def store_file(path, digest, filename):
+    """Take a reference on the blob with this content, moving the file at
+    `path` into storage if it is new content and deleting it otherwise."""
+    if _acquire(digest):
+        os.unlink(path)
+        return ReportBlob.objects.get(sha256=digest)
+
+    # The file goes in before its row, so a committed row always has its
+    # file. If the caller's transaction rolls back, the file is left without
+    # a row until prune_orphaned_files() comes across it.
+    name = blob_name(digest, filename)
+    size = os.path.getsize(path)
+    _move_into_storage(path, name)
+    try:
+        with transaction.atomic():
+            return ReportBlob.objects.create(sha256=digest, file=name, size=size, ref_count=1)
+    except IntegrityError:
+        # Stored concurrently by another request; its file has our content,
+        # but under another name if its extension differs
+        _acquire(digest)
+        blob = ReportBlob.objects.get(sha256=digest)
+    except Exception:
+        default_storage.delete(name)
+        raise
+    if blob.file.name != name:
+        default_storage.delete(name)
+    return blob
+
+
+def store_uploaded_file(uploaded_file):
+    """Store an uploaded file by content, hashing it in the same pass that
+    copies it out of the request, and return its blob with a new reference."""
+    temp_dir = Path(settings.UPLOAD_TEMP_DIR)
+    temp_dir.mkdir(parents=True, exist_ok=True)
+    checksum = hashlib.sha256()
+    fd, temp_name = tempfile.mkstemp(dir=temp_dir, suffix='.blob')
+    try:
+        with os.fdopen(fd, 'wb') as temp:
+            for data in uploaded_file.chunks(READ_SIZE):
+                checksum.update(data)
+                temp.write(data)
+        return store_file(temp_name, checksum.hexdigest(), uploaded_file.name)
+    finally:
+        if os.path.exists(temp_name):
+            os.unlink(temp_name)
+
+
+def release(blob_id):
+    """Drop a reference to a blob, deleting it and its file once the commit
+    of the last reference's removal has gone through."""
+    with transaction.atomic():
+        ReportBlob.objects.filter(pk=blob_id).update(ref_count=F('ref_count') - 1)
+        blob = ReportBlob.objects.filter(pk=blob_id, ref_count__lte=0).values('file', 'sha256').first()
+        if blob is None:
+            return
+        # Only if no store_file() has taken a new reference in the meantime
+        deleted, _ = ReportBlob.objects.filter(pk=blob_id, ref_count__lte=0).delete()
+    if not deleted:
+        return
+    name, digest = blob['file'], blob['sha256']
+
+    def delete_file():
+        # The same content may have been stored again since
+        if not ReportBlob.objects.filter(sha256=digest).exists():
+            default_storage.delete(name)
+            delete_previews(digest)
+    transaction.on_commit(delete_file)
+
+
+def prune_orphaned_files(min_age=24 * 60 * 60):
+    """Delete blob files that no blob names, left behind by transactions that
+    rolled back after storing them. Files younger than `min_age` seconds are
+    kept, as the transaction that stored them may still be open."""
+    cutoff = timezone.now() - timedelta(seconds=min_age)
+    try:
+        directories = default_storage.listdir('report_blobs')[0]
+    except FileNotFoundError:
+        return 0
+    deleted = 0
+    for directory in directories:
+        files = default_storage.listdir(f"report_blobs/{directory}")[1]
+        names = [f"report_blobs/{directory}/{name}" for name in files]
+        stored = set(ReportBlob.objects.filter(file__in=names).values_list('file', flat=True))
+        for name in names:
+            if name in stored or default_storage.get_modified_time(name) > cutoff:
+                continue
+            default_storage.delete(name)
+            digest = Path(name).stem
+            if not ReportBlob.objects.filter(sha256=digest).exists():
+                delete_previews(digest)
+            deleted += 1
+    return deleted
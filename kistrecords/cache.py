@@ -0,0 +1,81 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# How long a worker may hold a rebuild lock before another worker takes over
+REBUILD_LOCK_TIMEOUT = 30
+# How long a worker without the lock waits for a fresh payload when there is no
+# stale copy to serve
+REBUILD_WAIT = 5
+REBUILD_POLL_INTERVAL = 0.05
+
+DASHBOARD_NAMESPACE = 'dashboard'
+
+# Backends whose entries live in, and are only seen by, a single process
+PROCESS_LOCAL_BACKENDS = (
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+)
+
+
+def is_shared():
+    """Whether every worker process sees the same default cache."""
+    return settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_BACKENDS
+
+
+def get_version(namespace):
+    key = f'{namespace}:version'
+    version = cache.get(key)
+    if version is None:
+        # Start from a timestamp rather than 1 so that an evicted counter can
+        # never line up with payloads cached under an earlier version
+        cache.add(key, int(time.time() * 1000), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(namespace):
+    key = f'{namespace}:version'
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = int(time.time() * 1000)
+        cache.set(key, version, None)
+        return version
+
+
+def get_or_build(namespace, build, timeout, suffix=''):
+    """Return the payload cached for the current version of `namespace`,
+    building it with `build()` on a miss.
+
+    Only the worker that wins the rebuild lock calls `build()`; the others serve
+    the last payload built for the namespace, or wait for the new one.
+    """
+    key = f'{namespace}:{get_version(namespace)}:{suffix}'
+    payload = cache.get(key)
+    if payload is not None:
+        return payload
+
+    latest_key = f'{namespace}:latest:{suffix}'
+    lock_key = f'{key}:lock'
+    if cache.add(lock_key, True, REBUILD_LOCK_TIMEOUT):
+        try:
+            payload = build()
+            cache.set(key, payload, timeout)
+            cache.set(latest_key, payload, None)
+        finally:
+            cache.delete(lock_key)
+        return payload
+
+    payload = cache.get(latest_key)
+    if payload is not None:
+        return payload
+
+    deadline = time.monotonic() + REBUILD_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(REBUILD_POLL_INTERVAL)
+        payload = cache.get(key)
+        if payload is not None:
+            return payload
+    return build()
@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+from .media import url_epoch
+from .models import Bill, MedicalRecord, MedicalReport, Patient
+from .serializers import (
+    BillSerializer, MedicalRecordSerializer, MedicalReportSerializer, PatientSerializer
+)
+
+
+def bump_chart_versions(patient_ids):
+    """Mark the charts of the given patients as changed. The UPDATE runs in the
+    caller's transaction, so readers only see the new version once the change
+    that caused it has committed."""
+    Patient.objects.filter(pk__in=patient_ids).update(chart_version=F('chart_version') + 1)
+
+
+def refresh_chart_version(patient):
+    patient.refresh_from_db(fields=['chart_version'])
+    return patient.chart_version
+
+
+def chart_etag(patient):
+    # Charts embed signed report file links, renewed once per signing window
+    return f'"patient-{patient.pk}-v{patient.chart_version}-e{url_epoch()}"'
+
+
+def build_chart(patient):
+    medical_records = MedicalRecord.objects.filter(patient=patient).order_by('-date')
+    bills = Bill.objects.with_details().filter(patient=patient).order_by('-date')
+    reports = MedicalReport.objects.filter(patient=patient).order_by('-date')
+
+    return {
+        'patient': PatientSerializer(patient).data,
+        'medicalRecords': MedicalRecordSerializer(medical_records, many=True).data,
+        'billingHistory': BillSerializer(bills, many=True).data,
+        'medicalReports': MedicalReportSerializer(reports, many=True).data,
+    }
+
+
+def get_chart(patient):
+    """Serialized chart for `patient` at its loaded chart_version, built at
+    most once per version."""
+    key = f'patient-chart:{patient.pk}:{patient.chart_version}:{url_epoch()}'
+    chart = cache.get(key)
+    if chart is None:
+        chart = build_chart(patient)
+        cache.set(key, chart, settings.PATIENT_CHART_CACHE_TIMEOUT)
+    return chart
@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+from reportlab.pdfbase.ttfonts import TTFError, TTFont
+
+from . import cache as cache_utils
+
+
+@register()
+def check_invoice_fonts(app_configs, **kwargs):
+    """Invoices print text Helvetica cannot show, such as Devanagari names,
+    in INVOICE_FONT and INVOICE_BOLD_FONT."""
+    warnings = []
+    for setting in ('INVOICE_FONT', 'INVOICE_BOLD_FONT'):
+        path = getattr(settings, setting)
+        try:
+            TTFont(setting, path)
+        except (OSError, TTFError) as error:
+            warnings.append(Warning(
+                f"{setting} {path!r} cannot be loaded: {error}",
+                hint='Install fonts-noto-core or point the setting at a TrueType font with Devanagari; '
+                     'until then, text Helvetica cannot show prints as blanks on invoices.',
+                id='kistrecords.W001',
+            ))
+    return warnings
+
+
+@register(Tags.caches)
+def check_shared_cache(app_configs, **kwargs):
+    """Cache invalidations only reach every worker through a shared cache."""
+    if settings.DEBUG or cache_utils.is_shared():
+        return []
+    return [Warning(
+        f"The default cache backend {settings.CACHES['default']['BACKEND']} is not shared between worker processes.",
+        hint='Set CACHE_BACKEND and CACHE_LOCATION to a shared cache such as Redis or Memcached. '
+             'Until then dashboard invalidations only reach the worker that made the change, '
+             'and the user cache in CachedJWTAuthentication is disabled.',
+        id='kistrecords.W002',
+    )]
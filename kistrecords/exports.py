@@ -0,0 +1,91 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Bill, BillItem
+
+# Column name -> values() lookup, per export type
+EXPORT_COLUMNS = {
+    'bills': {
+        'bill_id': 'id',
+        'bill_number': 'bill_number',
+        'date': 'date',
+        'day': 'day',
+        'patient_id': 'patient_id',
+        'patient_name': 'patient__name',
+        'status': 'status',
+        'discount_type': 'discount_type',
+        'discount_value': 'discount_value',
+        'discount_amount': 'discount_amount',
+        'grand_total': 'grand_total',
+        'created_by': 'created_by__username',
+    },
+    'items': {
+        'item_id': 'id',
+        'bill_id': 'bill_id',
+        'bill_number': 'bill__bill_number',
+        'day': 'bill__day',
+        'bill_status': 'bill__status',
+        'service_id': 'service_id',
+        'service_name': 'service__name',
+        'category': 'service__category',
+        'quantity': 'quantity',
+        'price': 'price',
+        'total': 'total',
+    },
+}
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+# Rows fetched per round trip; on PostgreSQL this is the server-side cursor's
+# fetch size
+EXPORT_CHUNK_SIZE = 2000
+
+
+def export_rows(kind, start, end, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield one dict per bill (or bill item) whose local day falls between
+    `start` and `end` inclusive, in date order, keyed by export column."""
+    columns = EXPORT_COLUMNS[kind]
+    if kind == 'bills':
+        queryset = Bill.objects.filter(day__gte=start, day__lte=end).order_by('day', 'date', 'id')
+    else:
+        queryset = BillItem.objects.filter(
+            bill__day__gte=start, bill__day__lte=end
+        ).order_by('bill__day', 'bill__date', 'bill_id', 'id')
+
+    # Plain value rows straight off the cursor: no model instances, no
+    # serializer, and only one chunk held in memory at a time
+    lookups = list(columns.values())
+    for row in queryset.values_list(*lookups).iterator(chunk_size=chunk_size):
+        yield dict(zip(columns, row))
+
+
+class _LineBuffer:
+    # csv.writer only needs write(); hand each formatted line straight back
+    def write(self, value):
+        return value
+
+
+def csv_lines(kind, rows):
+    writer = csv.writer(_LineBuffer())
+    yield writer.writerow(EXPORT_COLUMNS[kind])
+    for row in rows:
+        yield writer.writerow(row.values())
+
+
+def ndjson_lines(kind, rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+def export_lines(kind, export_format, start, end, chunk_size=EXPORT_CHUNK_SIZE):
+    rows = export_rows(kind, start, end, chunk_size)
+    if export_format == 'csv':
+        return csv_lines(kind, rows)
+    return ndjson_lines(kind, rows)
+
+
+def export_filename(kind, export_format, start, end):
+    return f"{kind}-{start.isoformat()}-{end.isoformat()}.{export_format}"
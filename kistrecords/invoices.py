@@ -0,0 +1,141 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import pdf
+
+# Part of every cache key; bump it when the invoice layout changes so that
+# cached PDFs are rendered again
+LAYOUT_VERSION = 1
+
+
+class RendererBusy(Exception):
+    """Every render slot of this process is taken."""
+
+
+def invoice_data(bill):
+    """Everything printed on the bill's invoice, as plain strings. Expects the
+    bill's patient and items (with their services) to be loaded, as
+    Bill.objects.with_details() does."""
+    items = [
+        {
+            'service': item.service.name,
+            'quantity': str(item.quantity),
+            'price': f"{item.price:.2f}",
+            'total': f"{item.total:.2f}",
+        }
+        for item in bill.items.all()
+    ]
+    subtotal = sum(item.total for item in bill.items.all())
+    if bill.discount_type == 'percentage':
+        discount_label = f"Discount ({bill.discount_value:g}%)"
+    else:
+        discount_label = 'Discount'
+    return {
+        'clinic': settings.INVOICE_CLINIC_NAME,
+        'fonts': [settings.INVOICE_FONT, settings.INVOICE_BOLD_FONT],
+        'bill_number': bill.bill_number,
+        'date': timezone.localtime(bill.date).strftime('%Y-%m-%d %H:%M'),
+        'status': bill.status,
+        'patient': {
+            'name': bill.patient.name,
+            'phone': bill.patient.phone,
+            'address': bill.patient.address,
+        },
+        'items': items,
+        'subtotal': f"{subtotal:.2f}",
+        'discount': f"{bill.discount_amount:.2f}" if bill.discount_amount else '',
+        'discount_label': discount_label,
+        'grand_total': f"{bill.grand_total:.2f}",
+        'notes': bill.notes,
+    }
+
+
+def invoice_digest(data):
+    payload = json.dumps([LAYOUT_VERSION, data], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class InvoiceRenderer:
+    """Renders invoices in a small process pool.
+
+    Each server process gets INVOICE_RENDER_WORKERS render processes and
+    admits at most INVOICE_RENDER_QUEUE more requests waiting for them; past
+    that, render() raises RendererBusy at once instead of tying up the request
+    worker. With no render workers configured invoices are rendered inline.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self._slots = None
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                workers = settings.INVOICE_RENDER_WORKERS
+                # Spawned rather than forked: the server process holds
+                # database connections and threads that must not be copied
+                self._pool = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context('spawn')
+                )
+                self._slots = threading.BoundedSemaphore(workers + settings.INVOICE_RENDER_QUEUE)
+            return self._pool, self._slots
+
+    def render(self, data):
+        if settings.INVOICE_RENDER_WORKERS <= 0:
+            return pdf.render_invoice(data)
+
+        pool, slots = self._executor()
+        if not slots.acquire(blocking=False):
+            raise RendererBusy()
+        try:
+            return pool.submit(pdf.render_invoice, data).result(timeout=settings.INVOICE_RENDER_TIMEOUT)
+        except BrokenProcessPool:
+            # A render process died; start a fresh pool for the next request
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            raise
+        finally:
+            slots.release()
+
+
+renderer = InvoiceRenderer()
+
+
+def invoice_path(bill, digest):
+    return Path(settings.INVOICE_CACHE_DIR) / f"bill-{bill.pk}-{digest[:32]}.pdf"
+
+
+def get_invoice(bill, data=None):
+    """Return the path of the bill's invoice PDF, rendering it only if the
+    bill has changed since it was last printed."""
+    data = data or invoice_data(bill)
+    path = invoice_path(bill, invoice_digest(data))
+    if path.exists():
+        return path
+
+    content = renderer.render(data)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write under a temporary name and rename, so that a concurrent reader
+    # never sees a partial file
+    fd, temp_name = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as temp:
+        temp.write(content)
+    os.replace(temp_name, path)
+
+    # Earlier renders of this bill can never be served again
+    for stale in path.parent.glob(f"bill-{bill.pk}-*.pdf"):
+        if stale != path:
+            stale.unlink(missing_ok=True)
+    return path
@@ -0,0 +1,289 @@
+import logging
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import Count, F, Q, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# Registered tasks by name; filled by the @task decorator as modules such as
+# tasks.py are imported
+TASKS = {}
+# Seconds between a worker's checks for periodic tasks that are due
+SCHEDULE_INTERVAL = 60
+# PostgreSQL advisory lock key serializing claims while a concurrency limit
+# is being checked
+CLAIM_LOCK_KEY = 0x6b697374
+
+
+class Task:
+    def __init__(self, func, name, max_attempts, concurrency, backoff, every):
+        self.func = func
+        self.name = name
+        self.max_attempts = max_attempts
+        self.concurrency = concurrency
+        self.backoff = backoff
+        self.every = every
+
+    def __call__(self, **kwargs):
+        return self.func(**kwargs)
+
+    def enqueue(self, run_at=None, **kwargs):
+        return enqueue(self.name, run_at=run_at, **kwargs)
+
+    def retry_delay(self, attempts):
+        # Exponential backoff with jitter, so that jobs failing together do not
+        # all come back at the same moment
+        delay = self.backoff * 2 ** (attempts - 1)
+        return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def task(name=None, max_attempts=5, concurrency=None, backoff=30, every=None):
+    """Register a function as a background task.
+
+    `concurrency` caps how many jobs of the task run at once across all
+    workers, and a failed job is retried up to `max_attempts` times in all,
+    `backoff` seconds after the first failure and twice as long after each
+    further one. Keyword arguments must be JSON serializable. A task with
+    `every` set and no arguments is queued by the workers every `every`
+    seconds.
+    """
+    def register(func):
+        registered = Task(
+            func, name or f"{func.__module__}.{func.__name__}", max_attempts, concurrency, backoff, every
+        )
+        TASKS[registered.name] = registered
+        return registered
+    return register
+
+
+def enqueue(task_name, run_at=None, **kwargs):
+    """Queue a job. It is written in the caller's transaction, so workers only
+    see it once that transaction commits."""
+    if task_name not in TASKS:
+        raise KeyError(f"Unknown task {task_name!r}")
+    return Job.objects.create(
+        task=task_name,
+        kwargs=kwargs,
+        run_at=run_at or timezone.now(),
+        max_attempts=TASKS[task_name].max_attempts,
+    )
+
+
+def schedule_periodic_jobs():
+    """Queue a job for each periodic task that has none queued or running
+    and none created within its interval. Workers checking at the same moment
+    may both queue one; periodic tasks are written to tolerate that."""
+    now = timezone.now()
+    queued = []
+    for registered in TASKS.values():
+        if not registered.every:
+            continue
+        pending = Job.objects.filter(task=registered.name).filter(
+            Q(status__in=[Job.QUEUED, Job.RUNNING]) | Q(created_at__gte=now - timedelta(seconds=registered.every))
+        )
+        if not pending.exists():
+            queued.append(enqueue(registered.name))
+    return queued
+
+
+def _capacity():
+    """How many more jobs of each concurrency-limited task may start now."""
+    limited = {name: t.concurrency for name, t in TASKS.items() if t.concurrency}
+    if not limited:
+        return {}
+    running = dict(
+        Job.objects.filter(status=Job.RUNNING, task__in=limited)
+        .values_list('task').annotate(count=Count('id')).order_by()
+    )
+    return {name: limit - running.get(name, 0) for name, limit in limited.items()}
+
+
+def claim_jobs(worker_id, limit):
+    """Mark up to `limit` due jobs as running for this worker and return them.
+
+    PostgreSQL locks candidate rows with FOR UPDATE SKIP LOCKED, so concurrent
+    workers never wait on or claim each other's rows. Other backends claim each
+    candidate with an UPDATE conditional on it still being queued.
+    Concurrency limits are checked again by the UPDATE claiming a job of a
+    limited task; on PostgreSQL, whose statements only see rows committed
+    before they started, claims hold an advisory lock for that to hold.
+    """
+    if connection.vendor == 'postgresql':
+        with transaction.atomic():
+            if any(t.concurrency for t in TASKS.values()):
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s)', [CLAIM_LOCK_KEY])
+            capacity = _capacity()
+            due = _due_jobs(capacity).select_for_update(skip_locked=True)
+            return _claim(due[:limit * 2], worker_id, limit, capacity)
+    # Outside a transaction: on SQLite two workers reading and then writing in
+    # one transaction would deadlock, and each UPDATE below is atomic anyway
+    capacity = _capacity()
+    return _claim(_due_jobs(capacity)[:limit * 2], worker_id, limit, capacity)
+
+
+def _due_jobs(capacity):
+    due = Job.objects.filter(status=Job.QUEUED, run_at__lte=timezone.now(), task__in=list(TASKS))
+    full = [name for name, free in capacity.items() if free <= 0]
+    if full:
+        due = due.exclude(task__in=full)
+    return due.order_by('run_at', 'id')
+
+
+def _running(task_name):
+    return Coalesce(Subquery(
+        Job.objects.filter(task=task_name, status=Job.RUNNING).order_by()
+        .values('task').annotate(count=Count('id')).values('count')
+    ), 0)
+
+
+def _claim(candidates, worker_id, limit, capacity):
+    now = timezone.now()
+    claimed = []
+    for job in candidates:
+        if len(claimed) == limit:
+            break
+        if capacity.get(job.task, 1) <= 0:
+            continue
+        rows = Job.objects.filter(pk=job.pk, status=Job.QUEUED)
+        if job.task in capacity:
+            rows = rows.alias(running=_running(job.task)).filter(running__lt=TASKS[job.task].concurrency)
+        updated = rows.update(
+            status=Job.RUNNING, locked_by=worker_id, locked_at=now, attempts=F('attempts') + 1
+        )
+        if not updated:
+            continue
+        if job.task in capacity:
+            capacity[job.task] -= 1
+        job.status, job.locked_by, job.locked_at = Job.RUNNING, worker_id, now
+        job.attempts += 1
+        claimed.append(job)
+    return claimed
+
+
+def run_job(job):
+    """Run a claimed job and record its outcome, scheduling a retry if the
+    task failed and has attempts left."""
+    registered = TASKS.get(job.task)
+    try:
+        if registered is None:
+            raise KeyError(f"Unknown task {job.task!r}")
+        registered(**job.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        fields = {'locked_by': '', 'locked_at': None, 'last_error': error}
+        if registered is not None and job.attempts < job.max_attempts:
+            fields.update(status=Job.QUEUED, run_at=timezone.now() + registered.retry_delay(job.attempts))
+            logger.warning(f"Job {job} failed on attempt {job.attempts}, retrying at {fields['run_at']}")
+        else:
+            fields.update(status=Job.FAILED, finished_at=timezone.now())
+            logger.error(f"Job {job} failed after {job.attempts} attempts:\n{error}")
+    else:
+        fields = {'status': Job.SUCCEEDED, 'finished_at': timezone.now(), 'locked_by': '', 'locked_at': None}
+    # Only record the outcome if the job is still ours; it may have been
+    # requeued as stale in the meantime
+    Job.objects.filter(pk=job.pk, status=Job.RUNNING, locked_by=job.locked_by).update(**fields)
+    return fields['status']
+
+
+def touch_running_jobs(worker_id, job_ids):
+    """Renew the lock on jobs this worker is still running, so that a job
+    taking longer than JOB_LOCK_TIMEOUT is not requeued while it runs."""
+    return Job.objects.filter(pk__in=job_ids, status=Job.RUNNING, locked_by=worker_id).update(
+        locked_at=timezone.now()
+    )
+
+
+def requeue_stale_jobs():
+    """Put back jobs whose worker stopped without recording an outcome. The
+    lost run counts as an attempt, so a job that keeps crashing its worker
+    fails once it has used up its attempts."""
+    now = timezone.now()
+    stale = Job.objects.filter(status=Job.RUNNING, locked_at__lt=now - timedelta(seconds=settings.JOB_LOCK_TIMEOUT))
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(
+        status=Job.FAILED, finished_at=now, locked_by='', locked_at=None,
+        last_error='Worker stopped while running the job',
+    )
+    if failed:
+        logger.error(f"Failed {failed} jobs that were running when their worker stopped, with no attempts left")
+    return stale.update(status=Job.QUEUED, locked_by='', locked_at=None)
+
+
+def prune_finished_jobs():
+    """Delete jobs that finished more than JOB_RETENTION_DAYS ago."""
+    cutoff = timezone.now() - timedelta(days=settings.JOB_RETENTION_DAYS)
+    deleted, _ = Job.objects.filter(status__in=[Job.SUCCEEDED, Job.FAILED], finished_at__lt=cutoff).delete()
+    return deleted
+
+
+class Worker:
+    """Claims due jobs and runs them on a pool of `threads` threads."""
+
+    def __init__(self, threads=4, poll_interval=1.0, name=None):
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = threading.Event()
+        self._running = set()
+        self._next_schedule = 0
+        self._next_heartbeat = 0
+        self._lock = threading.Lock()
+
+    def stop(self):
+        self.stopping.set()
+
+    def _run(self, job):
+        try:
+            run_job(job)
+        except Exception:
+            logger.exception(f"Worker {self.name} could not record the outcome of {job}")
+        finally:
+            # Each pool thread has its own database connection
+            connection.close()
+            with self._lock:
+                self._running.discard(job.pk)
+
+    def run(self, once=False):
+        logger.info(f"Job worker {self.name} started with {self.threads} threads")
+        with ThreadPoolExecutor(self.threads, thread_name_prefix='job') as pool:
+            while not self.stopping.is_set():
+                close_old_connections()
+                with self._lock:
+                    running = list(self._running)
+                free = self.threads - len(running)
+                try:
+                    if time.monotonic() >= self._next_schedule:
+                        schedule_periodic_jobs()
+                        self._next_schedule = time.monotonic() + SCHEDULE_INTERVAL
+                    # Several heartbeats per lock timeout, so one missed
+                    # through a database hiccup does not lose the job
+                    if running and time.monotonic() >= self._next_heartbeat:
+                        touch_running_jobs(self.name, running)
+                        self._next_heartbeat = time.monotonic() + settings.JOB_LOCK_TIMEOUT / 3
+                    requeue_stale_jobs()
+                    jobs = claim_jobs(self.name, free) if free > 0 else []
+                except DatabaseError:
+                    logger.exception(f"Worker {self.name} could not claim jobs")
+                    jobs = []
+                for job in jobs:
+                    with self._lock:
+                        self._running.add(job.pk)
+                    pool.submit(self._run, job)
+                if once:
+                    break
+                if not jobs:
+                    self.stopping.wait(self.poll_interval)
+        logger.info(f"Job worker {self.name} stopped")
@@ -0,0 +1,68 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from kistrecords import invoices, pdf
+from kistrecords.models import Bill
+
+
+def sample_invoice(item_count):
+    return {
+        'clinic': 'Benchmark Clinic',
+        'fonts': [settings.INVOICE_FONT, settings.INVOICE_BOLD_FONT],
+        'bill_number': 'BILL-000',
+        'date': '2026-01-01 09:30',
+        'status': 'Pending',
+        'patient': {'name': 'Benchmark Patient', 'phone': '9800000000', 'address': 'Kathmandu'},
+        'items': [
+            {'service': f'Service {i}', 'quantity': '1', 'price': '150.00', 'total': '150.00'}
+            for i in range(item_count)
+        ],
+        'subtotal': f"{150 * item_count:.2f}",
+        'discount': '',
+        'discount_label': 'Discount',
+        'grand_total': f"{150 * item_count:.2f}",
+        'notes': '',
+    }
+
+
+class Command(BaseCommand):
+    help = 'Measure invoice PDF renders per second, inline and through a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--renders', type=int, default=200, help='Invoices rendered per run (default: 200)')
+        parser.add_argument('--items', type=int, default=10, help='Items per sample invoice (default: 10)')
+        parser.add_argument('--bill', type=int, help='Render this bill instead of a sample invoice')
+        parser.add_argument(
+            '--workers', type=int, default=multiprocessing.cpu_count(),
+            help='Processes in the pooled run (default: one per CPU)'
+        )
+
+    def handle(self, *args, **options):
+        if options['bill']:
+            try:
+                bill = Bill.objects.with_details().get(pk=options['bill'])
+            except Bill.DoesNotExist:
+                raise CommandError(f"Bill {options['bill']} does not exist")
+            data = invoices.invoice_data(bill)
+        else:
+            data = sample_invoice(options['items'])
+        renders = options['renders']
+
+        started = time.perf_counter()
+        for _ in range(renders):
+            size = len(pdf.render_invoice(data))
+        inline = renders / (time.perf_counter() - started)
+        self.stdout.write(f"inline:  {inline:8.1f} renders/s  ({size} bytes per invoice)")
+
+        workers = options['workers']
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            # Start the processes before timing
+            list(pool.map(pdf.render_invoice, [data] * workers))
+            started = time.perf_counter()
+            list(pool.map(pdf.render_invoice, [data] * renders, chunksize=max(1, renders // (workers * 4))))
+            pooled = renders / (time.perf_counter() - started)
+        self.stdout.write(f"pooled:  {pooled:8.1f} renders/s  ({workers} processes)")
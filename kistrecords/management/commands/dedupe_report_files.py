@@ -0,0 +1,100 @@
+import hashlib
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from kistrecords.blobs import READ_SIZE
+from kistrecords.charts import bump_chart_versions
+from kistrecords.models import MedicalReport, ReportBlob
+
+
+def storage_digest(name):
+    checksum = hashlib.sha256()
+    with default_storage.open(name, 'rb') as source:
+        for data in iter(lambda: source.read(READ_SIZE), b''):
+            checksum.update(data)
+    return checksum.hexdigest()
+
+
+def walk(directory):
+    directories, files = default_storage.listdir(directory)
+    for name in files:
+        yield f"{directory}/{name}"
+    for sub in directories:
+        yield from walk(f"{directory}/{sub}")
+
+
+class Command(BaseCommand):
+    help = (
+        'Move medical report files stored before deduplication into content-addressed '
+        'blobs, deleting duplicate copies, and report the space saved'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report what would change without changing it')
+        parser.add_argument(
+            '--delete-orphans', action='store_true',
+            help='Also delete files under medical_reports/ that no report refers to'
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        reports = MedicalReport.objects.filter(blob__isnull=True).exclude(file='').exclude(file__isnull=True)
+        seen = {blob.sha256: blob.file.name for blob in ReportBlob.objects.all()} if dry_run else {}
+        migrated = duplicates = saved = missing = 0
+
+        for report in reports.order_by('id').iterator():
+            name = report.file.name
+            if not default_storage.exists(name):
+                missing += 1
+                self.stderr.write(f"Report {report.pk}: {name} is missing, skipped")
+                continue
+            digest = storage_digest(name)
+            size = default_storage.size(name)
+            migrated += 1
+
+            if dry_run:
+                if digest in seen and seen[digest] != name:
+                    duplicates += 1
+                    saved += size
+                seen.setdefault(digest, name)
+                continue
+
+            with transaction.atomic():
+                blob = ReportBlob.objects.filter(sha256=digest).first()
+                if blob is None:
+                    # The first copy found becomes the blob, where it already is
+                    blob = ReportBlob.objects.create(sha256=digest, file=name, size=size, ref_count=1)
+                else:
+                    ReportBlob.objects.filter(pk=blob.pk).update(ref_count=F('ref_count') + 1)
+                MedicalReport.objects.filter(pk=report.pk).update(blob=blob, file=blob.file.name)
+                # The report's file URL may have changed
+                bump_chart_versions([report.patient_id])
+
+            if blob.file.name != name and not MedicalReport.objects.filter(file=name).exists():
+                default_storage.delete(name)
+                duplicates += 1
+                saved += size
+
+        orphans = orphan_bytes = 0
+        if default_storage.exists('medical_reports'):
+            referenced = set(MedicalReport.objects.values_list('file', flat=True))
+            referenced |= set(ReportBlob.objects.values_list('file', flat=True))
+            for name in walk('medical_reports'):
+                if name in referenced:
+                    continue
+                orphans += 1
+                orphan_bytes += default_storage.size(name)
+                if options['delete_orphans'] and not dry_run:
+                    default_storage.delete(name)
+
+        prefix = 'Would migrate' if dry_run else 'Migrated'
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix} {migrated} report files: {duplicates} duplicate copies, "
+            f"{saved / 1024 ** 2:.1f} MB saved ({missing} missing)"
+        ))
+        if orphans:
+            action = 'deleted' if options['delete_orphans'] and not dry_run else 'found (use --delete-orphans to remove)'
+            self.stdout.write(f"{orphans} unreferenced files, {orphan_bytes / 1024 ** 2:.1f} MB, {action}")
@@ -0,0 +1,104 @@
+import re
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from kistrecords.models import Bill, DailyRevenue, MedicalRecord, MedicalReport, Patient
+
+# Plan fragments showing that a table was read through an index, per backend
+INDEX_PATTERNS = {
+    'postgresql': [
+        r'Index (?:Only )?Scan(?: Backward)? using (\w+)',
+        r'Bitmap Index Scan on (\w+)',
+    ],
+    'sqlite': [
+        r'USING (?:COVERING )?INDEX (\w+)',
+        r'USING (INTEGER PRIMARY KEY)',
+    ],
+}
+# Plan fragments showing a full table read or an explicit sort
+SCAN_PATTERNS = {
+    'postgresql': [r'Seq Scan on (\w+)'],
+    'sqlite': [r'\bSCAN (\w+)(?!\w| USING)'],
+}
+SORT_PATTERNS = {
+    'postgresql': r'\bSort\b',
+    'sqlite': r'USE TEMP B-TREE FOR ORDER BY',
+}
+
+
+def hot_queries(patient_id, day):
+    page = 21
+    return [
+        ('patient chart: medical records',
+         MedicalRecord.objects.filter(patient_id=patient_id).order_by('-date')),
+        ('patient chart: bills',
+         Bill.objects.filter(patient_id=patient_id).order_by('-date')),
+        ('patient chart: medical reports',
+         MedicalReport.objects.filter(patient_id=patient_id).order_by('-date')),
+        ('bills for a day',
+         Bill.objects.filter(day=day).order_by('-date', '-id')),
+        ('bills by status',
+         Bill.objects.filter(status='Pending').order_by('date')),
+        ('bill list page',
+         Bill.objects.order_by('-date', '-id')[:page]),
+        ('patient list page',
+         Patient.objects.order_by('-created_at', '-id')[:page]),
+        ('dashboard rollup window',
+         DailyRevenue.objects.filter(day__gte=day - timedelta(days=6), day__lte=day)),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Run EXPLAIN on the hot kistrecords queries and report whether each one uses an index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patient', type=int, help='Patient id to use in chart queries')
+        parser.add_argument(
+            '--strict', action='store_true',
+            help='Exit with an error if any query reads a whole table or sorts'
+        )
+        parser.add_argument(
+            '--disable-seqscan', action='store_true',
+            help='PostgreSQL only: SET enable_seqscan = off, so that small tables '
+                 'still show whether an index is usable'
+        )
+
+    def handle(self, *args, **options):
+        vendor = connection.vendor
+        if vendor not in INDEX_PATTERNS:
+            raise CommandError(f"Plan inspection is not supported for the {vendor} backend")
+
+        if options['disable_seqscan']:
+            if vendor != 'postgresql':
+                raise CommandError('--disable-seqscan is only supported on PostgreSQL')
+            with connection.cursor() as cursor:
+                cursor.execute('SET enable_seqscan = off')
+
+        patient_id = options['patient'] or Patient.objects.values_list('id', flat=True).first() or 0
+        problems = []
+        for label, queryset in hot_queries(patient_id, timezone.localdate()):
+            plan = queryset.explain()
+            indexes = [m for p in INDEX_PATTERNS[vendor] for m in re.findall(p, plan)]
+            scans = [m for p in SCAN_PATTERNS[vendor] for m in re.findall(p, plan)]
+            sorts = re.search(SORT_PATTERNS[vendor], plan) is not None
+
+            if indexes and not scans and not sorts:
+                self.stdout.write(self.style.SUCCESS(f"OK    {label}: {', '.join(indexes)}"))
+            else:
+                problems.append(label)
+                details = []
+                if scans:
+                    details.append(f"full scan of {', '.join(scans)}")
+                if sorts:
+                    details.append('sort')
+                if indexes:
+                    details.append(f"index {', '.join(indexes)}")
+                self.stdout.write(self.style.WARNING(f"CHECK {label}: {'; '.join(details) or 'no index'}"))
+            if options['verbosity'] > 1:
+                self.stdout.write(plan)
+
+        if problems and options['strict']:
+            raise CommandError(f"{len(problems)} hot queries do not use an index: {', '.join(problems)}")
@@ -0,0 +1,54 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from kistrecords import exports
+
+
+def day_argument(value):
+    try:
+        day = parse_date(value)
+    except ValueError:
+        day = None
+    if day is None:
+        raise CommandError(f"Invalid date {value!r}, expected YYYY-MM-DD format")
+    return day
+
+
+class Command(BaseCommand):
+    help = 'Stream bills or bill items for a date range as CSV or NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('start', type=day_argument, help='First day to export (YYYY-MM-DD)')
+        parser.add_argument('end', type=day_argument, help='Last day to export (YYYY-MM-DD)')
+        parser.add_argument('--type', choices=list(exports.EXPORT_COLUMNS), default='bills')
+        parser.add_argument('--output-format', choices=list(exports.EXPORT_FORMATS), default='csv')
+        parser.add_argument('--output', help='File to write to (default: stdout)')
+        parser.add_argument(
+            '--chunk-size', type=int, default=exports.EXPORT_CHUNK_SIZE,
+            help=f'Rows fetched per round trip (default: {exports.EXPORT_CHUNK_SIZE})'
+        )
+
+    def handle(self, *args, **options):
+        start, end = options['start'], options['end']
+        if end < start:
+            raise CommandError('end must be on or after start')
+
+        lines = exports.export_lines(
+            options['type'], options['output_format'], start, end, options['chunk_size']
+        )
+        out = open(options['output'], 'w', newline='', encoding='utf-8') if options['output'] else sys.stdout
+        try:
+            written = 0
+            for line in lines:
+                out.write(line)
+                written += 1
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+        if options['output']:
+            if options['output_format'] == 'csv':
+                written -= 1
+            self.stdout.write(self.style.SUCCESS(f"Exported {written} {options['type']} to {options['output']}"))
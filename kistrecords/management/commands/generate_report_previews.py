@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from kistrecords import jobs
+from kistrecords.models import MedicalReport
+from kistrecords.previews import generate_previews
+
+
+class Command(BaseCommand):
+    help = 'Queue thumbnail and preview generation for image reports that have none yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sync', action='store_true',
+            help='Generate the previews in this process instead of queueing jobs'
+        )
+
+    def handle(self, *args, **options):
+        reports = MedicalReport.objects.filter(type='image', thumbnail__isnull=True).exclude(file='')
+        count = failed = 0
+        for report in reports.select_related('blob').order_by('id').iterator():
+            if options['sync']:
+                try:
+                    generate_previews(report)
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f"Report {report.pk}: {e}")
+                    continue
+            else:
+                jobs.enqueue('generate_report_previews', report_id=report.pk)
+            count += 1
+
+        action = 'Generated previews for' if options['sync'] else 'Queued preview jobs for'
+        self.stdout.write(self.style.SUCCESS(f"{action} {count} image reports ({failed} failed)"))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from kistrecords.rollups import rebuild_daily_rollups
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the DailyRevenue rollup table from all existing bills'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-days', type=int, default=31,
+            help='Number of days aggregated per query (default: 31)'
+        )
+
+    def handle(self, *args, **options):
+        log = self.stdout.write if options['verbosity'] > 1 else None
+        created = rebuild_daily_rollups(chunk_days=options['chunk_days'], log=log)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {created} daily rollup rows"))
@@ -0,0 +1,58 @@
+import multiprocessing
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from kistrecords.jobs import TASKS, Worker
+
+
+def run_worker(threads, poll_interval, once):
+    worker = Worker(threads=threads, poll_interval=poll_interval)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: worker.stop())
+    worker.run(once=once)
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=4, help='Jobs run at once per process (default: 4)')
+        parser.add_argument(
+            '--processes', type=int, default=1,
+            help='Worker processes to start, each with its own thread pool (default: 1)'
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help='Seconds to wait between polls when no job is due (default: 1)'
+        )
+        parser.add_argument('--once', action='store_true', help='Claim one batch of due jobs, run it and exit')
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['processes'] < 1:
+            raise CommandError('--threads and --processes must be at least 1')
+        self.stdout.write(f"Registered tasks: {', '.join(sorted(TASKS)) or 'none'}")
+        worker_args = (options['threads'], options['poll_interval'], options['once'])
+        if options['processes'] == 1:
+            run_worker(*worker_args)
+            return
+
+        # Children must not share the parent's database connections
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        children = [
+            context.Process(target=run_worker, args=worker_args, name=f"run_jobs-{i}")
+            for i in range(options['processes'])
+        ]
+        for child in children:
+            child.start()
+
+        def stop_children(*args):
+            for child in children:
+                if child.is_alive():
+                    child.terminate()
+        signal.signal(signal.SIGTERM, stop_children)
+        signal.signal(signal.SIGINT, stop_children)
+        for child in children:
+            child.join()
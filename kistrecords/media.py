@@ -0,0 +1,199 @@
+import mimetypes
+import os
+import re
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.signing import BadSignature, Signer
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+# Files of a MedicalReport that can be served, by URL variant
+REPORT_FILE_FIELDS = ('file', 'thumbnail', 'preview')
+STREAM_BLOCK_SIZE = 64 * 1024
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+_signer = Signer(salt='kistrecords.media')
+
+
+def url_epoch():
+    """Index of the current signing window. Signed URLs, and so anything
+    cached that embeds them, stay the same for a whole window."""
+    return int(time.time() // settings.MEDIA_URL_LIFETIME)
+
+
+def _signature(report_id, variant, expires):
+    return _signer.signature(f"{report_id}:{variant}:{expires}")
+
+
+def report_file_url(report, variant='file', request=None, signed=True):
+    """URL of a report file. Signed URLs work without an Authorization header,
+    for use in <img> and <a> tags, and stay valid for at least
+    MEDIA_URL_LIFETIME seconds; only ever hand them to users allowed to see
+    the report."""
+    field = getattr(report, variant)
+    if not field:
+        return None
+    url = reverse('medical-report-file', kwargs={'pk': report.pk, 'variant': variant})
+    if signed:
+        # Rounded to the signing window, so the URL is stable within it
+        expires = (url_epoch() + 2) * settings.MEDIA_URL_LIFETIME
+        url = f"{url}?expires={expires}&signature={_signature(report.pk, variant, expires)}"
+    return request.build_absolute_uri(url) if request is not None else url
+
+
+def signature_is_valid(report_id, variant, expires, signature):
+    try:
+        expires = int(expires)
+    except (TypeError, ValueError):
+        return False
+    if expires < time.time():
+        return False
+    try:
+        _signer.unsign(f"{report_id}:{variant}:{expires}{_signer.sep}{signature}")
+    except BadSignature:
+        return False
+    return True
+
+
+def _etag(report, variant, size, modified):
+    if variant == 'file' and report.blob_id:
+        return f'"{report.blob.sha256}"'
+    return f'"{size:x}-{int(modified):x}"'
+
+
+def _parse_range(header, size):
+    """(start, end) of a single byte range, inclusive; None for a header we do
+    not handle, which means sending the whole file; False if unsatisfiable."""
+    match = _RANGE_RE.match(header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if start > end:
+            return False if start >= size else None
+    else:
+        # bytes=-N: the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        start, end = max(size - length, 0), size - 1
+    return start, end
+
+
+def _stat(name):
+    """(local path, size, modification time) of a stored file. The path is
+    None for storages without local files, such as S3, whose files are read
+    through the storage API instead."""
+    try:
+        path = default_storage.path(name)
+    except NotImplementedError:
+        if not default_storage.exists(name):
+            raise FileNotFoundError(name)
+        try:
+            modified = default_storage.get_modified_time(name).timestamp()
+        except NotImplementedError:
+            modified = 0
+        return None, default_storage.size(name), modified
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime
+
+
+def _open(path, name):
+    return open(path, 'rb') if path is not None else default_storage.open(name, 'rb')
+
+
+def _read_range(path, name, start, length):
+    with _open(path, name) as source:
+        source.seek(start)
+        while length > 0:
+            data = source.read(min(STREAM_BLOCK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def serve_report_file(request, report, variant):
+    """Respond with one of a report's files once access has been checked.
+
+    With MEDIA_SENDFILE set, the front proxy is told which file to send and
+    handles ranges itself; otherwise the file is streamed from here with
+    Range, ETag and Last-Modified support. X-Sendfile needs a local path, so
+    with other storages the file is streamed from here as well.
+    """
+    field = getattr(report, variant)
+    name = field.name
+    try:
+        path, size, modified = _stat(name)
+    except FileNotFoundError:
+        return HttpResponse(status=404)
+
+    etag = _etag(report, variant, size, modified)
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(modified))
+    if not_modified is not None:
+        return not_modified
+
+    extension = Path(name).suffix
+    filename = report.title if variant == 'file' else f"{report.title}-{variant}"
+    if not filename.lower().endswith(extension.lower()):
+        filename += extension
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    # Both headers are URL-decoded by the proxy, and a non-ASCII value would
+    # be MIME-encoded by Django and never match a file
+    if settings.MEDIA_SENDFILE == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = quote(settings.MEDIA_SENDFILE_PREFIX.rstrip('/') + '/' + name)
+    elif settings.MEDIA_SENDFILE == 'x-sendfile' and path is not None:
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = quote(path)
+    else:
+        response = _stream_file(request, path, name, size, content_type, etag, modified)
+
+    response['Content-Disposition'] = content_disposition_header(False, filename)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(modified)
+    response['Accept-Ranges'] = 'bytes'
+    response['Cache-Control'] = 'private, max-age=3600'
+    return response
+
+
+def _stream_file(request, path, name, size, content_type, etag, modified):
+    byte_range = None
+    if 'Range' in request.headers and _if_range_matches(request, etag, modified):
+        byte_range = _parse_range(request.headers['Range'], size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f"bytes */{size}"
+        return response
+    if byte_range is None:
+        # Whole file: FileResponse lets the WSGI server use sendfile() on
+        # local files
+        return FileResponse(_open(path, name), content_type=content_type)
+
+    start, end = byte_range
+    length = end - start + 1
+    response = StreamingHttpResponse(_read_range(path, name, start, length), status=206, content_type=content_type)
+    response['Content-Range'] = f"bytes {start}-{end}/{size}"
+    response['Content-Length'] = str(length)
+    return response
+
+
+def _if_range_matches(request, etag, modified):
+    # A range only applies to the representation the client already has part of
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    since = parse_http_date_safe(if_range)
+    return since is not None and int(modified) <= since
@@ -0,0 +1,257 @@
+import hmac
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection
+from django.http import Http404, HttpResponse
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'http_request_duration_seconds': (
+        'histogram', 'Time to produce a response, by URL name', LATENCY_BUCKETS
+    ),
+    'http_request_db_queries': (
+        'histogram', 'Database queries run per request, by URL name', QUERY_BUCKETS
+    ),
+    'http_request_db_duration_seconds': (
+        'histogram', 'Time spent in database queries per request, by URL name', LATENCY_BUCKETS
+    ),
+    'http_response_size_bytes': (
+        'histogram', 'Response body size, by URL name; streamed bodies of unknown length are left out', SIZE_BUCKETS
+    ),
+    'http_responses_total': (
+        'counter', 'Responses, by URL name and status code', None
+    ),
+}
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Registry:
+    """Metric values of this process. Histograms keep a count per bucket,
+    the last one for values above every bound, followed by the sum."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = {}
+        self.changed = False
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [0] * (len(buckets) + 2)
+            entry[bisect_left(buckets, value)] += 1
+            entry[-1] += value
+            self.changed = True
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+            self.changed = True
+
+    def snapshot(self, flushing=False):
+        with self._lock:
+            if flushing:
+                self.changed = False
+            return {key: list(value) if isinstance(value, list) else value for key, value in self.values.items()}
+
+    def clear(self):
+        with self._lock:
+            self.values.clear()
+            self.changed = False
+
+
+registry = Registry()
+
+
+def _dump(values):
+    return json.dumps([[name, labels, value] for (name, labels), value in values.items()])
+
+
+def _load(data):
+    return {(name, tuple(map(tuple, labels))): value for name, labels, value in json.loads(data)}
+
+
+def _merge(total, values):
+    for key, value in values.items():
+        if key[0] not in METRICS:
+            continue
+        current = total.get(key)
+        if current is None:
+            total[key] = value
+        elif isinstance(value, list):
+            total[key] = [a + b for a, b in zip(current, value)]
+        else:
+            total[key] = current + value
+    return total
+
+
+class _Flusher:
+    """With METRICS_DIR set, writes this process's registry to its own file
+    every METRICS_FLUSH_INTERVAL seconds when it has changed, so that whichever
+    gunicorn worker answers /metrics can report on all of them."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def path(self, pid=None):
+        return Path(settings.METRICS_DIR) / f"metrics-{pid or os.getpid()}.json"
+
+    def ensure_started(self):
+        # Per pid, as workers forked after the first request get no threads
+        if not settings.METRICS_DIR or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            Path(settings.METRICS_DIR).mkdir(parents=True, exist_ok=True)
+            threading.Thread(target=self._run, name='metrics-flush', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            if registry.changed and settings.METRICS_DIR:
+                try:
+                    self.flush()
+                except OSError:
+                    logger.exception('Could not write metrics')
+
+    def flush(self):
+        path = self.path()
+        fd, temp_name = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        with os.fdopen(fd, 'w') as temp:
+            temp.write(_dump(registry.snapshot(flushing=True)))
+        os.replace(temp_name, path)
+
+
+flusher = _Flusher()
+
+
+def collect():
+    """Metric values of every process: this one's live, the others' from the
+    last file they wrote. Files of exited workers are kept so that counters
+    never go down; empty METRICS_DIR when restarting the server."""
+    total = registry.snapshot()
+    if settings.METRICS_DIR:
+        own = flusher.path().name
+        for path in Path(settings.METRICS_DIR).glob('metrics-*.json'):
+            if path.name == own:
+                continue
+            try:
+                _merge(total, _load(path.read_text()))
+            except (OSError, ValueError):
+                continue
+    return total
+
+
+def _format_labels(labels):
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(values):
+    """Values in the Prometheus text exposition format."""
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        series = sorted((labels, value) for (metric, labels), value in values.items() if metric == name)
+        if not series:
+            continue
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in series:
+            if kind == 'counter':
+                lines.append(f"{name}{_format_labels(labels)} {_format_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), value):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_number(value[-1])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+class QueryTimer:
+    """connection.execute_wrapper that counts and times queries."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+
+class MetricsMiddleware:
+    """Records latency, database use, response size and status code of each
+    request under the name of the URL it resolved to. For streamed responses
+    the latency ends when streaming starts."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        flusher.ensure_started()
+        timer = QueryTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(timer):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        method = request.method if request.method in METHODS else 'other'
+        labels = (('view', view), ('method', method))
+        registry.observe('http_request_duration_seconds', labels, duration)
+        registry.observe('http_request_db_queries', labels, timer.count)
+        registry.observe('http_request_db_duration_seconds', labels, timer.duration)
+        if not response.streaming:
+            registry.observe('http_response_size_bytes', labels, len(response.content))
+        elif response.has_header('Content-Length'):
+            registry.observe('http_response_size_bytes', labels, int(response['Content-Length']))
+        registry.inc('http_responses_total', labels + (('status', str(response.status_code)),))
+        return response
+
+
+def metrics_view(request):
+    # Scrapers send METRICS_TOKEN as a bearer token; without one configured
+    # the endpoint only exists in development
+    if not settings.METRICS_TOKEN and not settings.DEBUG:
+        raise Http404()
+    expected = f"Bearer {settings.METRICS_TOKEN}"
+    if settings.METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get('Authorization', '').encode(), expected.encode()
+    ):
+        return HttpResponse(status=403)
+    return HttpResponse(render(collect()), content_type=CONTENT_TYPE)
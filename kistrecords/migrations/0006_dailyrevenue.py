@@ -0,0 +1,60 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:26
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce, TruncDate
+
+
+def populate_daily_revenue(apps, schema_editor):
+    Bill = apps.get_model('kistrecords', 'Bill')
+    DailyRevenue = apps.get_model('kistrecords', 'DailyRevenue')
+    revenue_fields = {
+        'Paid': 'paid_revenue',
+        'Pending': 'pending_revenue',
+        'Cancelled': 'cancelled_revenue',
+    }
+    rows = (
+        Bill.objects.annotate(day=TruncDate('date'))
+        .values('day')
+        .annotate(
+            bill_count=Count('id'),
+            patient_count=Count('patient', distinct=True),
+            **{
+                field: Coalesce(Sum('grand_total', filter=Q(status=status)), Decimal('0.00'))
+                for status, field in revenue_fields.items()
+            }
+        )
+        .order_by()
+    )
+    DailyRevenue.objects.bulk_create(
+        (DailyRevenue(**row) for row in rows.iterator(chunk_size=1000)),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kistrecords', '0005_medicalreport_file_alter_medicalreport_fileurl'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRevenue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('bill_count', models.PositiveIntegerField(default=0)),
+                ('patient_count', models.PositiveIntegerField(default=0)),
+                ('paid_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('pending_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('cancelled_revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'ordering': ['-day'],
+            },
+        ),
+        migrations.RunPython(populate_daily_revenue, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kistrecords', '0006_dailyrevenue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillNumberSequence',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prefix', models.CharField(max_length=10)),
+                ('year', models.PositiveIntegerField(default=0)),
+                ('next_value', models.PositiveBigIntegerField(default=1)),
+            ],
+            options={
+                'unique_together': {('prefix', 'year')},
+            },
+        ),
+    ]
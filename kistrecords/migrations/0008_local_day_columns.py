@@ -0,0 +1,32 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:10
+
+from django.db import migrations
+
+import kistrecords.models
+
+
+class Migration(migrations.Migration):
+    # The columns start out nullable so that adding them is quick; they are
+    # filled in by 0009 and made NOT NULL by 0010
+
+    dependencies = [
+        ('kistrecords', '0007_billnumbersequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bill',
+            name='day',
+            field=kistrecords.models.LocalDayField(db_index=True, editable=False, null=True, source='date'),
+        ),
+        migrations.AddField(
+            model_name='medicalrecord',
+            name='day',
+            field=kistrecords.models.LocalDayField(db_index=True, editable=False, null=True, source='date'),
+        ),
+        migrations.AddField(
+            model_name='medicalreport',
+            name='day',
+            field=kistrecords.models.LocalDayField(db_index=True, editable=False, null=True, source='date'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:10
+
+from django.db import migrations
+from django.db.models import Max, Min
+from django.db.models.functions import TruncDate
+
+BACKFILL_BATCH_SIZE = 5000
+
+
+def populate_day_columns(apps, schema_editor):
+    # TruncDate converts to the current time zone, matching LocalDayField
+    for model_name in ('Bill', 'MedicalRecord', 'MedicalReport'):
+        model = apps.get_model('kistrecords', model_name)
+        bounds = model.objects.aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['first'] is None:
+            continue
+        for start in range(bounds['first'], bounds['last'] + 1, BACKFILL_BATCH_SIZE):
+            model.objects.filter(
+                pk__gte=start, pk__lt=start + BACKFILL_BATCH_SIZE
+            ).update(day=TruncDate('date'))
+
+
+class Migration(migrations.Migration):
+    # Each batch commits on its own, so the tables are never locked for the
+    # whole backfill; rerunning it after an interruption fills them in again
+    atomic = False
+
+    dependencies = [
+        ('kistrecords', '0008_local_day_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(populate_day_columns, migrations.RunPython.noop),
+    ]
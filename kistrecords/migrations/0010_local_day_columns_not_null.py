@@ -0,0 +1,30 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:10
+
+from django.db import migrations
+
+import kistrecords.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kistrecords', '0009_backfill_local_day_columns'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bill',
+            name='day',
+            field=kistrecords.models.LocalDayField(db_index=True, editable=False, source='date'),
+        ),
+        migrations.AlterField(
+            model_name='medicalrecord',
+            name='day',
+            field=kistrecords.models.LocalDayField(db_index=True, editable=False, source='date'),
+        ),
+        migrations.AlterField(
+            model_name='medicalreport',
+            name='day',
+            field=kistrecords.models.LocalDayField(db_index=True, editable=False, source='date'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:34
+
+import kistrecords.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kistrecords', '0010_local_day_columns_not_null'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='bill',
+            name='day',
+            field=kistrecords.models.LocalDayField(db_index=False, editable=False, source='date'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['patient', '-date'], name='bill_patient_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['status', 'date'], name='bill_status_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['-date', '-id'], name='bill_date_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='bill',
+            index=models.Index(fields=['day', '-date', '-id'], name='bill_day_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='medicalrecord',
+            index=models.Index(fields=['patient', '-date'], name='medrecord_patient_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='medicalreport',
+            index=models.Index(fields=['patient', '-date'], name='medreport_patient_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['-created_at', '-id'], name='patient_created_id_idx'),
+        ),
+    ]
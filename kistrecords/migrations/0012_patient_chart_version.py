@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kistrecords', '0011_chart_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='chart_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:36
+
+import re
+
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+
+def populate_search_index(apps, schema_editor):
+    Patient = apps.get_model('kistrecords', 'Patient')
+    connection = schema_editor.connection
+
+    batch = []
+    for patient in Patient.objects.only('id', 'phone').iterator(chunk_size=BATCH_SIZE):
+        patient.phone_reversed = re.sub(r'\D', '', patient.phone or '')[::-1][:15]
+        batch.append(patient)
+        if len(batch) == BATCH_SIZE:
+            Patient.objects.bulk_update(batch, ['phone_reversed'])
+            batch = []
+    Patient.objects.bulk_update(batch, ['phone_reversed'])
+
+    if connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS patient_name_trgm_idx '
+            'ON kistrecords_patient USING gin (name gin_trgm_ops)'
+        )
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS patient_email_trgm_idx '
+            'ON kistrecords_patient USING gin (email gin_trgm_ops)'
+        )
+    elif connection.vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS kistrecords_patient_search '
+            "USING fts5(name, email, tokenize = 'trigram')"
+        )
+        schema_editor.execute(
+            'INSERT INTO kistrecords_patient_search (rowid, name, email) '
+            "SELECT id, name, COALESCE(email, '') FROM kistrecords_patient"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS patient_name_trgm_idx')
+        schema_editor.execute('DROP INDEX IF EXISTS patient_email_trgm_idx')
+    elif connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS kistrecords_patient_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kistrecords', '0012_patient_chart_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='phone_reversed',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=15),
+        ),
+        # Trigram GIN indexes on PostgreSQL, an FTS5 trigram table on SQLite;
+        # see kistrecords/search.py
+        migrations.RunPython(populate_search_index, drop_search_index),
+    ]
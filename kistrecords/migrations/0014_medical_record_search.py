@@ -0,0 +1,53 @@
+# Generated by Django 5.2.1 on 2026-10-17 14:02
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        # A generated column is kept current by PostgreSQL on every write,
+        # including bulk and queryset updates that bypass signals
+        schema_editor.execute(
+            'ALTER TABLE kistrecords_medicalrecord ADD COLUMN IF NOT EXISTS search_vector tsvector '
+            "GENERATED ALWAYS AS ("
+            "setweight(to_tsvector('english', coalesce(diagnosis, '')), 'A') || "
+            "setweight(to_tsvector('english', coalesce(treatment, '')), 'B') || "
+            "setweight(to_tsvector('english', coalesce(notes, '')), 'C')"
+            ") STORED"
+        )
+        schema_editor.execute(
+            'CREATE INDEX IF NOT EXISTS medrecord_search_vector_idx '
+            'ON kistrecords_medicalrecord USING gin (search_vector)'
+        )
+    elif connection.vendor == 'sqlite':
+        schema_editor.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS kistrecords_medicalrecord_search '
+            "USING fts5(diagnosis, treatment, notes, tokenize = 'porter unicode61')"
+        )
+        schema_editor.execute(
+            'INSERT INTO kistrecords_medicalrecord_search (rowid, diagnosis, treatment, notes) '
+            "SELECT id, diagnosis, treatment, COALESCE(notes, '') FROM kistrecords_medicalrecord"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS medrecord_search_vector_idx')
+        schema_editor.execute('ALTER TABLE kistrecords_medicalrecord DROP COLUMN IF EXISTS search_vector')
+    elif connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS kistrecords_medicalrecord_search')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kistrecords', '0013_patient_search_index'),
+    ]
+
+    operations = [
+        # A weighted tsvector column with a GIN index on PostgreSQL, an FTS5
+        # table on SQLite; see MedicalRecordSearch in kistrecords/search.py
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kistrecords', '0017_report_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='medicalreport',
+            name='preview',
+            field=models.FileField(blank=True, editable=False, max_length=255, null=True, upload_to=''),
+        ),
+        migrations.AddField(
+            model_name='medicalreport',
+            name='thumbnail',
+            field=models.FileField(blank=True, editable=False, max_length=255, null=True, upload_to=''),
+        ),
+    ]
@@ -1,6 +1,41 @@
+import re
+import uuid
+
 from django.db import models
 from django.core.validators import MinValueValidator
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
+
+class LocalDayField(models.DateField):
+    """Stores the calendar day, in the current time zone, of the DateTimeField
+    named by `source`, so day filters compare against a plain indexed column
+    instead of casting every row's timestamp.
+
+    Declare it after its source so auto_now_add has already run in pre_save;
+    this also covers bulk_create.
+    """
+
+    def __init__(self, *args, source=None, **kwargs):
+        self.source = source
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('db_index', True)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        # Always spelled out, since __init__ has different defaults than DateField
+        kwargs['source'] = self.source
+        kwargs['editable'] = self.editable
+        kwargs['db_index'] = self.db_index
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = getattr(model_instance, self.source)
+        if value is None:
+            return super().pre_save(model_instance, add)
+        day = timezone.localdate(value) if timezone.is_aware(value) else value.date()
+        setattr(model_instance, self.attname, day)
+        return day
 
 class CustomUser(AbstractUser):
     ROLE_CHOICES = (
@@ -30,12 +65,36 @@ class Patient(models.Model):
     last_visit = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Incremented whenever anything shown on the patient's chart changes; see
+    # charts.bump_chart_versions
+    chart_version = models.PositiveIntegerField(default=0, editable=False)
+    # Phone digits in reverse order, so that searching by the last digits of a
+    # number is an indexed prefix lookup; maintained in save()
+    phone_reversed = models.CharField(max_length=15, blank=True, editable=False, db_index=True)
 
     def __str__(self):
         return self.name
 
+    @staticmethod
+    def reverse_phone(phone):
+        return re.sub(r'\D', '', phone or '')[::-1]
+
+    def save(self, *args, **kwargs):
+        self.phone_reversed = self.reverse_phone(self.phone)[:15]
+        # chart_version is only changed with UPDATE ... SET chart_version + 1,
+        # so never write back a possibly stale in-memory value
+        if not self._state.adding and not kwargs.get('force_insert') and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'chart_version'
+            ]
+        super().save(*args, **kwargs)
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='patient_created_id_idx'),
+        ]
 
 class Service(models.Model):
     CATEGORY_CHOICES = (
@@ -57,6 +116,15 @@ class Service(models.Model):
     def __str__(self):
         return self.name
 
+def bill_items_prefetch():
+    return models.Prefetch('items', queryset=BillItem.objects.select_related('service'))
+
+class BillQuerySet(models.QuerySet):
+    def with_details(self):
+        # Everything BillSerializer reads: the patient name and each item's
+        # service name, in three queries however many bills are listed
+        return self.select_related('patient').prefetch_related(bill_items_prefetch())
+
 class Bill(models.Model):
     DISCOUNT_TYPES = [
         ('percentage', 'Percentage'),
@@ -70,6 +138,8 @@ class Bill(models.Model):
     
     bill_number = models.CharField(max_length=20, unique=True)
     date = models.DateTimeField(auto_now_add=True)
+    # Indexed through bill_day_date_idx below
+    day = LocalDayField(source='date', db_index=False)
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='bills')
     discount_type = models.CharField(max_length=10, choices=DISCOUNT_TYPES, blank=True, null=True)
     discount_value = models.DecimalField(max_digits=10, decimal_places=2, default=0)
@@ -78,17 +148,79 @@ class Bill(models.Model):
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='Pending')
     created_by = models.ForeignKey(CustomUser, on_delete=models.PROTECT)
     notes = models.TextField(blank=True)
+
+    objects = BillQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient', '-date'], name='bill_patient_date_idx'),
+            models.Index(fields=['status', 'date'], name='bill_status_date_idx'),
+            models.Index(fields=['-date', '-id'], name='bill_date_id_idx'),
+            models.Index(fields=['day', '-date', '-id'], name='bill_day_date_idx'),
+        ]
+
+    ROLLUP_FIELDS = ('day', 'patient_id', 'status', 'grand_total')
     
     def __str__(self):
         return self.bill_number
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what this row contributed to the daily rollup so that a
+        # later save or delete can apply the difference
+        if all(name in field_names for name in cls.ROLLUP_FIELDS):
+            instance._rollup_state = instance.rollup_state()
+        return instance
+
+    def rollup_state(self):
+        return (self.day, self.patient_id, self.status, self.grand_total)
     
     def save(self, *args, **kwargs):
         if not self.bill_number:
-            last_bill = Bill.objects.order_by('-id').first()
-            last_id = last_bill.id if last_bill else 0
-            self.bill_number = f"BILL-{last_id + 1:03d}"
+            from .numbering import next_bill_number
+            self.bill_number = next_bill_number(timezone.localdate(self.date) if self.date else None)
         super().save(*args, **kwargs)
 
+class DailyRevenue(models.Model):
+    # Per-day rollup of Bill rows, kept current by the Bill signal handlers in
+    # signals.py and rebuilt with the rebuild_daily_rollups command
+    day = models.DateField(unique=True)
+    bill_count = models.PositiveIntegerField(default=0)
+    patient_count = models.PositiveIntegerField(default=0)
+    paid_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    pending_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    cancelled_revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    REVENUE_FIELDS = {
+        'Paid': 'paid_revenue',
+        'Pending': 'pending_revenue',
+        'Cancelled': 'cancelled_revenue',
+    }
+
+    class Meta:
+        ordering = ['-day']
+
+    def __str__(self):
+        return f"{self.day}: {self.bill_count} bills"
+
+    @property
+    def revenue(self):
+        return self.paid_revenue + self.pending_revenue + self.cancelled_revenue
+
+class BillNumberSequence(models.Model):
+    # Block counter used by numbering.BillNumberAllocator on databases without
+    # native sequences; year is 0 when numbers are not scoped per year
+    prefix = models.CharField(max_length=10)
+    year = models.PositiveIntegerField(default=0)
+    next_value = models.PositiveBigIntegerField(default=1)
+
+    class Meta:
+        unique_together = ('prefix', 'year')
+
+    def __str__(self):
+        return f"{self.prefix}-{self.year}: {self.next_value}" if self.year else f"{self.prefix}: {self.next_value}"
+
 class BillItem(models.Model):
     bill = models.ForeignKey(Bill, on_delete=models.CASCADE, related_name='items')
     service = models.ForeignKey(Service, on_delete=models.PROTECT)
@@ -106,10 +238,16 @@ class BillItem(models.Model):
 class MedicalRecord(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='medical_records')
     date = models.DateTimeField(auto_now_add=True)
+    day = LocalDayField(source='date')
     doctor = models.CharField(max_length=100)
     diagnosis = models.CharField(max_length=200)
     treatment = models.TextField()
     notes = models.TextField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient', '-date'], name='medrecord_patient_date_idx'),
+        ]
     
     def delete(self, *args, **kwargs):
         # Custom delete logic can be added here if needed in the future
@@ -119,18 +257,44 @@ class MedicalRecord(models.Model):
     def __str__(self):
         return f"{self.diagnosis} - {self.patient.name} ({self.date.strftime('%Y-%m-%d')})"
 
+class ReportBlob(models.Model):
+    # One stored copy of a medical report file, shared by every MedicalReport
+    # with the same content and deleted with the last of them; see blobs.py
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.ref_count} refs)"
+
 class MedicalReport(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='medical_reports')
     title = models.CharField(max_length=200)
     date = models.DateTimeField(auto_now_add=True)
+    day = LocalDayField(source='date')
     type = models.CharField(max_length=50, choices=[('image', 'Image'), ('document', 'Document')])
     file = models.FileField(upload_to='medical_reports/', null=True, blank=True)
     fileUrl = models.URLField(blank=True, null=True)  # Keep for compatibility
     uploadedBy = models.CharField(max_length=100)
+    # Set for deduplicated files, in which case `file` names the blob's file
+    blob = models.ForeignKey(ReportBlob, on_delete=models.PROTECT, null=True, blank=True, related_name='reports')
+    # Downscaled copies of image reports, generated in the background by the
+    # generate_report_previews task; see previews.py
+    thumbnail = models.FileField(max_length=255, null=True, blank=True, editable=False)
+    preview = models.FileField(max_length=255, null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['patient', '-date'], name='medreport_patient_date_idx'),
+        ]
     
     def delete(self, *args, **kwargs):
-        # Delete the file from the filesystem when the model instance is deleted
-        if self.file:
+        # Delete the file from the filesystem when the model instance is deleted;
+        # a deduplicated file is released by signals.py instead, and only
+        # deleted with its last reference
+        if self.file and self.blob_id is None:
             # Get the storage backend
             storage = self.file.storage
             # Get the file name
@@ -138,8 +302,76 @@ class MedicalReport(models.Model):
             # Delete the file if it exists
             if storage.exists(file_name):
                 storage.delete(file_name)
+            for derivative in (self.thumbnail, self.preview):
+                if derivative and storage.exists(derivative.name):
+                    storage.delete(derivative.name)
         # Call the parent delete method
         super().delete(*args, **kwargs)
     
     def __str__(self):
-        return f"{self.title} - {self.patient.name}"
\ No newline at end of file
+        return f"{self.title} - {self.patient.name}"
+
+class Job(models.Model):
+    # A unit of background work run by the run_jobs worker; see jobs.py
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    ]
+
+    task = models.CharField(max_length=100)
+    kwargs = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    run_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at', 'id'], name='job_status_run_at_idx'),
+            models.Index(fields=['task', 'status'], name='job_task_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.task} #{self.pk} ({self.status})"
+
+
+class UploadSession(models.Model):
+    # A medical report file being uploaded in chunks; see uploads.py. The
+    # bytes received so far live in a part file under UPLOAD_TEMP_DIR
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='upload_sessions')
+    created_by = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    title = models.CharField(max_length=200)
+    type = models.CharField(max_length=50, choices=[('image', 'Image'), ('document', 'Document')])
+    uploaded_by = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    report = models.OneToOneField(MedicalReport, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received}/{self.size} bytes)"
+
+
+
+class RevokedToken(models.Model):
+    # A refresh token that may no longer be used, kept until it would have
+    # expired anyway; see revocation.py
+    jti = models.CharField(max_length=64, unique=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.jti
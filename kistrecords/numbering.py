@@ -0,0 +1,153 @@
+import re
+import threading
+from collections import deque
+from functools import partial
+
+from django.conf import settings
+from django.db import IntegrityError, ProgrammingError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Bill, BillNumberSequence
+
+
+def _scope(day=None):
+    day = day or timezone.localdate()
+    year = day.year if settings.BILL_NUMBER_PER_YEAR else 0
+    return settings.BILL_NUMBER_PREFIX, year
+
+
+def _number_prefix(scope):
+    prefix, year = scope
+    return f"{prefix}-{year}-" if year else f"{prefix}-"
+
+
+def _format(scope, value):
+    return f"{_number_prefix(scope)}{value:03d}"
+
+
+def _first_free_value(scope):
+    # Continue after the highest number already issued for this prefix, so a
+    # new sequence picks up where the old order_by('-id') numbering stopped
+    pattern = re.compile(re.escape(_number_prefix(scope)) + r'(\d+)$')
+    highest = 0
+    numbers = Bill.objects.filter(
+        bill_number__startswith=_number_prefix(scope)
+    ).values_list('bill_number', flat=True)
+    for number in numbers.iterator():
+        match = pattern.match(number)
+        if match:
+            highest = max(highest, int(match.group(1)))
+    return highest + 1
+
+
+class _Block:
+    """A run of reserved sequence values held by this process."""
+
+    def __init__(self, values):
+        self.values = deque(values)
+
+    def usable(self):
+        return bool(self.values)
+
+    def take(self, count):
+        return [self.values.popleft() for _ in range(min(count, len(self.values)))]
+
+
+class BillNumberAllocator:
+    """Hands out bill numbers from blocks reserved per process.
+
+    On PostgreSQL each prefix/year has its own database sequence and a block
+    is fetched with a single nextval() query. Other backends reserve a block
+    by incrementing a BillNumberSequence row. Numbers are unique but not
+    gap-free: values left in a block when a worker exits are never used.
+
+    A counter block reserved inside the caller's transaction only exists if
+    that transaction commits; if it or a savepoint around the reservation
+    rolls back, the values may be handed out again by another worker. Such a
+    block serves the allocation that reserved it and is only shared with later
+    ones from its transaction's on_commit callback, which Django drops on
+    rollback.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}
+
+    def allocate(self, count=1, day=None):
+        scope = _scope(day)
+        values = []
+        with self._lock:
+            while len(values) < count:
+                block = self._blocks.get(scope)
+                if block is None or not block.usable():
+                    size = max(settings.BILL_NUMBER_BLOCK_SIZE, count - len(values))
+                    block, committed = self._reserve(scope, size)
+                    if committed:
+                        self._blocks[scope] = block
+                    else:
+                        transaction.on_commit(partial(self._share, scope, block))
+                values.extend(block.take(count - len(values)))
+        return [_format(scope, value) for value in values]
+
+    def _share(self, scope, block):
+        with self._lock:
+            current = self._blocks.get(scope)
+            if block.usable() and (current is None or not current.usable()):
+                self._blocks[scope] = block
+
+    def reset(self):
+        with self._lock:
+            self._blocks.clear()
+
+    def _reserve(self, scope, size):
+        """A new block and whether its reservation is already committed."""
+        if connection.vendor == 'postgresql':
+            # nextval() is never rolled back
+            return _Block(self._reserve_from_sequence(scope, size)), True
+        return _Block(self._reserve_from_counter(scope, size)), not connection.in_atomic_block
+
+    def _reserve_from_sequence(self, scope, size):
+        prefix, year = scope
+        name = re.sub(r'[^a-z0-9_]', '_', f"kistrecords_bill_number_{prefix.lower()}_{year}")
+        fetch = "SELECT nextval(%s) FROM generate_series(1, %s)"
+        with connection.cursor() as cursor:
+            try:
+                with transaction.atomic():
+                    cursor.execute(fetch, [name, size])
+            except ProgrammingError:
+                # First block for this prefix/year: create its sequence
+                cursor.execute(
+                    f"CREATE SEQUENCE IF NOT EXISTS {connection.ops.quote_name(name)} "
+                    f"START WITH {_first_free_value(scope)}"
+                )
+                cursor.execute(fetch, [name, size])
+            return [row[0] for row in cursor.fetchall()]
+
+    def _reserve_from_counter(self, scope, size):
+        prefix, year = scope
+        sequences = BillNumberSequence.objects.filter(prefix=prefix, year=year)
+        with transaction.atomic():
+            # Take the write lock with the UPDATE before reading the counter
+            if not sequences.update(next_value=F('next_value') + size):
+                try:
+                    with transaction.atomic():
+                        BillNumberSequence.objects.create(
+                            prefix=prefix, year=year,
+                            next_value=_first_free_value(scope) + size
+                        )
+                except IntegrityError:
+                    sequences.update(next_value=F('next_value') + size)
+            end = sequences.values_list('next_value', flat=True).get()
+        return range(end - size, end)
+
+
+allocator = BillNumberAllocator()
+
+
+def next_bill_number(day=None):
+    return allocator.allocate(1, day)[0]
+
+
+def allocate_bill_numbers(count, day=None):
+    return allocator.allocate(count, day)
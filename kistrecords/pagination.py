@@ -0,0 +1,168 @@
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Cursor pagination on a compound key such as (date, id).
+
+    Each page is fetched with a WHERE on the last row of the previous page
+    instead of an OFFSET, and no COUNT(*) is run, so every page costs the same
+    however far back it is. `ordering` must end with a unique field.
+    """
+    ordering = ('-id',)
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    total_query_param = 'total'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.fields = [field.lstrip('-') for field in self.ordering]
+        self.model = queryset.model
+        self.total = self.get_total(queryset) if request.query_params.get(self.total_query_param) else None
+
+        position, reverse = self.decode_cursor(request)
+        ordering = self.ordering
+        if reverse:
+            ordering = [field[1:] if field.startswith('-') else f'-{field}' for field in ordering]
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self.after(position, ordering))
+
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+            self.has_previous, self.has_next = has_more, True
+        else:
+            self.has_previous, self.has_next = position is not None, has_more
+        self.page = rows
+        return rows
+
+    def after(self, position, ordering):
+        # (a, b) > (x, y) written out as a > x OR (a = x AND b > y), with the
+        # comparison flipped for descending fields
+        condition = Q()
+        for i in reversed(range(len(ordering))):
+            field = ordering[i].lstrip('-')
+            lookup = 'lt' if ordering[i].startswith('-') else 'gt'
+            step = Q(**{f'{field}__{lookup}': position[i]})
+            if i < len(ordering) - 1:
+                step |= Q(**{field: position[i]}) & condition
+            condition = step
+        return condition
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def get_total(self, queryset):
+        """Row estimate from the query planner on PostgreSQL, an exact count
+        elsewhere."""
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql':
+            plan = json.loads(queryset.order_by().explain(format='json'))
+            return {'count': int(plan[0]['Plan']['Plan Rows']), 'approximate': True}
+        return {'count': queryset.count(), 'approximate': False}
+
+    def encode_cursor(self, row, reverse):
+        values = []
+        for field in self.fields:
+            value = getattr(row, self.model._meta.get_field(field).attname)
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        token = json.dumps({'p': values, 'r': int(reverse)}, separators=(',', ':'))
+        cursor = base64.urlsafe_b64encode(token.encode()).decode()
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+        try:
+            token = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            position = [
+                self.model._meta.get_field(field).to_python(value)
+                for field, value in zip(self.fields, token['p'], strict=True)
+            ]
+            return position, bool(token['r'])
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        response = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+        if self.total is not None:
+            response['count'] = self.total['count']
+            response['count_is_approximate'] = self.total['approximate']
+        return Response(response)
+
+
+class SelectablePagination(BasePagination):
+    """Page numbers by default, keyset pagination when the request carries a
+    `cursor` or asks for `pagination=cursor`."""
+    keyset_class = KeysetPagination
+    page_number_class = PageNumberPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        use_keyset = (
+            'cursor' in request.query_params
+            or request.query_params.get('pagination') == 'cursor'
+        )
+        self.paginator = self.keyset_class() if use_keyset else self.page_number_class()
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
+
+
+class BillKeysetPagination(KeysetPagination):
+    ordering = ('-date', '-id')
+
+
+class PatientKeysetPagination(KeysetPagination):
+    ordering = ('-created_at', '-id')
+
+
+class BillPagination(SelectablePagination):
+    keyset_class = BillKeysetPagination
+
+
+class PatientPagination(SelectablePagination):
+    keyset_class = PatientKeysetPagination
+
+
+class MedicalRecordSearchPagination(PageNumberPagination):
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
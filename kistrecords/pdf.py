@@ -0,0 +1,205 @@
+"""Invoice PDFs, drawn with reportlab.
+
+Text Helvetica can show is set in the standard Helvetica fonts. Anything else,
+such as Devanagari, is set in the TrueType fonts named in the invoice and
+shaped with HarfBuzz, so conjuncts and vowel signs come out as they should.
+Nothing here imports Django, so render_invoice() can run in a freshly spawned
+worker process.
+"""
+import io
+import logging
+import os
+
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFError, TTFont
+from reportlab.pdfgen import canvas
+from reportlab.pdfgen.textobject import bidiShapedText
+
+logger = logging.getLogger(__name__)
+
+PAGE_WIDTH, PAGE_HEIGHT = A4
+MARGIN = 50
+
+_HELVETICA = ('Helvetica', 'Helvetica-Bold')
+# reportlab font names of registered TrueType files, by path
+_registered = {}
+
+
+def load_font(path):
+    """The reportlab name of the TrueType font at `path`, registering it on
+    first use, or None if it cannot be loaded."""
+    if not path:
+        return None
+    if path not in _registered:
+        name = f"Invoice-{len(_registered)}-{os.path.splitext(os.path.basename(path))[0]}"
+        try:
+            pdfmetrics.registerFont(TTFont(name, path))
+        except (OSError, TTFError) as error:
+            # Reported by the kistrecords.W001 system check; print what we can
+            logger.warning(f"Cannot load invoice font {path}: {error}")
+            name = None
+        _registered[path] = name
+    return _registered[path]
+
+
+def _in_helvetica(char):
+    try:
+        char.encode('cp1252')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+class Document:
+    """Pages of drawing operations, drawn on a reportlab canvas by to_bytes()
+    once the number of pages is known."""
+
+    def __init__(self, title='', fonts=(None, None)):
+        self.title = title
+        regular, bold = fonts
+        # Fonts for text outside Helvetica, by boldness
+        self.fonts = (regular, bold or regular)
+        self.pages = []
+
+    def add_page(self):
+        self.pages.append([])
+
+    def _runs(self, text, bold):
+        """(text, font, shaped) pieces of `text`, split where it moves between
+        Helvetica and the TrueType font. Spaces stay with the run they follow."""
+        runs = []
+        for char in text:
+            other = self.fonts[bold] is not None and not _in_helvetica(char)
+            font, shaped = (self.fonts[bold], True) if other else (_HELVETICA[bold], False)
+            if runs and (runs[-1][1] == font or char.isspace()):
+                runs[-1][0] += char
+            else:
+                runs.append([char, font, shaped])
+        return runs
+
+    def text_width(self, text, size, bold=False):
+        width = 0
+        for run, font, shaped in self._runs(text, bold):
+            if shaped:
+                width += bidiShapedText(run, fontName=font, fontSize=size, shaping=True)[1]
+            else:
+                width += pdfmetrics.stringWidth(run, font, size)
+        return width
+
+    def fit_text(self, text, width, size, bold=False):
+        """Truncate `text` with an ellipsis so that it fits in `width` points."""
+        if self.text_width(text, size, bold) <= width:
+            return text
+        while text and self.text_width(text + '...', size, bold) > width:
+            text = text[:-1]
+        return text + '...'
+
+    def text(self, x, y, text, size=10, bold=False, page=-1):
+        for run, font, shaped in self._runs(text, bold):
+            self.pages[page].append(('text', x, y, run, font, size, shaped))
+            x += self.text_width(run, size, bold)
+
+    def text_right(self, x, y, text, size=10, bold=False):
+        self.text(x - self.text_width(text, size, bold), y, text, size, bold)
+
+    def line(self, x1, y1, x2, y2, width=0.5):
+        self.pages[-1].append(('line', x1, y1, x2, y2, width))
+
+    def to_bytes(self):
+        out = io.BytesIO()
+        pdf = canvas.Canvas(out, pagesize=A4, pageCompression=1)
+        pdf.setTitle(self.title)
+        pdf.setProducer('kistrecords')
+        for operations in self.pages:
+            for kind, *args in operations:
+                if kind == 'text':
+                    x, y, text, font, size, shaped = args
+                    pdf.setFont(font, size)
+                    pdf.drawString(x, y, text, shaping=shaped)
+                else:
+                    x1, y1, x2, y2, width = args
+                    pdf.setLineWidth(width)
+                    pdf.line(x1, y1, x2, y2)
+            pdf.showPage()
+        pdf.save()
+        return out.getvalue()
+
+
+# Invoice layout: x positions of the item table columns
+_COL_SERVICE = MARGIN
+_COL_QUANTITY = 370
+_COL_PRICE = 455
+_COL_TOTAL = PAGE_WIDTH - MARGIN
+_ROW_HEIGHT = 16
+_FOOTER_Y = MARGIN + 20
+
+
+def _item_header(doc, y):
+    doc.text(_COL_SERVICE, y, 'Service', bold=True)
+    doc.text_right(_COL_QUANTITY, y, 'Qty', bold=True)
+    doc.text_right(_COL_PRICE, y, 'Price', bold=True)
+    doc.text_right(_COL_TOTAL, y, 'Amount', bold=True)
+    doc.line(MARGIN, y - 5, PAGE_WIDTH - MARGIN, y - 5)
+    return y - _ROW_HEIGHT - 4
+
+
+def render_invoice(invoice):
+    """Render an invoice dict, as built by kistrecords.invoices.invoice_data(),
+    to PDF bytes. All values in it are already formatted strings, but for
+    `fonts`, the paths of the regular and bold TrueType fonts for text
+    Helvetica cannot show."""
+    fonts = invoice.get('fonts') or (None, None)
+    doc = Document(title=f"Invoice {invoice['bill_number']}", fonts=[load_font(path) for path in fonts])
+    doc.add_page()
+
+    y = PAGE_HEIGHT - MARGIN - 10
+    if invoice.get('clinic'):
+        doc.text(MARGIN, y, invoice['clinic'], size=16, bold=True)
+        y -= 26
+    doc.text(MARGIN, y, 'INVOICE', size=14, bold=True)
+    doc.text_right(PAGE_WIDTH - MARGIN, y, invoice['bill_number'], size=14, bold=True)
+    y -= 22
+    doc.text_right(PAGE_WIDTH - MARGIN, y, f"Date: {invoice['date']}")
+    doc.text_right(PAGE_WIDTH - MARGIN, y - 14, f"Status: {invoice['status']}")
+
+    patient = invoice['patient']
+    doc.text(MARGIN, y, 'Billed to', bold=True)
+    y -= 14
+    for line in (patient['name'], patient.get('phone'), patient.get('address')):
+        if line:
+            doc.text(MARGIN, y, doc.fit_text(line, 300, 10))
+            y -= 14
+    y = _item_header(doc, y - 16)
+
+    service_width = _COL_QUANTITY - _COL_SERVICE - 50
+    for item in invoice['items']:
+        if y < _FOOTER_Y + _ROW_HEIGHT:
+            doc.add_page()
+            y = _item_header(doc, PAGE_HEIGHT - MARGIN - 10)
+        doc.text(_COL_SERVICE, y, doc.fit_text(item['service'], service_width, 10))
+        doc.text_right(_COL_QUANTITY, y, item['quantity'])
+        doc.text_right(_COL_PRICE, y, item['price'])
+        doc.text_right(_COL_TOTAL, y, item['total'])
+        y -= _ROW_HEIGHT
+
+    totals = [('Subtotal', invoice['subtotal'], False)]
+    if invoice.get('discount'):
+        totals.append((invoice['discount_label'], f"-{invoice['discount']}", False))
+    totals.append(('Total', invoice['grand_total'], True))
+    if y < _FOOTER_Y + _ROW_HEIGHT * (len(totals) + 1):
+        doc.add_page()
+        y = PAGE_HEIGHT - MARGIN - 10
+    doc.line(_COL_QUANTITY - 40, y + 6, PAGE_WIDTH - MARGIN, y + 6)
+    y -= 6
+    for label, amount, bold in totals:
+        doc.text_right(_COL_PRICE, y, label, bold=bold)
+        doc.text_right(_COL_TOTAL, y, amount, bold=bold)
+        y -= _ROW_HEIGHT
+
+    if invoice.get('notes') and y > _FOOTER_Y + _ROW_HEIGHT * 2:
+        doc.text(MARGIN, y - 10, doc.fit_text(f"Notes: {invoice['notes']}", PAGE_WIDTH - 2 * MARGIN, 9), size=9)
+
+    for number in range(1, len(doc.pages) + 1):
+        doc.text(PAGE_WIDTH - MARGIN - 50, MARGIN, f"Page {number} of {len(doc.pages)}", size=8, page=number - 1)
+    return doc.to_bytes()
@@ -0,0 +1,61 @@
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from .charts import bump_chart_versions
+from .models import MedicalReport
+
+# Longest side in pixels of each derivative, by MedicalReport field
+PREVIEW_SIZES = {
+    'preview': 1024,
+    'thumbnail': 200,
+}
+PREVIEW_FORMAT = 'WEBP'
+PREVIEW_QUALITY = 80
+
+
+def preview_key(report):
+    # Derivatives of a deduplicated file are shared by every report using it
+    return report.blob.sha256 if report.blob_id else f"report-{report.pk}"
+
+
+def preview_name(key, field):
+    return f"report_previews/{key[:2]}/{key}-{field}.webp"
+
+
+def delete_previews(key):
+    for field in PREVIEW_SIZES:
+        default_storage.delete(preview_name(key, field))
+
+
+def generate_previews(report):
+    """Write the thumbnail and preview of an image report, unless files with
+    the same content already have them, and link them to the report."""
+    from PIL import Image, ImageOps
+
+    key = preview_key(report)
+    names = {field: preview_name(key, field) for field in PREVIEW_SIZES}
+    missing = [field for field, name in names.items() if not default_storage.exists(name)]
+
+    if missing:
+        with report.file.open('rb') as source:
+            image = Image.open(source)
+            # Let JPEG decode straight to roughly the largest size needed
+            image.draft('RGB', (max(PREVIEW_SIZES.values()),) * 2)
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            # Largest first, each one scaled down from the one before
+            for field in sorted(PREVIEW_SIZES, key=PREVIEW_SIZES.get, reverse=True):
+                size = PREVIEW_SIZES[field]
+                image.thumbnail((size, size), Image.Resampling.LANCZOS)
+                if field in missing:
+                    output = BytesIO()
+                    image.save(output, PREVIEW_FORMAT, quality=PREVIEW_QUALITY)
+                    default_storage.delete(names[field])
+                    default_storage.save(names[field], ContentFile(output.getvalue()))
+
+    MedicalReport.objects.filter(pk=report.pk).update(**names)
+    # update() skips the signals that would mark the chart as changed
+    bump_chart_versions([report.patient_id])
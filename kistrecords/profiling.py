@@ -0,0 +1,134 @@
+import logging
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from . import metrics
+
+logger = logging.getLogger('kistrecords.sql')
+
+_IN_LIST_RE = re.compile(r'\((?:%s, )+%s\)')
+_LIBRARY_DIRS = ('site-packages', 'dist-packages')
+_INSTRUMENTATION_FILES = {__file__, metrics.__file__}
+
+
+class RepeatedQueries(Exception):
+    """Raised by the profiler middleware when SQL_PROFILER_RAISE is on."""
+
+
+def query_shape(sql):
+    # Parameters are placeholders already; only IN lists vary in length
+    return _IN_LIST_RE.sub('(...)', sql)
+
+
+def _library_path(filename):
+    for part in _LIBRARY_DIRS:
+        filename = filename.split(f"{part}{os.sep}")[-1]
+    return filename
+
+
+def call_site():
+    """Where a query comes from: the innermost frame of project code, or of
+    library code running a method of a project class, such as the list() a
+    ModelViewSet inherits from DRF."""
+    root = str(settings.BASE_DIR)
+    app_prefix = f"{__package__}."
+    fallback = None
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        # Execute wrappers and their middleware wrap every query
+        if filename not in _INSTRUMENTATION_FILES:
+            site = f"{frame.f_lineno} in {frame.f_code.co_name}"
+            if filename.startswith(root) and not any(part in filename for part in _LIBRARY_DIRS):
+                return f"{Path(filename).relative_to(root)}:{site}"
+            owner = type(frame.f_locals.get('self'))
+            if owner.__module__.startswith(app_prefix):
+                return f"{owner.__name__}.{frame.f_code.co_name} via {_library_path(filename)}:{frame.f_lineno}"
+            if fallback is None and f"{os.sep}django{os.sep}db{os.sep}" not in filename:
+                fallback = f"{_library_path(filename)}:{site}"
+        frame = frame.f_back
+    return fallback or 'unknown'
+
+
+class QueryProfile:
+    """connection.execute_wrapper that keeps every query with its duration
+    and the line of project code that ran it."""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((sql, time.perf_counter() - start, call_site()))
+
+    @property
+    def duration(self):
+        return sum(duration for _, duration, _ in self.queries)
+
+    def repeated(self, threshold):
+        """(shape, count, total seconds, call sites) of every query shape run
+        at least `threshold` times, most frequent first."""
+        groups = defaultdict(list)
+        for sql, duration, site in self.queries:
+            groups[query_shape(sql)].append((duration, site))
+        return sorted(
+            (
+                (shape, len(runs), sum(duration for duration, _ in runs), sorted({site for _, site in runs}))
+                for shape, runs in groups.items() if len(runs) >= threshold
+            ),
+            key=lambda group: -group[1],
+        )
+
+    def slow(self, threshold_ms):
+        return [query for query in self.queries if query[1] * 1000 >= threshold_ms]
+
+    def describe_repeated(self, threshold):
+        return '\n'.join(
+            f"{count} x {shape} ({total * 1000:.1f} ms in all, from {', '.join(sites)})"
+            for shape, count, total, sites in self.repeated(threshold)
+        )
+
+
+@contextmanager
+def profile_queries():
+    profile = QueryProfile()
+    with connection.execute_wrapper(profile):
+        yield profile
+
+
+class SQLProfilerMiddleware:
+    """Logs slow queries and repeated query shapes (N+1 patterns) of each
+    request. Only active with SQL_PROFILER on, as it records a stack walk
+    per query."""
+
+    def __init__(self, get_response):
+        if not settings.SQL_PROFILER:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with profile_queries() as profile:
+            response = self.get_response(request)
+
+        endpoint = f"{request.method} {request.path}"
+        for sql, duration, site in profile.slow(settings.SQL_SLOW_QUERY_MS):
+            logger.warning(f"Slow query ({duration * 1000:.1f} ms) in {endpoint} from {site}: {sql}")
+        repeated = profile.describe_repeated(settings.SQL_REPEATED_QUERY_THRESHOLD)
+        if repeated:
+            message = f"Repeated queries in {endpoint} ({len(profile.queries)} queries in all):\n{repeated}"
+            if settings.SQL_PROFILER_RAISE:
+                raise RepeatedQueries(message)
+            logger.warning(message)
+        return response
@@ -0,0 +1,138 @@
+import hashlib
+import math
+import threading
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import cache as cache_utils
+from .models import RevokedToken
+
+REVOCATION_NAMESPACE = 'revoked-tokens'
+# Bumped by pruning, after which ids may be reused (SQLite) and workers
+# reload the table instead of reading past the last id they saw
+PRUNE_NAMESPACE = 'revoked-tokens-pruned'
+
+
+class BloomFilter:
+    """A set of strings that can answer "definitely not in it" in constant
+    memory, with a false positive rate of about `error_rate` up to `capacity`
+    members."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        # Double hashing: k positions from the two halves of one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class RevocationStore:
+    """Per-process view of the RevokedToken table.
+
+    Lookups go to a Bloom filter, which rules out almost every token that was
+    never revoked, and then to an exact map of jti to expiry. Revoking a token
+    bumps a version in the shared cache; other workers notice it on their next
+    lookup and load only the rows added since they last looked.
+    """
+
+    def __init__(self, capacity=1024):
+        self._lock = threading.Lock()
+        self._reset(capacity)
+        self.version = self.prune_version = None
+
+    def _reset(self, capacity):
+        self.bloom = BloomFilter(capacity)
+        self.expiries = {}
+        self.last_id = 0
+
+    def _add(self, jti, expires_at):
+        if len(self.expiries) >= self.bloom.capacity:
+            self._rebuild()
+        self.expiries[jti] = expires_at
+        self.bloom.add(jti)
+
+    def _rebuild(self):
+        # Bloom filters cannot drop members, so expired tokens go by starting
+        # over, with room for the live ones to double
+        now = timezone.now()
+        live = {jti: expires for jti, expires in self.expiries.items() if expires > now}
+        last_id = self.last_id
+        self._reset(max(1024, 2 * len(live)))
+        self.last_id = last_id
+        for jti, expires in live.items():
+            self.expiries[jti] = expires
+            self.bloom.add(jti)
+
+    def sync(self):
+        version = cache_utils.get_version(REVOCATION_NAMESPACE)
+        prune_version = cache_utils.get_version(PRUNE_NAMESPACE)
+        if version == self.version and prune_version == self.prune_version:
+            return
+        with self._lock:
+            if prune_version != self.prune_version:
+                self._reset(self.bloom.capacity)
+                self.prune_version = prune_version
+            rows = (
+                RevokedToken.objects.filter(id__gt=self.last_id, expires_at__gt=timezone.now())
+                .order_by('id').values_list('id', 'jti', 'expires_at')
+            )
+            for row_id, jti, expires_at in rows.iterator():
+                self._add(jti, expires_at)
+                self.last_id = row_id
+            self.version = version
+
+    def is_revoked(self, jti):
+        # A row committing after one with a higher id can be missed by sync();
+        # revoke() is the authoritative check for tokens being used up
+        self.sync()
+        if jti not in self.bloom:
+            return False
+        expires_at = self.expiries.get(jti)
+        return expires_at is not None and expires_at > timezone.now()
+
+    def clear(self):
+        with self._lock:
+            self._reset(1024)
+            self.version = self.prune_version = None
+
+
+store = RevocationStore()
+
+
+def token_expiry(token):
+    return datetime.fromtimestamp(token['exp'], tz=dt_timezone.utc)
+
+
+def revoke(jti, expires_at):
+    """Record a token as revoked. Returns False if it already was, which makes
+    this safe to use as the check too when two requests race to use a token."""
+    try:
+        with transaction.atomic():
+            RevokedToken.objects.create(jti=jti, expires_at=expires_at)
+    except IntegrityError:
+        return False
+    transaction.on_commit(lambda: cache_utils.bump_version(REVOCATION_NAMESPACE))
+    return True
+
+
+def prune_revoked_tokens():
+    """Delete revoked tokens that have expired in one statement; they would be
+    rejected for their expiry anyway."""
+    deleted, _ = RevokedToken.objects.filter(expires_at__lte=timezone.now()).delete()
+    if deleted:
+        transaction.on_commit(lambda: cache_utils.bump_version(PRUNE_NAMESPACE))
+    return deleted
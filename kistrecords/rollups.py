@@ -0,0 +1,133 @@
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Bill, DailyRevenue
+
+ZERO_AMOUNT = Decimal('0.00')
+
+
+def _new_delta():
+    return {'bill_count': 0, 'revenue': defaultdict(Decimal)}
+
+
+def _add_contribution(deltas, state, sign):
+    day, patient_id, status, grand_total = state
+    delta = deltas[day]
+    delta['bill_count'] += sign
+    delta['revenue'][status] += sign * Decimal(grand_total or 0)
+
+
+def _distinct_patients(day):
+    return Coalesce(
+        Subquery(
+            Bill.objects.filter(day=day).order_by().values('day')
+            .annotate(count=Count('patient', distinct=True)).values('count')
+        ),
+        0
+    )
+
+
+def _apply_deltas(deltas):
+    for day, delta in deltas.items():
+        # Counted again rather than adjusted: when several bills of a patient
+        # go in one cascade or queryset delete, each post_delete runs after all
+        # of them are gone, so no single bill can tell whether it was the last
+        updates = {'patient_count': _distinct_patients(day)}
+        if delta['bill_count']:
+            updates['bill_count'] = F('bill_count') + delta['bill_count']
+        for status, amount in delta['revenue'].items():
+            if amount:
+                field = DailyRevenue.REVENUE_FIELDS[status]
+                updates[field] = F(field) + amount
+        DailyRevenue.objects.get_or_create(day=day)
+        DailyRevenue.objects.filter(day=day).update(**updates)
+
+
+def remember_bill_state(bill):
+    """Read what a stored bill contributes to the rollup before it is saved or
+    deleted, when it was loaded without all of Bill.ROLLUP_FIELDS (through
+    only() or defer()) and from_db() could not record it."""
+    if bill._state.adding or bill.pk is None or hasattr(bill, '_rollup_state'):
+        return
+    bill._rollup_state = (
+        Bill.objects.filter(pk=bill.pk).values_list(*Bill.ROLLUP_FIELDS).first()
+    )
+
+
+def record_bill_saved(bill, created):
+    old_state = None if created else getattr(bill, '_rollup_state', None)
+    new_state = bill.rollup_state()
+    if old_state == new_state:
+        return
+
+    deltas = defaultdict(_new_delta)
+    if old_state is not None:
+        _add_contribution(deltas, old_state, -1)
+    _add_contribution(deltas, new_state, 1)
+    _apply_deltas(deltas)
+    bill._rollup_state = new_state
+
+
+def record_bill_deleted(bill):
+    state = getattr(bill, '_rollup_state', None)
+    if state is None:
+        return
+    deltas = defaultdict(_new_delta)
+    _add_contribution(deltas, state, -1)
+    _apply_deltas(deltas)
+
+
+def record_bills_created(bills):
+    """Apply rollup changes for bills inserted with bulk_create, which skips
+    the post_save signal."""
+    if not bills:
+        return
+    deltas = defaultdict(_new_delta)
+    for bill in bills:
+        state = bill.rollup_state()
+        _add_contribution(deltas, state, 1)
+        bill._rollup_state = state
+    _apply_deltas(deltas)
+
+
+def rebuild_daily_rollups(chunk_days=31, log=None):
+    """Recompute every DailyRevenue row from the Bill table, one grouped query
+    per window of `chunk_days` days."""
+    with transaction.atomic():
+        DailyRevenue.objects.all().delete()
+        bounds = Bill.objects.aggregate(first_day=Min('day'), last_day=Max('day'))
+        if bounds['first_day'] is None:
+            return 0
+
+        first_day, last_day = bounds['first_day'], bounds['last_day']
+        revenue = {
+            field: Coalesce(Sum('grand_total', filter=Q(status=status)), ZERO_AMOUNT)
+            for status, field in DailyRevenue.REVENUE_FIELDS.items()
+        }
+
+        created = 0
+        start = first_day
+        while start <= last_day:
+            end = start + timedelta(days=chunk_days)
+            rows = (
+                Bill.objects.filter(day__gte=start, day__lt=end)
+                .values('day')
+                .annotate(
+                    bill_count=Count('id'),
+                    patient_count=Count('patient', distinct=True),
+                    **revenue
+                )
+                .order_by()
+            )
+            rollups = [DailyRevenue(**row) for row in rows]
+            DailyRevenue.objects.bulk_create(rollups)
+            created += len(rollups)
+            if log:
+                log(f"{start} to {end - timedelta(days=1)}: {len(rollups)} days")
+            start = end
+        return created
@@ -0,0 +1,289 @@
+import re
+from difflib import SequenceMatcher
+
+from django.db import connection
+from django.db.models import Case, F, FloatField, Lookup, Q, Value, When
+from django.utils.html import escape
+
+from .models import MedicalRecord, Patient
+
+PATIENT_SEARCH_TABLE = 'kistrecords_patient_search'
+# Minimum similarity for a fuzzy name match to be returned
+NAME_SIMILARITY_THRESHOLD = 0.3
+# Candidates fetched from the index per requested result before re-ranking
+CANDIDATE_FACTOR = 5
+# Separators people type in phone numbers, ignored when telling a phone
+# query from a name
+PHONE_PUNCTUATION = re.compile(r'[\s()+.-]')
+# Score of a match on the start of the email address
+EMAIL_PREFIX_SCORE = 0.9
+
+
+def _name_score(query, name):
+    """Similarity of `query` to a name, or to the best matching word in it, so
+    that "ram" ranks "Ram Thapa" highly and "raam" still finds it."""
+    query = query.lower()
+    name = (name or '').lower()
+    scores = [SequenceMatcher(None, query, name).ratio()]
+    scores += [SequenceMatcher(None, query, word).ratio() for word in name.split()]
+    if name.startswith(query) or any(word.startswith(query) for word in name.split()):
+        scores.append(0.9)
+    return max(scores)
+
+
+def _fts_trigram_query(text):
+    # OR together every trigram of the text: a misspelled name still shares
+    # most of its trigrams with the real one, and bm25 ranks by how many match
+    text = re.sub(r'\s+', ' ', text.lower()).strip()
+    trigrams = {text[i:i + 3] for i in range(len(text) - 2)}
+    return ' OR '.join('"{}"'.format(trigram.replace('"', '""')) for trigram in sorted(trigrams))
+
+
+def _phone_matches(digits, limit):
+    # Digits typed are matched against the end of stored numbers; the range
+    # on phone_reversed is an index scan on every backend
+    prefix = digits[::-1]
+    patients = Patient.objects.filter(
+        phone_reversed__gte=prefix, phone_reversed__lt=prefix + ':'
+    ).order_by('phone_reversed', '-id')[:limit]
+    return [(patient, 1.0 if patient.phone_reversed == prefix else 0.95) for patient in patients]
+
+
+class _ILikePrefix(Lookup):
+    # ILIKE on the bare column, which a gin_trgm_ops index can serve, where
+    # istartswith compares UPPER(column) and cannot
+    lookup_name = 'ilike_prefix'
+
+    def get_prep_lookup(self):
+        # The value is a prefix, its own % and _ taken literally
+        return Value(connection.ops.prep_for_like_query(self.rhs) + '%')
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} ILIKE {rhs}", (*lhs_params, *rhs_params)
+
+
+def _postgresql_name_matches(query, limit):
+    from django.contrib.postgres.search import TrigramSimilarity, TrigramWordSimilarity
+    from django.db.models.functions import Greatest
+
+    # The %, <% and ILIKE operators behind these filters use the trigram GIN
+    # indexes on name and email
+    email_prefix = _ILikePrefix(F('email'), query)
+    return [
+        (patient, patient.score)
+        for patient in Patient.objects.filter(
+            Q(name__trigram_similar=query) | Q(name__trigram_word_similar=query) | email_prefix
+        ).annotate(
+            score=Greatest(
+                TrigramSimilarity('name', query),
+                TrigramWordSimilarity(query, 'name'),
+                Case(When(email_prefix, then=Value(EMAIL_PREFIX_SCORE)), default=Value(0.0), output_field=FloatField()),
+            )
+        ).order_by('-score', '-id')[:limit]
+    ]
+
+
+def _sqlite_name_matches(query, limit):
+    fts_query = _fts_trigram_query(query)
+    if not fts_query:
+        # Too short for trigrams; a prefix match over names is all we can do
+        patients = Patient.objects.filter(
+            Q(name__istartswith=query) | Q(name__icontains=f' {query}')
+        ).order_by('name', '-id')[:limit]
+        return [(patient, _name_score(query, patient.name)) for patient in patients]
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid FROM {PATIENT_SEARCH_TABLE} "
+            f"WHERE {PATIENT_SEARCH_TABLE} MATCH %s ORDER BY rank LIMIT %s",
+            ['{name email} : (' + fts_query + ')', limit * CANDIDATE_FACTOR]
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+    patients = Patient.objects.in_bulk(ids).values()
+    return [(patient, max(_name_score(query, patient.name), _email_score(query, patient))) for patient in patients]
+
+
+def _email_score(query, patient):
+    email = (patient.email or '').lower()
+    return EMAIL_PREFIX_SCORE if email and email.startswith(query.lower()) else 0
+
+
+def _fallback_name_matches(query, limit):
+    patients = Patient.objects.filter(
+        Q(name__icontains=query) | Q(email__istartswith=query)
+    ).order_by('-id')[:limit * CANDIDATE_FACTOR]
+    return [(patient, max(_name_score(query, patient.name), _email_score(query, patient))) for patient in patients]
+
+
+def search_patients(query, limit=10):
+    """Return up to `limit` (patient, score) pairs for a name, email or phone
+    query, best match first."""
+    query = query.strip()
+    if not query:
+        return []
+
+    matches = {}
+    digits = re.sub(r'\D', '', query)
+    if len(digits) >= 3 and len(digits) >= len(PHONE_PUNCTUATION.sub('', query)) - 1:
+        for patient, score in _phone_matches(digits, limit):
+            matches[patient.pk] = (patient, score)
+    else:
+        if connection.vendor == 'postgresql':
+            found = _postgresql_name_matches(query, limit)
+        elif connection.vendor == 'sqlite':
+            found = _sqlite_name_matches(query, limit)
+        else:
+            found = _fallback_name_matches(query, limit)
+        for patient, score in found:
+            if score >= NAME_SIMILARITY_THRESHOLD:
+                matches[patient.pk] = (patient, score)
+
+    ranked = sorted(matches.values(), key=lambda match: (-match[1], -match[0].pk))
+    return ranked[:limit]
+
+
+def index_patient(patient):
+    """Refresh the patient's row in the SQLite FTS5 index. PostgreSQL keeps its
+    trigram indexes current by itself."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {PATIENT_SEARCH_TABLE} WHERE rowid = %s", [patient.pk])
+        cursor.execute(
+            f"INSERT INTO {PATIENT_SEARCH_TABLE} (rowid, name, email) VALUES (%s, %s, %s)",
+            [patient.pk, patient.name, patient.email or '']
+        )
+
+
+def unindex_patient(patient_id):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {PATIENT_SEARCH_TABLE} WHERE rowid = %s", [patient_id])
+
+
+MEDICAL_RECORD_SEARCH_TABLE = 'kistrecords_medicalrecord_search'
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_STOP = '\x03'
+
+
+def highlight_html(text):
+    """Escape indexed text and turn the highlight markers into <mark> tags."""
+    return escape(text or '').replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>')
+
+
+def _fts_terms_query(text):
+    # Every word must match; the last one may be a prefix of a word still
+    # being typed
+    words = re.findall(r'\w+', text.lower())
+    if not words:
+        return ''
+    return ' '.join(f'"{word}"' for word in words) + '*'
+
+
+class MedicalRecordSearch:
+    """Ranked full-text matches for a query, sliceable so it can be handed to
+    a DRF paginator: len() runs the count and each slice one ranked query.
+
+    PostgreSQL matches against the generated search_vector column and its GIN
+    index, SQLite against an FTS5 table kept current by signals.py.
+    """
+
+    def __init__(self, query):
+        self.query = query.strip()
+        if connection.vendor == 'postgresql':
+            self.match = self.query
+        else:
+            self.match = _fts_terms_query(self.query)
+
+    def count(self):
+        if not self.match:
+            return 0
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    "SELECT count(*) FROM kistrecords_medicalrecord "
+                    "WHERE search_vector @@ websearch_to_tsquery('english', %s)",
+                    [self.match]
+                )
+            else:
+                cursor.execute(
+                    f"SELECT count(*) FROM {MEDICAL_RECORD_SEARCH_TABLE} "
+                    f"WHERE {MEDICAL_RECORD_SEARCH_TABLE} MATCH %s",
+                    [self.match]
+                )
+            return cursor.fetchone()[0]
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, page):
+        if not isinstance(page, slice):
+            raise TypeError('MedicalRecordSearch only supports slicing')
+        offset = page.start or 0
+        limit = (page.stop - offset) if page.stop is not None else 100
+        if not self.match or limit <= 0:
+            return []
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                options = f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxFragments=2'
+                cursor.execute(
+                    "SELECT r.id, ts_rank(r.search_vector, q) AS rank, "
+                    "ts_headline('english', r.diagnosis, q, %s), "
+                    "ts_headline('english', r.treatment || ' ' || coalesce(r.notes, ''), q, %s) "
+                    "FROM kistrecords_medicalrecord r, websearch_to_tsquery('english', %s) q "
+                    "WHERE r.search_vector @@ q "
+                    "ORDER BY rank DESC, r.date DESC LIMIT %s OFFSET %s",
+                    [options, options, self.match, limit, offset]
+                )
+            else:
+                # Diagnosis matches weigh most, then treatment, then notes
+                cursor.execute(
+                    f"SELECT rowid, -bm25({MEDICAL_RECORD_SEARCH_TABLE}, 10.0, 3.0, 1.0) AS rank, "
+                    f"highlight({MEDICAL_RECORD_SEARCH_TABLE}, 0, %s, %s), "
+                    f"snippet({MEDICAL_RECORD_SEARCH_TABLE}, -1, %s, %s, '…', 16) "
+                    f"FROM {MEDICAL_RECORD_SEARCH_TABLE} "
+                    f"WHERE {MEDICAL_RECORD_SEARCH_TABLE} MATCH %s "
+                    f"ORDER BY rank DESC LIMIT %s OFFSET %s",
+                    [HIGHLIGHT_START, HIGHLIGHT_STOP, HIGHLIGHT_START, HIGHLIGHT_STOP,
+                     self.match, limit, offset]
+                )
+            rows = cursor.fetchall()
+
+        records = MedicalRecord.objects.select_related('patient').in_bulk([row[0] for row in rows])
+        results = []
+        for record_id, rank, diagnosis, snippet in rows:
+            record = records.get(record_id)
+            if record is None:
+                continue
+            results.append({
+                'record': record,
+                'rank': float(rank),
+                'diagnosis_highlight': highlight_html(diagnosis),
+                'snippet': highlight_html(snippet),
+            })
+        return results
+
+
+def index_medical_record(record):
+    """Refresh the record's row in the SQLite FTS5 index. On PostgreSQL the
+    search_vector column is generated by the database."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {MEDICAL_RECORD_SEARCH_TABLE} WHERE rowid = %s", [record.pk])
+        cursor.execute(
+            f"INSERT INTO {MEDICAL_RECORD_SEARCH_TABLE} (rowid, diagnosis, treatment, notes) "
+            f"VALUES (%s, %s, %s, %s)",
+            [record.pk, record.diagnosis, record.treatment, record.notes or '']
+        )
+
+
+def unindex_medical_record(record_id):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {MEDICAL_RECORD_SEARCH_TABLE} WHERE rowid = %s", [record_id])
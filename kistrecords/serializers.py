@@ -1,8 +1,13 @@
 from rest_framework import serializers
 from .models import Patient, Service, Bill, BillItem, Service, MedicalRecord, MedicalReport
-from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
+from .media import report_file_url
+from . import revocation
 
 User = get_user_model()
 
@@ -15,6 +20,31 @@ class CustomTokenObtainPairSerializer(TokenObtainPairSerializer):
         })
         return data
 
+class RevokingTokenRefreshSerializer(TokenRefreshSerializer):
+    # Stands in for simplejwt's token_blacklist app: a refresh token is
+    # revoked when it is rotated, so it can only ever be used once. The stock
+    # rotation cannot be reused, as it records the new token in that app
+    def validate(self, attrs):
+        refresh = self.token_class(attrs['refresh'])
+        jti = refresh[api_settings.JTI_CLAIM]
+        if revocation.store.is_revoked(jti):
+            raise TokenError('Token is revoked')
+
+        user = User.objects.filter(**{api_settings.USER_ID_FIELD: refresh.get(api_settings.USER_ID_CLAIM)}).first()
+        if not api_settings.USER_AUTHENTICATION_RULE(user):
+            raise AuthenticationFailed(self.error_messages['no_active_account'], 'no_active_account')
+
+        data = {'access': str(refresh.access_token)}
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            # The insert doubles as the check when two requests race to use it
+            if api_settings.BLACKLIST_AFTER_ROTATION and not revocation.revoke(jti, revocation.token_expiry(refresh)):
+                raise TokenError('Token is revoked')
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data['refresh'] = str(refresh)
+        return data
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -62,11 +92,13 @@ class BillSerializer(serializers.ModelSerializer):
         
         return bill
 
+class BillItemRequestSerializer(serializers.Serializer):
+    serviceId = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1, default=1)
+
 class CreateBillRequestSerializer(serializers.Serializer):
     patientId = serializers.IntegerField()
-    items = serializers.ListField(
-        child=serializers.DictField()
-    )
+    items = BillItemRequestSerializer(many=True)
     discountType = serializers.ChoiceField(choices=['percentage', 'amount'])
     discountValue = serializers.DecimalField(max_digits=10, decimal_places=2)
     notes = serializers.CharField(required=False, allow_blank=True)
@@ -77,16 +109,26 @@ class MedicalRecordSerializer(serializers.ModelSerializer):
         fields = ['id', 'date', 'doctor', 'diagnosis', 'treatment', 'notes']
 
 class MedicalReportSerializer(serializers.ModelSerializer):
+    # Signed links to the access-checked file view, usable in <img> and <a>
     file_url = serializers.SerializerMethodField()
+    # Null until the background job has generated them; fall back to file_url
+    thumbnail_url = serializers.SerializerMethodField()
+    preview_url = serializers.SerializerMethodField()
     
     class Meta:
         model = MedicalReport
-        fields = ['id', 'title', 'date', 'type', 'file_url', 'fileUrl', 'uploadedBy']
-        read_only_fields = ['file_url']
+        fields = [
+            'id', 'title', 'date', 'type', 'file_url', 'fileUrl', 'thumbnail_url', 'preview_url', 'uploadedBy'
+        ]
+        read_only_fields = ['file_url', 'thumbnail_url', 'preview_url']
     
     def get_file_url(self, obj):
         if obj.file:
-            request = self.context.get('request')
-            if request is not None:
-                return request.build_absolute_uri(obj.file.url)
-        return obj.fileUrl
\ No newline at end of file
+            return report_file_url(obj, 'file', self.context.get('request'))
+        return obj.fileUrl
+
+    def get_thumbnail_url(self, obj):
+        return report_file_url(obj, 'thumbnail', self.context.get('request'))
+
+    def get_preview_url(self, obj):
+        return report_file_url(obj, 'preview', self.context.get('request'))
@@ -0,0 +1,118 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .authentication import invalidate_user
+from .models import Bill, BillItem, CustomUser, MedicalRecord, MedicalReport, Patient
+from . import blobs
+from . import cache as cache_utils
+from . import charts
+from . import jobs
+from . import rollups
+from . import search
+
+
+@receiver(pre_save, sender=Bill)
+@receiver(pre_delete, sender=Bill)
+def remember_rollup_state(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    rollups.remember_bill_state(instance)
+
+
+@receiver(post_save, sender=Bill)
+def update_rollup_on_bill_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    rollups.record_bill_saved(instance, created)
+
+
+@receiver(post_delete, sender=Bill)
+def update_rollup_on_bill_delete(sender, instance, **kwargs):
+    rollups.record_bill_deleted(instance)
+
+
+def invalidate_dashboard():
+    # Bump after commit so that a worker rebuilding the dashboard in the
+    # meantime cannot cache a payload without the new rows
+    transaction.on_commit(lambda: cache_utils.bump_version(cache_utils.DASHBOARD_NAMESPACE))
+
+
+@receiver(post_save, sender=Bill)
+@receiver(post_delete, sender=Bill)
+@receiver(post_save, sender=BillItem)
+@receiver(post_delete, sender=BillItem)
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+def invalidate_dashboard_on_change(sender, **kwargs):
+    invalidate_dashboard()
+
+
+@receiver(post_save, sender=Patient)
+def bump_chart_on_patient_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    charts.bump_chart_versions([instance.pk])
+
+
+@receiver(post_save, sender=Bill)
+@receiver(post_delete, sender=Bill)
+@receiver(post_save, sender=MedicalRecord)
+@receiver(post_delete, sender=MedicalRecord)
+@receiver(post_save, sender=MedicalReport)
+@receiver(post_delete, sender=MedicalReport)
+def bump_chart_on_change(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    charts.bump_chart_versions([instance.patient_id])
+
+
+@receiver(post_save, sender=BillItem)
+@receiver(post_delete, sender=BillItem)
+def bump_chart_on_bill_item_change(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    charts.bump_chart_versions(Bill.objects.filter(pk=instance.bill_id).values('patient_id'))
+
+
+@receiver(post_save, sender=Patient)
+def update_patient_search_index(sender, instance, **kwargs):
+    search.index_patient(instance)
+
+
+@receiver(post_delete, sender=Patient)
+def remove_from_patient_search_index(sender, instance, **kwargs):
+    search.unindex_patient(instance.pk)
+
+
+@receiver(post_save, sender=MedicalRecord)
+def update_medical_record_search_index(sender, instance, **kwargs):
+    search.index_medical_record(instance)
+
+
+@receiver(post_delete, sender=MedicalRecord)
+def remove_from_medical_record_search_index(sender, instance, **kwargs):
+    search.unindex_medical_record(instance.pk)
+
+
+@receiver(post_delete, sender=MedicalReport)
+def release_report_blob(sender, instance, **kwargs):
+    # Covers queryset and cascade deletes too, which skip MedicalReport.delete()
+    if instance.blob_id:
+        blobs.release(instance.blob_id)
+
+
+@receiver(post_save, sender=MedicalReport)
+def queue_report_previews(sender, instance, created, raw=False, **kwargs):
+    # The job row commits with the report, so the worker never sees a job for
+    # a report that was rolled back
+    if created and not raw and instance.type == 'image' and instance.file:
+        jobs.enqueue('generate_report_previews', report_id=instance.pk)
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_cached_user(sender, instance, **kwargs):
+    # After commit, so a request in between cannot cache the old row again
+    user_id = instance.pk
+    transaction.on_commit(lambda: invalidate_user(user_id))
@@ -0,0 +1,62 @@
+import time
+from pathlib import Path
+
+from django.conf import settings
+
+from . import blobs
+from . import invoices
+from . import previews
+from . import revocation
+from . import rollups
+from . import uploads
+from . import jobs
+from .jobs import task
+from .models import Bill, MedicalReport
+
+
+@task(name='rebuild_daily_rollups', max_attempts=3, concurrency=1)
+def rebuild_daily_rollups(chunk_days=31):
+    rollups.rebuild_daily_rollups(chunk_days=chunk_days)
+
+
+@task(name='render_invoice', concurrency=2, backoff=10)
+def render_invoice(bill_id):
+    # Warms the on-disk invoice cache so the next download is a file read
+    bill = Bill.objects.with_details().filter(pk=bill_id).first()
+    if bill is not None:
+        invoices.get_invoice(bill)
+
+
+@task(name='prune_invoice_cache', max_attempts=1, concurrency=1, every=24 * 60 * 60)
+def prune_invoice_cache(max_age_days=30):
+    cutoff = time.time() - max_age_days * 86400
+    for path in Path(settings.INVOICE_CACHE_DIR).glob('bill-*.pdf'):
+        if path.stat().st_atime < cutoff and path.stat().st_mtime < cutoff:
+            path.unlink(missing_ok=True)
+
+
+@task(name='prune_expired_uploads', max_attempts=1, concurrency=1, every=60 * 60)
+def prune_expired_uploads():
+    uploads.prune_expired_uploads()
+
+
+@task(name='prune_orphaned_blob_files', max_attempts=1, concurrency=1, every=24 * 60 * 60)
+def prune_orphaned_blob_files():
+    blobs.prune_orphaned_files()
+
+
+@task(name='generate_report_previews', max_attempts=3, concurrency=2, backoff=60)
+def generate_report_previews(report_id):
+    report = MedicalReport.objects.select_related('blob').filter(pk=report_id, type='image').first()
+    if report is not None and report.file:
+        previews.generate_previews(report)
+
+
+@task(name='prune_revoked_tokens', max_attempts=1, concurrency=1, every=60 * 60)
+def prune_revoked_tokens():
+    revocation.prune_revoked_tokens()
+
+
+@task(name='prune_finished_jobs', max_attempts=1, concurrency=1, every=24 * 60 * 60)
+def prune_finished_jobs():
+    jobs.prune_finished_jobs()
@@ -1,3 +1,1388 @@
+import base64
+import csv
+import hashlib
+import importlib
+import io
+import json
+import os
+import tempfile
+from datetime import UTC, date, datetime, timedelta
+from decimal import Decimal
+from pathlib import Path
+from unittest import mock
+
+from django.apps import apps
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Count, Sum
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+import reportlab
+from rest_framework.test import APIClient
+
+from . import blobs, checks, invoices, jobs, metrics, pdf, revocation
+from . import cache as cache_utils
+from .authentication import user_cache
+from .numbering import allocate_bill_numbers, allocator
+from .profiling import RepeatedQueries, profile_queries, query_shape
+from .models import (
+    Bill, BillItem, BillNumberSequence, CustomUser, DailyRevenue, Job, MedicalRecord, MedicalReport, Patient,
+    ReportBlob, RevokedToken, Service
+)
+
+
+class KistrecordsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(
+            username='receptionist', password='receptionist123', role='receptionist'
+        )
+        cls.patient = Patient.objects.create(
+            name='Ram Thapa', age=42, gender='Male', phone='9800000001', address='Kathmandu'
+        )
+        cls.services = [
+            Service.objects.create(
+                name=f'Lab test {i}', price=Decimal('150.00') + i, category='Laboratory'
+            )
+            for i in range(15)
+        ]
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assertQueryBudget(self, budget, url, repeat_threshold=3, client=None):
+        """Fail if `url` runs more than `budget` queries, or any one query
+        shape `repeat_threshold` times or more, the mark of an N+1 pattern."""
+        with profile_queries() as profile:
+            response = (client or self.client).get(url)
+        self.assertEqual(response.status_code, 200, getattr(response, 'data', None))
+        self.assertLessEqual(
+            len(profile.queries), budget,
+            f"{url} ran {len(profile.queries)} queries, budget is {budget}:\n"
+            + "\n".join(f"{site}: {sql}" for sql, _, site in profile.queries)
+        )
+        repeated = profile.describe_repeated(repeat_threshold)
+        self.assertFalse(repeated, f"{url} repeats queries:\n{repeated}")
+        return response
+
+
+class CreateBillTests(KistrecordsTestCase):
+    def bill_request(self, services, discount_type='amount', discount_value='0'):
+        return {
+            'patientId': self.patient.id,
+            'items': [{'serviceId': service.id, 'quantity': 2} for service in services],
+            'discountType': discount_type,
+            'discountValue': discount_value,
+        }
+
+    def create_bill(self, services, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/bills/', self.bill_request(services, **kwargs), format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return response, len(queries)
+
+    def test_creates_bill_with_items_and_totals(self):
+        response, _ = self.create_bill(self.services[:3], discount_type='percentage', discount_value='10')
+
+        bill = Bill.objects.get(pk=response.data['id'])
+        subtotal = sum(service.price * 2 for service in self.services[:3])
+        self.assertEqual(bill.items.count(), 3)
+        self.assertEqual(bill.discount_amount, (subtotal / 10).quantize(Decimal('0.01')))
+        self.assertEqual(bill.grand_total, subtotal - bill.discount_amount)
+        self.assertEqual(len(response.data['items']), 3)
+
+    def test_query_count_does_not_depend_on_item_count(self):
+        # Warm up so that both measured requests draw from the same block of
+        # bill numbers
+        self.create_bill(self.services[:1])
+
+        _, single_item_queries = self.create_bill(self.services[:1])
+        _, fifteen_item_queries = self.create_bill(self.services)
+        self.assertEqual(single_item_queries, fifteen_item_queries)
+
+    def test_unknown_service_creates_nothing(self):
+        payload = self.bill_request(self.services[:2])
+        payload['items'].append({'serviceId': 999999, 'quantity': 1})
+
+        response = self.client.post('/api/bills/', payload, format='json')
+
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Bill.objects.exists())
+        self.assertFalse(BillItem.objects.exists())
+
+
+class BulkCreateBillTests(KistrecordsTestCase):
+    def test_reports_results_per_entry(self):
+        entries = [
+            {'patientId': self.patient.id, 'items': [{'serviceId': self.services[0].id}],
+             'discountType': 'amount', 'discountValue': '0'},
+            {'patientId': self.patient.id, 'items': [{'serviceId': 999999}],
+             'discountType': 'amount', 'discountValue': '0'},
+            {'patientId': 999999, 'items': [{'serviceId': self.services[0].id}],
+             'discountType': 'amount', 'discountValue': '0'},
+            {'patientId': self.patient.id, 'items': [{'serviceId': self.services[1].id, 'quantity': 3}],
+             'discountType': 'percentage', 'discountValue': '50'},
+            {'items': []},
+        ]
+
+        response = self.client.post('/api/bills/bulk/', entries, format='json')
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(
+            [result['status'] for result in response.data['results']],
+            ['created', 'error', 'error', 'created', 'error']
+        )
+        bills = Bill.objects.order_by('id')
+        self.assertEqual(len({bill.bill_number for bill in bills}), 2)
+        self.assertEqual(BillItem.objects.filter(bill__in=bills).count(), 2)
+        rollup = DailyRevenue.objects.get()
+        self.assertEqual(rollup.bill_count, 2)
+        self.assertEqual(rollup.patient_count, 1)
+        self.assertEqual(rollup.revenue, sum(bill.grand_total for bill in bills))
+
+    def test_malformed_items_fail_only_their_entry(self):
+        valid = {'patientId': self.patient.id, 'items': [{'serviceId': self.services[0].id}],
+                 'discountType': 'amount', 'discountValue': '0'}
+        entries = [
+            dict(valid, items=[{'serviceId': self.services[0].id, 'quantity': 'abc'}]),
+            dict(valid, items=[{'serviceId': self.services[0].id, 'quantity': None}]),
+            dict(valid, items=[{'quantity': 2}]),
+            dict(valid, items=[{'serviceId': self.services[0].id, 'quantity': 0}]),
+            valid,
+        ]
+
+        response = self.client.post('/api/bills/bulk/', entries, format='json')
+
+        self.assertEqual(response.status_code, 207)
+        results = response.data['results']
+        self.assertEqual([result['status'] for result in results], ['error'] * 4 + ['created'])
+        self.assertIn('quantity', results[0]['details']['items'][0])
+        self.assertIn('serviceId', results[2]['details']['items'][0])
+        self.assertEqual(Bill.objects.count(), 1)
+
+
+class BillNumberingTests(KistrecordsTestCase):
+    """The BillNumberSequence counter used on backends other than
+    PostgreSQL."""
+
+    def setUp(self):
+        super().setUp()
+        allocator.reset()
+        self.addCleanup(allocator.reset)
+        overrides = self.settings(BILL_NUMBER_PREFIX='BILL', BILL_NUMBER_PER_YEAR=False, BILL_NUMBER_BLOCK_SIZE=3)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def allocate(self, count):
+        # Each allocation in a transaction of its own, as in a request
+        with self.captureOnCommitCallbacks(execute=True):
+            return allocate_bill_numbers(count)
+
+    def test_numbers_run_on_across_blocks(self):
+        numbers = self.allocate(2) + self.allocate(2) + self.allocate(5) + self.allocate(1)
+        self.assertEqual(numbers, [f'BILL-{value:03d}' for value in range(1, 11)])
+        # Four blocks of 3, of which 11 and 12 are still held
+        self.assertEqual(BillNumberSequence.objects.get(prefix='BILL', year=0).next_value, 13)
+
+    def test_counter_starts_after_existing_numbers(self):
+        for number in ('BILL-041', 'BILL-7', 'OTHER-900'):
+            Bill.objects.create(patient=self.patient, bill_number=number, grand_total=Decimal('0'), created_by=self.user)
+        self.assertEqual(self.allocate(1), ['BILL-042'])
+
+    def test_rolled_back_block_is_not_reused(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                self.assertEqual(allocate_bill_numbers(1), ['BILL-001'])
+                raise RuntimeError
+            # The reservation went with the savepoint, so the numbers are free
+            # again, and the rest of the rolled back block must not be drawn on
+            self.assertEqual(allocate_bill_numbers(1), ['BILL-001'])
+        self.assertEqual(self.allocate(2), ['BILL-002', 'BILL-003'])
+        self.assertEqual(BillNumberSequence.objects.get().next_value, 4)
+
+    def test_block_is_shared_only_once_committed(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.assertEqual(allocate_bill_numbers(1), ['BILL-001'])
+            # Until then, every allocation reserves its own block
+            self.assertEqual(allocate_bill_numbers(1), ['BILL-004'])
+        for callback in callbacks:
+            callback()
+        self.assertEqual(self.allocate(2), ['BILL-002', 'BILL-003'])
+
+
+class BillExportTests(KistrecordsTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for day, total in ((date(2026, 3, 1), '300.00'), (date(2026, 3, 15), '151.00'), (date(2026, 4, 1), '99.00')):
+            bill = Bill.objects.create(patient=cls.patient, grand_total=Decimal(total), created_by=cls.user)
+            BillItem.objects.create(bill=bill, service=cls.services[0], quantity=2, price=Decimal('150.00'))
+            Bill.objects.filter(pk=bill.pk).update(day=day)
+
+    def export(self, **params):
+        response = self.client.get('/api/bills/export/', {'start': '2026-03-01', 'end': '2026-03-31', **params})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode()
+
+    def test_streams_bills_in_range_as_csv(self):
+        rows = list(csv.DictReader(io.StringIO(self.export())))
+        self.assertEqual([row['grand_total'] for row in rows], ['300.00', '151.00'])
+        self.assertEqual(rows[0]['patient_name'], 'Ram Thapa')
+        self.assertEqual(rows[1]['day'], '2026-03-15')
+
+    def test_streams_items_as_ndjson(self):
+        rows = [json.loads(line) for line in self.export(type='items', output='ndjson').splitlines()]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0]['service_name'], 'Lab test 0')
+        self.assertEqual(rows[0]['total'], '300.00')
+
+    def test_rejects_bad_ranges(self):
+        response = self.client.get('/api/bills/export/', {'start': '2026-03-31', 'end': '2026-03-01'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get('/api/bills/export/', {'start': '2026-03-01'})
+        self.assertEqual(response.status_code, 400)
+
+
+class InvoiceDownloadTests(KistrecordsTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.bill = Bill.objects.create(patient=cls.patient, grand_total=Decimal('300.00'), created_by=cls.user)
+        BillItem.objects.create(bill=cls.bill, service=cls.services[0], quantity=2, price=Decimal('150.00'))
+
+    def setUp(self):
+        super().setUp()
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        overrides = self.settings(INVOICE_CACHE_DIR=cache_dir.name, INVOICE_RENDER_WORKERS=0)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.url = f'/api/bills/{self.bill.pk}/download/'
+
+    def test_renders_pdf_once_per_bill_version(self):
+        with mock.patch('kistrecords.invoices.pdf.render_invoice', wraps=pdf.render_invoice) as render:
+            first = self.client.get(self.url)
+            second = self.client.get(self.url)
+            self.assertEqual(render.call_count, 1)
+
+            self.bill.status = 'Paid'
+            self.bill.save()
+            third = self.client.get(self.url)
+            self.assertEqual(render.call_count, 2)
+
+        self.assertEqual(first['Content-Type'], 'application/pdf')
+        body = b''.join(first.streaming_content)
+        self.assertTrue(body.startswith(b'%PDF-') and body.rstrip().endswith(b'%%EOF'))
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertNotEqual(first['ETag'], third['ETag'])
+
+    def test_not_modified_for_current_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_busy_renderer_returns_503(self):
+        with mock.patch('kistrecords.invoices.renderer.render', side_effect=invoices.RendererBusy):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '2')
+
+    def test_shapes_text_beyond_helvetica_in_configured_font(self):
+        # reportlab's HarfBuzz test font: Noto Sans Khmer, cut down to the
+        # letters of this word, whose subscript consonant needs shaping
+        self.patient.name = 'Ram ឆ្នាំ'
+        self.patient.save()
+        font = str(Path(reportlab.__file__).parent / 'fonts' / 'hb-test.ttf')
+        with self.settings(INVOICE_FONT=font, INVOICE_BOLD_FONT=''):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        body = b''.join(response.streaming_content)
+        self.assertIn(b'NotoSansKhmer', body)
+        self.assertIn(b'/Helvetica', body)
+
+    def test_missing_font_still_prints(self):
+        self.patient.name = 'राम थापा'
+        self.patient.save()
+        with self.settings(INVOICE_FONT='/nonexistent/font.ttf', INVOICE_BOLD_FONT=''):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_check_warns_about_missing_fonts(self):
+        with self.settings(INVOICE_FONT='/nonexistent/font.ttf', INVOICE_BOLD_FONT='/nonexistent/bold.ttf'):
+            warnings = checks.check_invoice_fonts(None)
+        self.assertEqual([warning.id for warning in warnings], ['kistrecords.W001'] * 2)
+
+
+class DailyRevenueTests(KistrecordsTestCase):
+    """The DailyRevenue rows kept by the Bill signals must always equal a
+    fresh aggregate over the bills."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other_patient = Patient.objects.create(
+            name='Sita Rai', age=35, gender='Female', phone='9800000002', address='Lalitpur'
+        )
+
+    def create_bill(self, patient, total='100.00', status='Pending'):
+        return Bill.objects.create(patient=patient, grand_total=Decimal(total), status=status, created_by=self.user)
+
+    def assertRollupsMatchBills(self):
+        expected = {
+            row['day']: (row['bill_count'], row['patient_count'], row['revenue'])
+            for row in Bill.objects.values('day').annotate(
+                bill_count=Count('id'), patient_count=Count('patient', distinct=True), revenue=Sum('grand_total')
+            ).order_by()
+        }
+        actual = {
+            rollup.day: (rollup.bill_count, rollup.patient_count, rollup.revenue)
+            for rollup in DailyRevenue.objects.all()
+            if rollup.bill_count or rollup.patient_count or rollup.revenue
+        }
+        self.assertEqual(actual, expected)
+
+    def test_create(self):
+        self.create_bill(self.patient)
+        self.create_bill(self.patient, '50.00', 'Paid')
+        self.create_bill(self.other_patient)
+        self.assertRollupsMatchBills()
+        self.assertEqual(DailyRevenue.objects.get().patient_count, 2)
+
+    def test_update_to_another_day_or_patient(self):
+        first = self.create_bill(self.patient)
+        second = self.create_bill(self.patient)
+        first.date -= timedelta(days=1)
+        first.save()
+        self.assertRollupsMatchBills()
+
+        second.patient = self.other_patient
+        second.status = 'Paid'
+        second.save()
+        self.assertRollupsMatchBills()
+
+    def test_single_delete(self):
+        first = self.create_bill(self.patient)
+        self.create_bill(self.patient)
+        self.create_bill(self.other_patient)
+        first.delete()
+        self.assertRollupsMatchBills()
+        self.assertEqual(DailyRevenue.objects.get().patient_count, 2)
+
+    def test_cascade_and_queryset_delete(self):
+        self.create_bill(self.patient)
+        self.create_bill(self.patient)
+        self.create_bill(self.other_patient)
+        # Both of the patient's bills go in one DELETE before any post_delete
+        Bill.objects.filter(patient=self.patient).delete()
+        self.assertRollupsMatchBills()
+        self.assertEqual(DailyRevenue.objects.get().patient_count, 1)
+
+        self.create_bill(self.other_patient)
+        self.other_patient.delete()
+        self.assertRollupsMatchBills()
+        self.assertEqual(DailyRevenue.objects.get().patient_count, 0)
+
+    def test_save_and_delete_of_deferred_bill(self):
+        bill = self.create_bill(self.patient, '10.00')
+        # Loaded without the rollup fields, so from_db() cannot record them
+        Bill.objects.only('id', 'notes').get(pk=bill.pk).save()
+        self.assertRollupsMatchBills()
+        self.assertEqual(DailyRevenue.objects.get().bill_count, 1)
+
+        deferred = Bill.objects.defer('status', 'grand_total').get(pk=bill.pk)
+        deferred.status = 'Paid'
+        deferred.save()
+        self.assertRollupsMatchBills()
+        self.assertEqual(DailyRevenue.objects.get().paid_revenue, Decimal('10.00'))
+
+        Bill.objects.defer('day', 'grand_total').get(pk=bill.pk).delete()
+        self.assertRollupsMatchBills()
+
+
+class LocalDayFieldTests(KistrecordsTestCase):
+    """`day` holds the date of `date` in the current time zone, whichever way
+    the row is written."""
+
+    # 23:59 and 00:01 in Kathmandu, at UTC+05:45
+    BEFORE_MIDNIGHT = datetime(2026, 10, 16, 18, 14, tzinfo=UTC)
+    AFTER_MIDNIGHT = datetime(2026, 10, 16, 18, 16, tzinfo=UTC)
+
+    def setUp(self):
+        super().setUp()
+        override = timezone.override('Asia/Kathmandu')
+        override.__enter__()
+        self.addCleanup(override.__exit__, None, None, None)
+
+    def new_record(self):
+        return MedicalRecord(patient=self.patient, doctor='Dr. Sharma', diagnosis='Fever', treatment='Rest')
+
+    def create_record(self, at):
+        # auto_now_add stamps `date` with the time of the save
+        with mock.patch('django.utils.timezone.now', return_value=at):
+            record = self.new_record()
+            record.save()
+        return record
+
+    def stored_days(self):
+        return list(MedicalRecord.objects.order_by('date').values_list('day', flat=True))
+
+    def test_local_midnight_boundary(self):
+        self.create_record(self.BEFORE_MIDNIGHT)
+        self.create_record(self.AFTER_MIDNIGHT)
+        self.assertEqual(self.stored_days(), [date(2026, 10, 16), date(2026, 10, 17)])
+
+    def test_bulk_create(self):
+        with mock.patch('django.utils.timezone.now', return_value=self.AFTER_MIDNIGHT):
+            MedicalRecord.objects.bulk_create([self.new_record() for _ in range(2)])
+        self.assertEqual(self.stored_days(), [date(2026, 10, 17)] * 2)
+
+    def test_date_change_rederives_day(self):
+        record = self.create_record(self.AFTER_MIDNIGHT)
+        record.date = self.BEFORE_MIDNIGHT - timedelta(days=1)
+        record.save()
+        self.assertEqual(self.stored_days(), [date(2026, 10, 15)])
+
+    def test_backfill_matches_the_field(self):
+        self.create_record(self.BEFORE_MIDNIGHT)
+        self.create_record(self.AFTER_MIDNIGHT)
+        expected = self.stored_days()
+        MedicalRecord.objects.update(day=date(2000, 1, 1))
+
+        backfill = importlib.import_module('kistrecords.migrations.0009_backfill_local_day_columns')
+        backfill.populate_day_columns(apps, None)
+        self.assertEqual(self.stored_days(), expected)
+
+
+class DashboardCacheTests(KistrecordsTestCase):
+    """The dashboard is built once per version and day; bills, bill items and
+    patients bump the version when their transaction commits."""
+
+    def dashboard(self):
+        response = self.client.get('/api/dashboard/')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_changes_show_once_committed(self):
+        self.assertEqual(self.dashboard()['totalBills'], 0)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bill = Bill.objects.create(patient=self.patient, grand_total=Decimal('150.00'), created_by=self.user)
+        self.assertEqual(self.dashboard()['totalBills'], 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            BillItem.objects.create(bill=bill, service=self.services[0], price=self.services[0].price)
+        self.assertEqual(len(self.dashboard()['recentBills'][0]['items']), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.create(name='Sita Rai', age=35, gender='Female', phone='9800000002', address='Lalitpur')
+        self.assertEqual(self.dashboard()['totalPatients'], 2)
+
+    def test_payload_is_reused_until_the_version_changes(self):
+        build = mock.Mock(side_effect=['first', 'second'])
+        self.assertEqual(cache_utils.get_or_build('test', build, 60), 'first')
+        self.assertEqual(cache_utils.get_or_build('test', build, 60), 'first')
+        cache_utils.bump_version('test')
+        self.assertEqual(cache_utils.get_or_build('test', build, 60), 'second')
+        self.assertEqual(build.call_count, 2)
+
+    def lock_rebuild(self, namespace):
+        # As a worker would while it rebuilds the current version
+        cache.add(f'{namespace}:{cache_utils.get_version(namespace)}::lock', True)
+
+    def test_workers_without_the_lock_serve_the_stale_payload(self):
+        cache_utils.get_or_build('test', lambda: 'stale', 60)
+        cache_utils.bump_version('test')
+        self.lock_rebuild('test')
+        build = mock.Mock(return_value='fresh')
+        self.assertEqual(cache_utils.get_or_build('test', build, 60), 'stale')
+        build.assert_not_called()
+
+    def test_failed_rebuild_releases_the_lock(self):
+        with self.assertRaises(DatabaseError):
+            cache_utils.get_or_build('test', mock.Mock(side_effect=DatabaseError), 60)
+        # The next request rebuilds instead of waiting for a lock nobody holds
+        with mock.patch.object(cache_utils.time, 'sleep') as sleep:
+            self.assertEqual(cache_utils.get_or_build('test', lambda: 'built', 60), 'built')
+        sleep.assert_not_called()
+
+    def test_builds_itself_when_the_lock_holder_never_finishes(self):
+        self.lock_rebuild('test')
+        with mock.patch.object(cache_utils, 'REBUILD_WAIT', 0.1):
+            self.assertEqual(cache_utils.get_or_build('test', lambda: 'built', 60), 'built')
+
+
+class BillQueryBudgetTests(KistrecordsTestCase):
+    """Every endpoint returning bills must run a fixed number of queries, no
+    matter how many bills, items or patients are involved."""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other_patient = Patient.objects.create(
+            name='Sita Rai', age=35, gender='Female', phone='9800000002', address='Lalitpur'
+        )
+        cls.bills = []
+        for i in range(6):
+            bill = Bill.objects.create(
+                patient=cls.patient if i % 2 else cls.other_patient,
+                grand_total=Decimal('450.00'),
+                created_by=cls.user
+            )
+            for service in cls.services[:3]:
+                BillItem.objects.create(bill=bill, service=service, price=service.price)
+            cls.bills.append(bill)
+
+    def test_bill_list(self):
+        response = self.assertQueryBudget(3, '/api/bills/list/')
+        self.assertEqual(len(response.data['results']), 6)
+
+    def test_bill_list_for_patient(self):
+        self.assertQueryBudget(3, f'/api/bills/list/?patientId={self.patient.id}')
+
+    def test_bill_detail(self):
+        self.assertQueryBudget(2, f'/api/bills/{self.bills[0].id}/')
+
+    def test_daily_report(self):
+        response = self.assertQueryBudget(3, f'/api/bills/daily-report/?date={self.bills[0].date.date()}')
+        self.assertEqual(len(response.data['bills']), 6)
+
+    def test_dashboard(self):
+        response = self.assertQueryBudget(6, '/api/dashboard/')
+        self.assertEqual(len(response.data['recentBills']), 5)
+
+    def test_patient_details(self):
+        response = self.assertQueryBudget(5, f'/api/patients/{self.patient.id}/details/')
+        self.assertEqual(len(response.data['billingHistory']), 3)
+
+    def test_patient_billing_history(self):
+        self.assertQueryBudget(3, f'/api/patients/{self.patient.id}/billing_history/')
+
+
+class KeysetPaginationTests(KistrecordsTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.bills = [
+            Bill.objects.create(patient=cls.patient, grand_total=Decimal('100.00'), created_by=cls.user)
+            for _ in range(7)
+        ]
+        # Several bills sharing a timestamp must still page without repeats
+        Bill.objects.filter(pk__in=[bill.pk for bill in cls.bills[2:5]]).update(date=cls.bills[2].date)
+
+    def collect_pages(self, url):
+        ids = []
+        pages = 0
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids.extend(bill['id'] for bill in response.data['results'])
+            url = response.data['next']
+            pages += 1
+        return ids, pages
+
+    def test_pages_forward_through_bills_in_date_order(self):
+        ids, pages = self.collect_pages('/api/bills/list/?pagination=cursor&page_size=3')
+
+        expected = list(Bill.objects.order_by('-date', '-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+        self.assertEqual(pages, 3)
+
+    def test_previous_link_returns_the_earlier_page(self):
+        first = self.client.get('/api/bills/list/?pagination=cursor&page_size=3').data
+        second = self.client.get(first['next']).data
+        previous = self.client.get(second['previous']).data
+
+        self.assertEqual(previous['results'], first['results'])
+        self.assertIsNone(first['previous'])
+
+    def test_patients_support_cursor_with_total(self):
+        response = self.client.get('/api/patients/?pagination=cursor&total=approximate')
+
+        self.assertEqual(response.data['count'], 1)
+        self.assertNotIn('page', response.data)
+
+    def test_page_numbers_remain_the_default(self):
+        response = self.client.get('/api/bills/list/')
+
+        self.assertEqual(response.data['count'], 7)
+
+    def test_rejects_malformed_cursor(self):
+        response = self.client.get('/api/bills/list/?cursor=not-a-cursor')
+
+        self.assertEqual(response.status_code, 404)
+
+
+class PatientChartTests(KistrecordsTestCase):
+    def details_url(self):
+        return f'/api/patients/{self.patient.id}/details/'
+
+    def test_unchanged_chart_returns_304(self):
+        first = self.client.get(self.details_url())
+        etag = first['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(self.details_url(), HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(second.status_code, 304)
+        self.assertEqual(len(queries), 1)
+
+    def test_mutations_change_the_etag(self):
+        etag = self.client.get(self.details_url())['ETag']
+
+        response = self.client.post(
+            f'/api/patients/{self.patient.id}/add_medical_record/',
+            {'diagnosis': 'Dengue', 'treatment': 'Fluids', 'doctor': 'Dr. Shrestha'},
+            format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.data['medicalRecords']), 1)
+
+        stale = self.client.get(self.details_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(stale.status_code, 200)
+        self.assertEqual(stale['ETag'], response['ETag'])
+
+    def test_new_bill_changes_the_chart(self):
+        first = self.client.get(self.details_url())
+        Bill.objects.create(patient=self.patient, grand_total=Decimal('10.00'), created_by=self.user)
+
+        second = self.client.get(self.details_url())
+
+        self.assertNotEqual(first['ETag'], second['ETag'])
+        self.assertEqual(len(second.data['billingHistory']), 1)
+
+    def test_saving_the_patient_keeps_concurrent_version_bumps(self):
+        stale = Patient.objects.get(pk=self.patient.pk)
+        MedicalRecord.objects.create(patient=self.patient, doctor='Dr. Shrestha', diagnosis='Flu', treatment='Rest')
+        version = Patient.objects.get(pk=self.patient.pk).chart_version
+
+        stale.age = 43
+        stale.save()
+
+        self.assertGreater(Patient.objects.get(pk=self.patient.pk).chart_version, version)
+
+    def test_delta_mode_returns_only_the_changed_record(self):
+        url = f'/api/patients/{self.patient.id}/add_medical_record/'
+        payload = {'diagnosis': 'Dengue', 'treatment': 'Fluids', 'doctor': 'Dr. Shrestha'}
+
+        created = self.client.post(url, payload, format='json', HTTP_PREFER='return=minimal')
+
+        self.assertEqual(created.data['action'], 'created')
+        self.assertEqual(created.data['medicalRecord']['diagnosis'], 'Dengue')
+        self.assertNotIn('billingHistory', created.data)
+        record_id = created.data['medicalRecord']['id']
+
+        deleted = self.client.delete(
+            f'/api/patients/{self.patient.id}/delete-medical-record/{record_id}/?response=delta'
+        )
+
+        self.assertEqual(deleted.data['action'], 'deleted')
+        self.assertEqual(deleted.data['medicalRecord']['id'], record_id)
+        self.assertGreater(deleted.data['chartVersion'], created.data['chartVersion'])
+        self.assertEqual(deleted['ETag'], self.client.get(self.details_url())['ETag'])
+
+
+class PatientSearchTests(KistrecordsTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Patient.objects.create(name='Sita Rai', age=35, gender='Female', phone='+977 980-123-4567',
+                               email='sita.rai@example.com', address='Lalitpur')
+        Patient.objects.create(name='Hari Bahadur', age=60, gender='Male', phone='9811111111', address='Bhaktapur')
+
+    def search(self, query):
+        response = self.client.get('/api/patients/search/', {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [result['name'] for result in response.data['results']]
+
+    def test_matches_phone_suffix(self):
+        self.assertEqual(self.search('4567'), ['Sita Rai'])
+
+    def test_matches_phone_typed_with_separators(self):
+        self.assertEqual(self.search('980-123-4567'), ['Sita Rai'])
+        self.assertEqual(self.search('+977 (980) 123.4567'), ['Sita Rai'])
+
+    def test_tolerates_typos_in_names(self):
+        self.assertEqual(self.search('Seeta Rai')[0], 'Sita Rai')
+        self.assertEqual(self.search('thapaa')[0], 'Ram Thapa')
+
+    def test_matches_email_prefix(self):
+        self.assertEqual(self.search('sita.rai@')[0], 'Sita Rai')
+
+    def test_index_follows_updates_and_deletes(self):
+        self.patient.name = 'Ramesh Karki'
+        self.patient.save()
+        self.assertEqual(self.search('karki'), ['Ramesh Karki'])
+
+        self.patient.delete()
+        self.assertEqual(self.search('karki'), [])
+
+
+class MedicalRecordSearchTests(KistrecordsTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.fever = MedicalRecord.objects.create(
+            patient=cls.patient, doctor='Dr. Sharma', diagnosis='Dengue fever',
+            treatment='Paracetamol and fluids', notes='Platelets <100k, review in 2 days'
+        )
+        MedicalRecord.objects.create(
+            patient=cls.patient, doctor='Dr. Sharma', diagnosis='Fractured wrist',
+            treatment='Cast for six weeks', notes='Patient had a mild fever on arrival'
+        )
+        MedicalRecord.objects.create(
+            patient=cls.patient, doctor='Dr. Koirala', diagnosis='Hypertension',
+            treatment='Amlodipine 5mg daily'
+        )
+
+    def search(self, query, **params):
+        response = self.client.get('/api/medical-records/search/', {'q': query, **params})
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data
+
+    def test_ranks_diagnosis_matches_first(self):
+        data = self.search('fever')
+        self.assertEqual(data['count'], 2)
+        self.assertEqual([r['diagnosis'] for r in data['results']], ['Dengue fever', 'Fractured wrist'])
+        self.assertEqual(data['results'][0]['patient']['name'], 'Ram Thapa')
+
+    def test_highlights_matches_and_escapes_text(self):
+        result = self.search('platelets')['results'][0]
+        self.assertEqual(result['highlight']['diagnosis'], 'Dengue fever')
+        self.assertIn('<mark>Platelets</mark> &lt;100k', result['highlight']['snippet'])
+
+    def test_matches_word_prefixes_and_stems(self):
+        self.assertEqual(self.search('amlod')['results'][0]['diagnosis'], 'Hypertension')
+        self.assertEqual(self.search('fevers')['count'], 2)
+
+    def test_paginates(self):
+        data = self.search('fever', page_size=1)
+        self.assertEqual(len(data['results']), 1)
+        self.assertIsNotNone(data['next'])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.fever.diagnosis = 'Typhoid'
+        self.fever.save()
+        self.assertEqual(self.search('typhoid')['count'], 1)
+
+        self.fever.delete()
+        self.assertEqual(self.search('typhoid')['count'], 0)
+
+    def test_requires_query(self):
+        response = self.client.get('/api/medical-records/search/')
+        self.assertEqual(response.status_code, 400)
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.addCleanup(jobs.TASKS.pop, 'test.record', None)
+        self.addCleanup(jobs.TASKS.pop, 'test.limited', None)
+
+        @jobs.task(name='test.record', max_attempts=2, backoff=60)
+        def record(value, fail=False):
+            self.calls.append(value)
+            if fail:
+                raise RuntimeError('boom')
+
+        @jobs.task(name='test.limited', concurrency=1)
+        def limited():
+            pass
+
+        self.record = record
+
+    def run_due(self):
+        return [jobs.run_job(job) for job in jobs.claim_jobs('test-worker', 10)]
+
+    def test_runs_queued_jobs_once(self):
+        job = self.record.enqueue(value=1)
+        self.assertEqual(self.run_due(), [Job.SUCCEEDED])
+        self.assertEqual(self.run_due(), [])
+        self.assertEqual(self.calls, [1])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.SUCCEEDED, 1))
+
+    def test_retries_with_backoff_then_fails(self):
+        job = self.record.enqueue(value=1, fail=True)
+        self.assertEqual(self.run_due(), [Job.QUEUED])
+        job.refresh_from_db()
+        self.assertGreater(job.run_at, timezone.now() + timedelta(seconds=40))
+        self.assertIn('RuntimeError: boom', job.last_error)
+        # Not due again until the backoff has passed
+        self.assertEqual(self.run_due(), [])
+
+        Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+        self.assertEqual(self.run_due(), [Job.FAILED])
+        job.refresh_from_db()
+        self.assertEqual(job.attempts, 2)
+
+    def test_concurrency_limit_across_claims(self):
+        for _ in range(3):
+            jobs.enqueue('test.limited')
+        self.assertEqual(len(jobs.claim_jobs('worker-a', 10)), 1)
+        self.assertEqual(jobs.claim_jobs('worker-b', 10), [])
+
+    def test_periodic_tasks_are_queued_once_per_interval(self):
+        self.addCleanup(jobs.TASKS.pop, 'test.periodic', None)
+        jobs.task(name='test.periodic', every=3600)(lambda: None)
+
+        queued = {job.task for job in jobs.schedule_periodic_jobs()}
+        self.assertTrue({'test.periodic', 'prune_expired_uploads', 'prune_revoked_tokens'} <= queued)
+        self.assertEqual(jobs.schedule_periodic_jobs(), [])
+
+        # Not again within the interval, even once the job has run
+        self.run_due()
+        self.assertEqual(jobs.schedule_periodic_jobs(), [])
+        Job.objects.update(created_at=timezone.now() - timedelta(days=2))
+        self.assertEqual({job.task for job in jobs.schedule_periodic_jobs()}, queued)
+
+    def test_requeues_jobs_of_lost_workers(self):
+        job = self.record.enqueue(value=1)
+        jobs.claim_jobs('test-worker', 1)
+        Job.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(jobs.requeue_stale_jobs(), 1)
+        self.assertEqual(self.run_due(), [Job.SUCCEEDED])
+
+    def test_running_jobs_are_kept_locked_by_their_worker(self):
+        running, lost = self.record.enqueue(value=1), self.record.enqueue(value=2)
+        worker = jobs.Worker(threads=1, name='test-worker')
+        jobs.claim_jobs(worker.name, 1)
+        jobs.claim_jobs('lost-worker', 1)
+        # The first job has been running for longer than the lock timeout
+        Job.objects.update(locked_at=timezone.now() - timedelta(hours=1))
+        worker._running.add(running.pk)
+
+        worker.run(once=True)
+        running.refresh_from_db()
+        lost.refresh_from_db()
+        self.assertEqual((running.status, running.locked_by), (Job.RUNNING, 'test-worker'))
+        self.assertGreater(running.locked_at, timezone.now() - timedelta(minutes=1))
+        self.assertEqual(lost.status, Job.QUEUED)
+
+    def test_fails_jobs_that_keep_losing_their_worker(self):
+        job = self.record.enqueue(value=1)
+        for _ in range(2):
+            jobs.claim_jobs('test-worker', 1)
+            Job.objects.filter(pk=job.pk).update(locked_at=timezone.now() - timedelta(hours=1))
+            jobs.requeue_stale_jobs()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+        self.assertEqual(self.run_due(), [])
+
+    def test_claim_rechecks_concurrency_limit(self):
+        jobs.enqueue('test.limited')
+        jobs.enqueue('test.limited')
+        # As if another worker claimed a job after this one counted them
+        candidates = list(Job.objects.filter(task='test.limited'))
+        self.assertEqual(len(jobs._claim(candidates[:1], 'other-worker', 1, {'test.limited': 1})), 1)
+        self.assertEqual(jobs._claim(candidates[1:], 'test-worker', 1, {'test.limited': 1}), [])
+        self.assertEqual(Job.objects.filter(status=Job.RUNNING).count(), 1)
+
+    def test_prunes_old_finished_jobs(self):
+        old, recent = self.record.enqueue(value=1), self.record.enqueue(value=2)
+        self.run_due()
+        Job.objects.filter(pk=old.pk).update(finished_at=timezone.now() - timedelta(days=30))
+        queued = self.record.enqueue(value=3)
+        self.assertEqual(jobs.prune_finished_jobs(), 1)
+        self.assertEqual(set(Job.objects.values_list('pk', flat=True)), {recent.pk, queued.pk})
+
+
+class ChunkedUploadTests(KistrecordsTestCase):
+    content = bytes(range(256)) * 40
+
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = self.settings(
+            MEDIA_ROOT=media.name, UPLOAD_TEMP_DIR=f'{media.name}/parts', UPLOAD_MAX_CHUNK_SIZE=4096
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def start(self, **data):
+        response = self.client.post('/api/uploads/', {
+            'patientId': self.patient.id, 'filename': 'scan.pdf', 'size': len(self.content), **data
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return f"/api/uploads/{response.data['id']}/"
+
+    def put_chunk(self, url, offset, chunk, digest=None):
+        digest = base64.b64encode(hashlib.sha256(digest or chunk).digest()).decode()
+        return self.client.put(
+            url, chunk, content_type='application/octet-stream',
+            HTTP_UPLOAD_OFFSET=str(offset), HTTP_CONTENT_DIGEST=f'sha-256=:{digest}:'
+        )
+
+    def test_uploads_in_chunks_and_completes_into_report(self):
+        url = self.start(title='CT scan')
+        for offset in range(0, len(self.content), 4096):
+            response = self.put_chunk(url, offset, self.content[offset:offset + 4096])
+            self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.client.get(url).data['offset'], len(self.content))
+
+        response = self.client.post(f'{url}complete/')
+        self.assertEqual(response.status_code, 201, response.data)
+        report = MedicalReport.objects.get(pk=response.data['medicalReport']['id'])
+        self.assertEqual(report.title, 'CT scan')
+        with report.file.open('rb') as stored:
+            self.assertEqual(stored.read(), self.content)
+
+        # Completing again is harmless
+        again = self.client.post(f'{url}complete/')
+        self.assertEqual(again.data['medicalReport']['id'], report.pk)
+
+    def test_resumes_after_bad_or_misplaced_chunks(self):
+        url = self.start()
+        self.assertEqual(self.put_chunk(url, 0, self.content[:4096]).status_code, 200)
+
+        corrupted = self.put_chunk(url, 4096, b'x' * 4096, digest=self.content[4096:8192])
+        self.assertEqual(corrupted.status_code, 400)
+        skipped = self.put_chunk(url, 8192, self.content[8192:])
+        self.assertEqual(skipped.status_code, 409)
+        self.assertEqual(skipped['Upload-Offset'], '4096')
+
+        status = self.client.get(url).data
+        self.assertEqual((status['offset'], status['complete']), (4096, False))
+        self.assertEqual(self.client.post(f'{url}complete/').status_code, 409)
+
+        self.assertEqual(self.put_chunk(url, 4096, self.content[4096:8192]).status_code, 200)
+        self.assertEqual(self.put_chunk(url, 8192, self.content[8192:]).status_code, 200)
+        self.assertEqual(self.client.post(f'{url}complete/').status_code, 201)
+
+    def test_requires_chunk_digest(self):
+        url = self.start()
+        response = self.client.put(
+            url, self.content[:10], content_type='application/octet-stream', HTTP_UPLOAD_OFFSET='0'
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class ReportDeduplicationTests(KistrecordsTestCase):
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = self.settings(MEDIA_ROOT=media.name, UPLOAD_TEMP_DIR=f'{media.name}/parts')
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def upload(self, content, name='lab.pdf'):
+        response = self.client.post(
+            f'/api/patients/{self.patient.pk}/add_medical_report/',
+            {'file': SimpleUploadedFile(name, content), 'title': name, 'type': 'document'},
+            format='multipart', HTTP_PREFER='return=minimal'
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        return MedicalReport.objects.get(pk=response.data['medicalReport']['id'])
+
+    def test_same_content_is_stored_once(self):
+        first = self.upload(b'%PDF lab results')
+        second = self.upload(b'%PDF lab results', name='lab-again.pdf')
+        other = self.upload(b'%PDF other results')
+
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertNotEqual(first.blob_id, other.blob_id)
+        self.assertEqual(ReportBlob.objects.get(pk=first.blob_id).ref_count, 2)
+
+    def test_file_is_deleted_with_last_reference(self):
+        first = self.upload(b'%PDF lab results')
+        second = self.upload(b'%PDF lab results')
+        name = first.file.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(default_storage.exists(name))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(ReportBlob.objects.exists())
+
+    def test_release_keeps_blob_reacquired_meanwhile(self):
+        blob = self.upload(b'%PDF lab results').blob
+        reacquired = []
+
+        def reacquire(execute, sql, params, many, context):
+            result = execute(sql, params, many, context)
+            # Another request storing the same content once the blob was found
+            # to have no references left
+            if sql.startswith('SELECT') and 'kistrecords_reportblob' in sql and not reacquired:
+                reacquired.append(None)
+                reacquired[0] = blobs._acquire(blob.sha256)
+            return result
+
+        with self.captureOnCommitCallbacks(execute=True), connection.execute_wrapper(reacquire):
+            blobs.release(blob.pk)
+        self.assertEqual(reacquired, [1])
+        self.assertEqual(ReportBlob.objects.get(pk=blob.pk).ref_count, 1)
+        self.assertTrue(default_storage.exists(blob.file.name))
+
+    def test_failed_insert_removes_stored_file(self):
+        with mock.patch('kistrecords.blobs.ReportBlob.objects.create', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                blobs.store_uploaded_file(SimpleUploadedFile('lab.pdf', b'%PDF lab results'))
+        directories = default_storage.listdir('report_blobs')[0]
+        self.assertFalse(any(default_storage.listdir(f'report_blobs/{name}')[1] for name in directories))
+
+    def test_prunes_files_of_rolled_back_stores(self):
+        kept = self.upload(b'%PDF lab results').blob
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            orphan = blobs.store_uploaded_file(SimpleUploadedFile('scan.pdf', b'%PDF other results'))
+            raise RuntimeError
+        self.assertTrue(default_storage.exists(orphan.file.name))
+
+        self.assertEqual(blobs.prune_orphaned_files(), 0)
+        self.assertEqual(blobs.prune_orphaned_files(min_age=0), 1)
+        self.assertFalse(default_storage.exists(orphan.file.name))
+        self.assertTrue(default_storage.exists(kept.file.name))
+
+    def test_command_deduplicates_existing_files(self):
+        for i in range(3):
+            name = default_storage.save(f'medical_reports/scan-{i}.pdf', ContentFile(b'x' * 1000))
+            MedicalReport.objects.create(patient=self.patient, title='Scan', type='document', file=name)
+
+        out = io.StringIO()
+        call_command('dedupe_report_files', stdout=out)
+
+        blob = ReportBlob.objects.get()
+        self.assertEqual(blob.ref_count, 3)
+        self.assertEqual(set(MedicalReport.objects.values_list('file', flat=True)), {blob.file.name})
+        self.assertEqual(default_storage.listdir('medical_reports')[1], [blob.file.name.split('/')[-1]])
+        self.assertIn('2 duplicate copies', out.getvalue())
+
+
+class ReportPreviewTests(KistrecordsTestCase):
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = self.settings(MEDIA_ROOT=media.name, UPLOAD_TEMP_DIR=f'{media.name}/parts')
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def upload_photo(self):
+        photo = io.BytesIO()
+        Image.new('RGB', (3000, 2000), 'teal').save(photo, 'JPEG')
+        response = self.client.post(
+            f'/api/patients/{self.patient.pk}/add_medical_report/',
+            {'file': SimpleUploadedFile('wound.jpg', photo.getvalue()), 'title': 'Wound', 'type': 'image'},
+            format='multipart', HTTP_PREFER='return=minimal'
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        return response.data['medicalReport']
+
+    def test_previews_are_generated_by_a_queued_job(self):
+        report = self.upload_photo()
+        self.assertIsNone(report['thumbnail_url'])
+
+        job = Job.objects.get(task='generate_report_previews')
+        self.assertEqual(job.kwargs, {'report_id': report['id']})
+        self.assertEqual([jobs.run_job(job) for job in jobs.claim_jobs('test-worker', 10)], [Job.SUCCEEDED])
+
+        details = self.client.get(f'/api/patients/{self.patient.pk}/details/').data
+        stored = details['medicalReports'][0]
+        # Signed links work without credentials, as in an <img> tag
+        anonymous = APIClient()
+        thumbnail = anonymous.get(stored['thumbnail_url'])
+        self.assertEqual(thumbnail['Content-Type'], 'image/webp')
+        self.assertEqual(Image.open(io.BytesIO(b''.join(thumbnail.streaming_content))).size, (200, 133))
+        preview = anonymous.get(stored['preview_url'])
+        self.assertEqual(Image.open(io.BytesIO(b''.join(preview.streaming_content))).size, (1024, 683))
+
+
+class MedicalReportFileTests(KistrecordsTestCase):
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        overrides = self.settings(MEDIA_ROOT=media.name, UPLOAD_TEMP_DIR=f'{media.name}/parts')
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.content = bytes(range(256)) * 40
+        response = self.client.post(
+            f'/api/patients/{self.patient.pk}/add_medical_report/',
+            {'file': SimpleUploadedFile('scan.pdf', self.content), 'title': 'CT scan', 'type': 'document'},
+            format='multipart', HTTP_PREFER='return=minimal'
+        )
+        self.assertEqual(response.status_code, 200, response.data)
+        self.report = MedicalReport.objects.get(pk=response.data['medicalReport']['id'])
+        self.url = f'/api/medical-reports/{self.report.pk}/file/'
+
+    def test_whole_file_with_validators(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(response['ETag'], f'"{self.report.blob.sha256}"')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertIn('filename="CT scan.pdf"', response['Content-Disposition'])
+
+        cached = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        cached = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(cached.status_code, 304)
+
+    def test_byte_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.content[100:200])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-10:])
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+
+        # A resume against a changed file gets the whole new file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_access_requires_login_or_signature(self):
+        anonymous = APIClient()
+        self.assertEqual(anonymous.get(self.url).status_code, 403)
+
+        signed_url = self.client.get(f'/api/patients/{self.patient.pk}/details/').data['medicalReports'][0]['file_url']
+        self.assertEqual(anonymous.get(signed_url).status_code, 200)
+        self.assertEqual(anonymous.get(signed_url.replace('/file/', '/preview/')).status_code, 403)
+        self.assertEqual(anonymous.get(signed_url[:-1] + 'x').status_code, 403)
+
+    def test_offload_to_front_proxy(self):
+        with self.settings(MEDIA_SENDFILE='x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.report.file.name}')
+        self.assertEqual(response.content, b'')
+
+    def test_offload_of_names_with_spaces_percent_and_non_ascii(self):
+        # As kept by reports stored before files were named by content
+        name = default_storage.save('medical_reports/एक्स-रे 100%.pdf', ContentFile(self.content))
+        MedicalReport.objects.filter(pk=self.report.pk).update(file=name)
+        escaped = 'medical_reports/%E0%A4%8F%E0%A4%95%E0%A5%8D%E0%A4%B8-%E0%A4%B0%E0%A5%87%20100%25.pdf'
+
+        with self.settings(MEDIA_SENDFILE='x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{escaped}')
+
+        with self.settings(MEDIA_SENDFILE='x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertTrue(response['X-Sendfile'].endswith(f'/{escaped}'))
+
+    def test_storage_without_local_paths(self):
+        # A storage reached through its API only, as S3 is
+        remote = mock.Mock(wraps=default_storage, **{'path.side_effect': NotImplementedError})
+        with mock.patch('kistrecords.media.default_storage', remote), self.settings(MEDIA_SENDFILE='x-sendfile'):
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.has_header('X-Sendfile'))
+            self.assertEqual(b''.join(response.streaming_content), self.content)
+
+            response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), self.content[100:200])
+
+
+class CachedAuthenticationTests(KistrecordsTestCase):
+    def setUp(self):
+        # A cache directory is shared by every worker on the host, so the
+        # user cache is used with it
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        overrides = self.settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': cache_dir.name
+        }})
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        super().setUp()
+        user_cache.clear()
+        self.addCleanup(user_cache.clear)
+        token = self.client.post(
+            '/api/auth/login/', {'username': 'receptionist', 'password': 'receptionist123'}
+        ).data['access']
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_user_is_loaded_once_per_token(self):
+        self.client.get('/api/auth/user/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/auth/user/')
+        self.assertEqual(response.data['role'], 'receptionist')
+        self.assertEqual(len(queries), 0, [query['sql'] for query in queries])
+
+    def test_saved_user_is_reloaded(self):
+        self.client.get('/api/auth/user/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.role = 'admin'
+            self.user.save()
+        self.assertEqual(self.client.get('/api/auth/user/').data['role'], 'admin')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+        self.assertEqual(self.client.get('/api/auth/user/').status_code, 401)
+
+    def test_user_cache_is_not_used_with_a_per_process_cache(self):
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            self.assertEqual([warning.id for warning in checks.check_shared_cache(None)], ['kistrecords.W002'])
+            self.client.get('/api/auth/user/')
+            with CaptureQueriesContext(connection) as queries:
+                self.client.get('/api/auth/user/')
+            self.assertEqual(len(queries), 1)
+        self.assertEqual(checks.check_shared_cache(None), [])
+
+
+class RefreshTokenRevocationTests(KistrecordsTestCase):
+    def setUp(self):
+        super().setUp()
+        revocation.store.clear()
+        self.addCleanup(revocation.store.clear)
+        self.refresh = self.client.post(
+            '/api/auth/login/', {'username': 'receptionist', 'password': 'receptionist123'}
+        ).data['refresh']
+
+    def refresh_token(self, token):
+        with self.captureOnCommitCallbacks(execute=True):
+            return APIClient().post('/api/auth/token/refresh/', {'refresh': token})
+
+    def test_rotated_refresh_token_cannot_be_reused(self):
+        response = self.refresh_token(self.refresh)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.refresh_token(response.data['refresh']).status_code, 200)
+
+        self.assertEqual(self.refresh_token(self.refresh).status_code, 401)
+        with CaptureQueriesContext(connection) as queries:
+            reused = self.refresh_token(self.refresh)
+        self.assertEqual(reused.status_code, 401)
+        # Once synced, turned away from memory without touching the table
+        self.assertEqual(len(queries), 0)
+
+    def test_revocations_from_other_workers_are_seen(self):
+        other_worker = revocation.RevocationStore()
+        self.assertFalse(other_worker.is_revoked('abc'))
+        with self.captureOnCommitCallbacks(execute=True):
+            revocation.revoke('abc', timezone.now() + timedelta(days=1))
+        self.assertTrue(other_worker.is_revoked('abc'))
+        self.assertFalse(other_worker.is_revoked('abd'))
+
+    def test_prune_deletes_expired_entries(self):
+        revocation.revoke('old', timezone.now() - timedelta(seconds=1))
+        revocation.revoke('new', timezone.now() + timedelta(days=1))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(revocation.prune_revoked_tokens(), 1)
+        self.assertEqual(list(RevokedToken.objects.values_list('jti', flat=True)), ['new'])
+        self.assertTrue(revocation.store.is_revoked('new'))
+
+    def test_bloom_filter_grows_past_its_capacity(self):
+        store = revocation.RevocationStore(capacity=16)
+        expires = timezone.now() + timedelta(days=1)
+        RevokedToken.objects.bulk_create(RevokedToken(jti=f'jti-{i}', expires_at=expires) for i in range(100))
+        self.assertTrue(all(store.is_revoked(f'jti-{i}') for i in range(100)))
+        self.assertFalse(store.is_revoked('jti-100'))
+
+
+class MetricsTests(KistrecordsTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.registry.clear()
+        self.addCleanup(metrics.registry.clear)
+        overrides = self.settings(METRICS_TOKEN='scrape-me')
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def scrape(self):
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-me')
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_requests_are_recorded_by_url_name(self):
+        self.client.get('/api/dashboard/')
+        self.client.get('/api/dashboard/')
+        self.client.get(f'/api/bills/{10 ** 6}/')
+
+        text = self.scrape()
+        self.assertIn('http_request_duration_seconds_count{view="dashboard",method="GET"} 2', text)
+        self.assertIn('http_responses_total{view="dashboard",method="GET",status="200"} 2', text)
+        self.assertIn('http_responses_total{view="bill-detail",method="GET",status="404"} 1', text)
+        self.assertIn('http_request_db_queries_bucket{view="dashboard",method="GET",le="+Inf"} 2', text)
+        self.assertIn('# TYPE http_response_size_bytes histogram', text)
+
+    def test_other_processes_are_merged(self):
+        with tempfile.TemporaryDirectory() as directory, self.settings(METRICS_DIR=directory):
+            self.client.get('/api/dashboard/')
+            metrics.flusher.flush()
+            # Another worker's file, as it would have written it
+            other = metrics.flusher.path(pid=os.getpid() + 1)
+            other.write_text(metrics.flusher.path().read_text())
+            self.client.get('/api/dashboard/')
+            text = self.scrape()
+        self.assertIn('http_request_duration_seconds_count{view="dashboard",method="GET"} 3', text)
+
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer guess').status_code, 403)
+        self.scrape()
+
+    def test_hidden_without_token_outside_debug(self):
+        with self.settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+            with self.settings(DEBUG=True):
+                self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class SQLProfilerTests(KistrecordsTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.admin = CustomUser.objects.create_superuser(username='admin', password='admin123', role='admin')
+        for i in range(4):
+            bill = Bill.objects.create(patient=cls.patient, grand_total=Decimal('300.00'), created_by=cls.user)
+            BillItem.objects.create(bill=bill, service=cls.services[i], price=cls.services[i].price)
+            MedicalRecord.objects.create(patient=cls.patient, diagnosis=f'Fever {i}', treatment='Rest', doctor='Dr. Shah')
+
+    def test_repeated_shapes_are_found_with_their_call_site(self):
+        with profile_queries() as profile:
+            names = [str(item) for item in BillItem.objects.all()]
+        self.assertEqual(len(names), 4)
+        [(shape, count, _, sites)] = profile.repeated(3)
+        self.assertEqual(count, 4)
+        self.assertIn('kistrecords_service', shape)
+        self.assertEqual(sites, [f"kistrecords/models.py:{BillItem.__str__.__code__.co_firstlineno + 1} in __str__"])
+        self.assertEqual(query_shape('SELECT 1 WHERE id IN (%s, %s, %s)'), query_shape('SELECT 1 WHERE id IN (%s, %s)'))
+
+    def test_middleware_logs_slow_and_repeated_queries(self):
+        with self.settings(SQL_PROFILER=True, SQL_SLOW_QUERY_MS=0, SQL_REPEATED_QUERY_THRESHOLD=1):
+            client = APIClient()
+            client.force_authenticate(self.user)
+            with self.assertLogs('kistrecords.sql', 'WARNING') as logs:
+                client.get('/api/services/')
+            self.assertTrue(any(line.startswith('WARNING:kistrecords.sql:Slow query') for line in logs.output))
+            self.assertTrue(any('Repeated queries in GET /api/services/' in line for line in logs.output))
+            # Sites point past the metrics and profiler wrappers, into the view
+            self.assertTrue(any('from ServiceViewSet.paginate_queryset via rest_framework/' in line for line in logs.output), logs.output)
+
+            with self.assertLogs('kistrecords.sql', 'WARNING') as logs:
+                client.get('/api/dashboard/')
+            sites = [line.split(' from ', 1)[1].split(':', 1)[0] for line in logs.output if 'Slow query' in line]
+            self.assertIn('kistrecords/views.py', sites)
+            self.assertNotIn('kistrecords/metrics.py', ''.join(logs.output))
+
+            with self.settings(SQL_PROFILER_RAISE=True), self.assertRaises(RepeatedQueries):
+                client.get('/api/services/')
 
-# Create your tests here.
+    def test_admin_changelists_have_no_repeated_queries(self):
+        client = APIClient()
+        client.force_login(self.admin)
+        for model in ('bill', 'billitem', 'medicalrecord', 'medicalreport'):
+            self.assertQueryBudget(12, f'/admin/kistrecords/{model}/', client=client)
@@ -0,0 +1,160 @@
+import base64
+import binascii
+import hashlib
+import re
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import blobs
+from .models import MedicalReport, UploadSession
+
+READ_SIZE = 64 * 1024
+_DIGEST_RE = re.compile(r'(?:^|,)\s*sha-256=:([A-Za-z0-9+/=]+):')
+
+
+class UploadError(Exception):
+    status_code = 400
+
+
+class OffsetMismatch(UploadError):
+    """The chunk does not start where the received bytes end."""
+    status_code = 409
+
+    def __init__(self, received):
+        super().__init__(f"Expected a chunk at offset {received}")
+        self.received = received
+
+
+class ChecksumMismatch(UploadError):
+    pass
+
+
+class UploadIncomplete(UploadError):
+    status_code = 409
+
+
+def parse_content_digest(header):
+    """The SHA-256 digest from a `Content-Digest: sha-256=:<base64>:` header
+    (RFC 9530), or None if the header carries none."""
+    match = _DIGEST_RE.search(header or '')
+    if not match:
+        return None
+    try:
+        digest = base64.b64decode(match.group(1), validate=True)
+    except binascii.Error:
+        return None
+    return digest if len(digest) == 32 else None
+
+
+def part_path(session):
+    return Path(settings.UPLOAD_TEMP_DIR) / f"{session.pk}.part"
+
+
+def expires_at(session):
+    return session.updated_at + timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+
+
+def append_chunk(session, offset, stream, length, digest):
+    """Write `length` bytes read from `stream` at `offset` of the session's
+    part file, and advance the received offset only if they match `digest`.
+
+    The chunk goes to disk in READ_SIZE pieces as it is read off the request,
+    so a chunk never has to fit in memory. Bytes past the received offset are
+    not trusted until their digest has checked out, so a chunk cut off by a
+    dropped connection is simply sent again from the same offset.
+    """
+    if length > settings.UPLOAD_MAX_CHUNK_SIZE:
+        raise UploadError(f"Chunks may be at most {settings.UPLOAD_MAX_CHUNK_SIZE} bytes")
+
+    with transaction.atomic():
+        # Serialize appends to one session
+        sessions = UploadSession.objects.filter(pk=session.pk)
+        if connection.vendor == 'postgresql':
+            sessions = sessions.select_for_update()
+        session = sessions.get()
+        if session.report_id:
+            raise UploadError('Upload is already complete')
+        if offset != session.received:
+            raise OffsetMismatch(session.received)
+        if offset + length > session.size:
+            raise UploadError(f"Chunk ends past the declared size of {session.size} bytes")
+
+        path = part_path(session)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        checksum = hashlib.sha256()
+        written = 0
+        with open(path, 'r+b' if path.exists() else 'wb') as part:
+            part.seek(offset)
+            while written < length:
+                data = stream.read(min(READ_SIZE, length - written))
+                if not data:
+                    break
+                checksum.update(data)
+                part.write(data)
+                written += len(data)
+
+        if written != length:
+            raise UploadError(f"Received {written} of {length} bytes")
+        if checksum.digest() != digest:
+            raise ChecksumMismatch('Chunk does not match its Content-Digest')
+
+        session.received = offset + length
+        session.save(update_fields=['received', 'updated_at'])
+    return session
+
+
+def complete_upload(session):
+    """Turn a fully received upload into a MedicalReport.
+
+    The part file becomes the report's deduplicated blob: on local storage it
+    is renamed into place, or dropped if the content is already stored.
+    Completing an already completed upload returns its report.
+    """
+    with transaction.atomic():
+        sessions = UploadSession.objects.filter(pk=session.pk)
+        if connection.vendor == 'postgresql':
+            sessions = sessions.select_for_update()
+        session = sessions.get()
+        if session.report_id:
+            return session.report
+        if session.received != session.size:
+            raise UploadIncomplete(f"Received {session.received} of {session.size} bytes")
+
+        # Hashing takes one read of the part file, as digest state cannot be
+        # kept between chunk requests; the file itself is moved, not copied
+        path = part_path(session)
+        blob = blobs.store_file(path, blobs.file_digest(path), session.filename)
+        report = MedicalReport.objects.create(
+            patient_id=session.patient_id,
+            title=session.title,
+            type=session.type,
+            file=blob.file.name,
+            blob=blob,
+            uploadedBy=session.uploaded_by,
+        )
+        session.report = report
+        session.save(update_fields=['report', 'updated_at'])
+    return report
+
+
+def discard_upload(session):
+    part_path(session).unlink(missing_ok=True)
+    session.delete()
+
+
+def prune_expired_uploads():
+    """Delete unfinished uploads idle for longer than UPLOAD_SESSION_TTL_HOURS,
+    with their part files."""
+    cutoff = timezone.now() - timedelta(hours=settings.UPLOAD_SESSION_TTL_HOURS)
+    expired = UploadSession.objects.filter(report__isnull=True, updated_at__lt=cutoff)
+    count = 0
+    for session in expired.iterator():
+        discard_upload(session)
+        count += 1
+    # Completed sessions only keep the report link for repeated completes
+    UploadSession.objects.filter(report__isnull=False, updated_at__lt=cutoff).delete()
+    return count
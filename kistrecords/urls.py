@@ -1,8 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from . import views
-from .views import CustomTokenObtainPairView
-from rest_framework_simplejwt.views import TokenRefreshView
+from .views import CustomTokenObtainPairView, CustomTokenRefreshView
 
 
 router = DefaultRouter()
@@ -16,11 +15,19 @@ urlpatterns = [
     path('auth/user/', views.get_current_user, name='get_current_user'),
     path('dashboard/', views.get_dashboard_data, name='dashboard'),
     path('bills/', views.CreateBillView.as_view(), name='bill-create'),
+    path('bills/bulk/', views.BulkCreateBillView.as_view(), name='bill-bulk-create'),
+    path('bills/export/', views.export_bills, name='bill-export'),
     path('bills/list/', views.BillViewSet.as_view({'get': 'list'}), name='bill-list'),
     path('bills/<int:pk>/', views.BillViewSet.as_view({'get': 'retrieve', 'patch': 'partial_update'}), name='bill-detail'),
+    path('bills/<int:pk>/download/', views.BillViewSet.as_view({'get': 'download'}), name='bill-download'),
     path('bills/daily-report/', views.BillViewSet.as_view({'get': 'daily_report'}), name='bill-daily-report'),
+    path('medical-reports/<int:pk>/<str:variant>/', views.medical_report_file, name='medical-report-file'),
+    path('medical-records/search/', views.search_medical_records, name='medical-record-search'),
     path('patients/<int:pk>/add_medical_record/', views.PatientViewSet.as_view({'post': 'add_medical_record'}), name='add-medical-record'),
     path('patients/<int:pk>/add_medical_report/', views.PatientViewSet.as_view({'post': 'add_medical_report'}), name='add-medical-report'),
+    path('uploads/', views.UploadSessionViewSet.as_view({'post': 'create'}), name='upload-create'),
+    path('uploads/<uuid:pk>/', views.UploadSessionViewSet.as_view({'get': 'retrieve', 'put': 'append', 'delete': 'destroy'}), name='upload-detail'),
+    path('uploads/<uuid:pk>/complete/', views.UploadSessionViewSet.as_view({'post': 'complete'}), name='upload-complete'),
     path('auth/login/', CustomTokenObtainPairView.as_view(), name='token_obtain_pair'),
-    path('auth/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('auth/token/refresh/', CustomTokenRefreshView.as_view(), name='token_refresh'),
 ]
\ No newline at end of file
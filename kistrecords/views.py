@@ -1,25 +1,62 @@
 from rest_framework import viewsets, generics, status
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.decorators import action, api_view
-from django.db.models import Sum, Count
+from rest_framework.exceptions import NotFound, ValidationError
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum, Count, F, prefetch_related_objects
+from django.db.models.functions import Coalesce
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_date
 from django.utils import timezone
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from datetime import datetime, timedelta
-from .models import Bill, Patient, BillItem, Service, MedicalRecord, MedicalReport
+from decimal import Decimal
+from .models import (
+    Bill, Patient, BillItem, Service, MedicalRecord, MedicalReport, DailyRevenue, UploadSession,
+    bill_items_prefetch
+)
 from .serializers import (
     BillSerializer, PatientSerializer, 
     CreateBillRequestSerializer, ServiceSerializer,
     MedicalRecordSerializer, MedicalReportSerializer
 )
-from rest_framework_simplejwt.views import TokenObtainPairView
-from .serializers import CustomTokenObtainPairSerializer
+from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from . import billing
+from . import blobs
+from . import exports
+from . import invoices
+from . import media
+from . import uploads
+from .numbering import allocate_bill_numbers
+from .pagination import BillPagination, MedicalRecordSearchPagination, PatientPagination
+from .search import MedicalRecordSearch, search_patients
+from . import cache as cache_utils
+from . import charts
+from .serializers import CustomTokenObtainPairSerializer, RevokingTokenRefreshSerializer
 import logging
 
 logger = logging.getLogger(__name__)
 
+ZERO_AMOUNT = Decimal('0.00')
+DAILY_REVENUE_TOTAL = F('paid_revenue') + F('pending_revenue') + F('cancelled_revenue')
+
+def parse_day(value):
+    # parse_date returns None for malformed input but raises for impossible
+    # dates such as 2025-02-30
+    try:
+        return parse_date(value)
+    except ValueError:
+        return None
+
 class CustomTokenObtainPairView(TokenObtainPairView):
     serializer_class = CustomTokenObtainPairSerializer
 
+class CustomTokenRefreshView(TokenRefreshView):
+    serializer_class = RevokingTokenRefreshSerializer
+
 from rest_framework.decorators import permission_classes
 from django.contrib.auth import get_user_model
 
@@ -38,9 +75,10 @@ def get_current_user(request):
     })
     
 class BillViewSet(viewsets.ModelViewSet):
-    queryset = Bill.objects.all().order_by('-date')
+    queryset = Bill.objects.with_details().order_by('-date', '-id')
     serializer_class = BillSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = BillPagination
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -51,16 +89,40 @@ class BillViewSet(viewsets.ModelViewSet):
             queryset = queryset.filter(patient_id=patient_id)
         if date:
             # Filter bills by date (YYYY-MM-DD format)
-            queryset = queryset.filter(date__date=date)
+            day = parse_day(date)
+            if day is None:
+                raise ValidationError({'date': 'Invalid date, expected YYYY-MM-DD format'})
+            queryset = queryset.filter(day=day)
             
         return queryset
 
     @action(detail=True, methods=['get'])
     def download(self, request, pk=None):
         bill = self.get_object()
-        # In production, generate PDF here
-        serializer = self.get_serializer(bill)
-        return Response(serializer.data)
+        data = invoices.invoice_data(bill)
+        # The PDF is cached under a hash of everything printed on it, which
+        # also serves as its ETag
+        etag = f'"{invoices.invoice_digest(data)}"'
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            path = invoices.get_invoice(bill, data)
+        except (invoices.RendererBusy, FuturesTimeoutError):
+            logger.warning(f"Invoice renderer busy, refusing download of bill {bill.pk}")
+            return Response(
+                {"error": "Invoice printing is busy, please try again shortly"},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': '2'}
+            )
+
+        response = FileResponse(
+            open(path, 'rb'), content_type='application/pdf', filename=f"{bill.bill_number}.pdf"
+        )
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
         
     @action(detail=False, methods=['get'])
     def daily_report(self, request):
@@ -71,14 +133,27 @@ class BillViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
             
+        day = parse_day(date)
+        if day is None:
+            return Response(
+                {"error": "Invalid date, expected YYYY-MM-DD format"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
         # Filter bills by date
-        bills = self.get_queryset().filter(date__date=date)
-        
-        # Calculate summary data
-        total_amount = sum(bill.grand_total for bill in bills)
-        bill_count = bills.count()
+        bills = list(self.get_queryset().filter(day=day))
+
+        # Calculate summary data; unless the list is narrowed to one patient the
+        # totals come straight from the day's rollup row
+        if request.query_params.get('patientId'):
+            total_amount = sum(bill.grand_total for bill in bills)
+            bill_count = len(bills)
+        else:
+            rollup = DailyRevenue.objects.filter(day=day).first() or DailyRevenue(day=day)
+            total_amount = rollup.revenue
+            bill_count = rollup.bill_count
         average_amount = total_amount / bill_count if bill_count > 0 else 0
-        highest_amount = max([bill.grand_total for bill in bills]) if bill_count > 0 else 0
+        highest_amount = max(bill.grand_total for bill in bills) if bills else 0
         
         # Serialize the bills
         serializer = self.get_serializer(bills, many=True)
@@ -97,9 +172,10 @@ class BillViewSet(viewsets.ModelViewSet):
 
 
 class PatientViewSet(viewsets.ModelViewSet):
-    queryset = Patient.objects.all().order_by('-created_at')
+    queryset = Patient.objects.all().order_by('-created_at', '-id')
     serializer_class = PatientSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = PatientPagination
     filterset_fields = ['name', 'phone', 'gender']
     
     def destroy(self, request, *args, **kwargs):
@@ -134,30 +210,26 @@ class PatientViewSet(viewsets.ModelViewSet):
                     
             uploaded_by = request.data.get('uploadedBy', request.user.username)
             
-            # Create the medical report with the actual file
-            report = MedicalReport.objects.create(
-                patient=patient,
-                title=title,
-                type=report_type,
-                file=uploaded_file,
-                uploadedBy=uploaded_by
-            )
+            # Store the file by content, so a re-uploaded file is kept only once
+            with transaction.atomic():
+                blob = blobs.store_uploaded_file(uploaded_file)
+                report = MedicalReport.objects.create(
+                    patient=patient,
+                    title=title,
+                    type=report_type,
+                    file=blob.file.name,
+                    blob=blob,
+                    uploadedBy=uploaded_by
+                )
             
             # Set the fileUrl to the file's URL for frontend compatibility
-            report.fileUrl = request.build_absolute_uri(report.file.url)
+            report.fileUrl = media.report_file_url(report, request=request, signed=False)
             report.save()
         
             # Return updated patient data
-            medical_records = MedicalRecord.objects.filter(patient=patient).order_by('-date')
-            bills = Bill.objects.filter(patient=patient).order_by('-date')
-            reports = MedicalReport.objects.filter(patient=patient).order_by('-date')
-        
-            return Response({
-                'patient': PatientSerializer(patient).data,
-                'medicalRecords': MedicalRecordSerializer(medical_records, many=True).data,
-                'billingHistory': BillSerializer(bills, many=True).data,
-                'medicalReports': MedicalReportSerializer(reports, many=True).data,
-            })
+            return self.mutation_response(
+                request, patient, 'created', 'medicalReport', MedicalReportSerializer(report).data
+            )
         
         except Exception as e:
             logger.error(f"Error adding medical report: {str(e)}")
@@ -187,16 +259,9 @@ class PatientViewSet(viewsets.ModelViewSet):
             )
             
             # Return updated patient data
-            medical_records = MedicalRecord.objects.filter(patient=patient).order_by('-date')
-            bills = Bill.objects.filter(patient=patient).order_by('-date')
-            reports = MedicalReport.objects.filter(patient=patient).order_by('-date')
-            
-            return Response({
-                'patient': PatientSerializer(patient).data,
-                'medicalRecords': MedicalRecordSerializer(medical_records, many=True).data,
-                'billingHistory': BillSerializer(bills, many=True).data,
-                'medicalReports': MedicalReportSerializer(reports, many=True).data,
-            })
+            return self.mutation_response(
+                request, patient, 'created', 'medicalRecord', MedicalRecordSerializer(record).data
+            )
             
         except Exception as e:
             logger.error(f"Error adding medical record: {str(e)}")
@@ -212,26 +277,66 @@ class PatientViewSet(viewsets.ModelViewSet):
             logger.error(f"Error creating patient: {str(e)}")
             raise
 
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        query = request.query_params.get('q', '')
+        try:
+            limit = min(max(int(request.query_params.get('limit', 10)), 1), 50)
+        except ValueError:
+            limit = 10
+
+        results = []
+        for patient, score in search_patients(query, limit):
+            data = PatientSerializer(patient).data
+            data['score'] = round(score, 3)
+            results.append(data)
+        return Response({'query': query, 'results': results})
+
     @action(detail=True, methods=['get'])
     def billing_history(self, request, pk=None):
         patient = self.get_object()
-        bills = Bill.objects.filter(patient=patient).order_by('-date')
+        bills = Bill.objects.with_details().filter(patient=patient).order_by('-date')
         serializer = BillSerializer(bills, many=True)
         return Response(serializer.data)
         
     @action(detail=True, methods=['get'])
     def details(self, request, pk=None):
         patient = self.get_object()
-        medical_records = MedicalRecord.objects.filter(patient=patient).order_by('-date')
-        bills = Bill.objects.filter(patient=patient).order_by('-date')
-        reports = MedicalReport.objects.filter(patient=patient).order_by('-date')
-        
-        return Response({
-            'patient': PatientSerializer(patient).data,
-            'medicalRecords': MedicalRecordSerializer(medical_records, many=True).data,
-            'billingHistory': BillSerializer(bills, many=True).data,
-            'medicalReports': MedicalReportSerializer(reports, many=True).data,
+        # The chart only changes when its version does, so a client holding
+        # the current ETag gets a 304 without anything being serialized
+        not_modified = get_conditional_response(request, etag=charts.chart_etag(patient))
+        if not_modified is not None:
+            not_modified['ETag'] = charts.chart_etag(patient)
+            return not_modified
+        return self.chart_response(patient)
+
+    def chart_response(self, patient):
+        response = Response(charts.get_chart(patient))
+        response['ETag'] = charts.chart_etag(patient)
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def wants_delta(self, request):
+        # Opt in with "Prefer: return=minimal" or ?response=delta
+        prefer = [token.strip() for token in request.headers.get('Prefer', '').split(',')]
+        return 'return=minimal' in prefer or request.query_params.get('response') == 'delta'
+
+    def mutation_response(self, request, patient, change, key, data):
+        """Respond to a chart mutation with the full chart, or, when the client
+        asks for a delta, with just the changed entity and the new chart version
+        so it can patch the chart it already holds."""
+        charts.refresh_chart_version(patient)
+        if not self.wants_delta(request):
+            return self.chart_response(patient)
+
+        response = Response({
+            'action': change,
+            key: data,
+            'chartVersion': patient.chart_version,
         })
+        response['ETag'] = charts.chart_etag(patient)
+        response['Preference-Applied'] = 'return=minimal'
+        return response
         
     @action(detail=True, methods=['delete'], url_path='delete-medical-report/(?P<report_id>[^/.]+)')
     def delete_medical_report(self, request, pk=None, report_id=None):
@@ -239,19 +344,11 @@ class PatientViewSet(viewsets.ModelViewSet):
         
         try:
             report = MedicalReport.objects.get(id=report_id, patient=patient)
+            deleted = MedicalReportSerializer(report).data
             report.delete()
             
             # Return updated patient data
-            medical_records = MedicalRecord.objects.filter(patient=patient).order_by('-date')
-            bills = Bill.objects.filter(patient=patient).order_by('-date')
-            reports = MedicalReport.objects.filter(patient=patient).order_by('-date')
-            
-            return Response({
-                'patient': PatientSerializer(patient).data,
-                'medicalRecords': MedicalRecordSerializer(medical_records, many=True).data,
-                'billingHistory': BillSerializer(bills, many=True).data,
-                'medicalReports': MedicalReportSerializer(reports, many=True).data,
-            })
+            return self.mutation_response(request, patient, 'deleted', 'medicalReport', deleted)
             
         except MedicalReport.DoesNotExist:
             return Response({"error": "Medical report not found"}, status=status.HTTP_404_NOT_FOUND)
@@ -265,19 +362,11 @@ class PatientViewSet(viewsets.ModelViewSet):
         
         try:
             record = MedicalRecord.objects.get(id=record_id, patient=patient)
+            deleted = MedicalRecordSerializer(record).data
             record.delete()
             
             # Return updated patient data
-            medical_records = MedicalRecord.objects.filter(patient=patient).order_by('-date')
-            bills = Bill.objects.filter(patient=patient).order_by('-date')
-            reports = MedicalReport.objects.filter(patient=patient).order_by('-date')
-            
-            return Response({
-                'patient': PatientSerializer(patient).data,
-                'medicalRecords': MedicalRecordSerializer(medical_records, many=True).data,
-                'billingHistory': BillSerializer(bills, many=True).data,
-                'medicalReports': MedicalReportSerializer(reports, many=True).data,
-            })
+            return self.mutation_response(request, patient, 'deleted', 'medicalRecord', deleted)
             
         except MedicalRecord.DoesNotExist:
             return Response({"error": "Medical record not found"}, status=status.HTTP_404_NOT_FOUND)
@@ -289,101 +378,70 @@ class ServiceViewSet(viewsets.ModelViewSet):
     serializer_class = ServiceSerializer
     permission_classes = [IsAuthenticated]
 
+
+def build_dashboard_data(today):
+    week_start = today - timedelta(days=6)
+
+    # All-time totals and the 7-day window come from the DailyRevenue
+    # rollup, so the work here grows with days rather than with bills
+    totals = DailyRevenue.objects.aggregate(
+        total_bills=Coalesce(Sum('bill_count'), 0),
+        total_revenue=Coalesce(Sum(DAILY_REVENUE_TOTAL), ZERO_AMOUNT),
+    )
+    total_patients = Patient.objects.count()
+
+    stats_by_day = {
+        rollup.day: rollup
+        for rollup in DailyRevenue.objects.filter(day__gte=week_start, day__lte=today)
+    }
+    empty_day = DailyRevenue()
+
+    daily_stats = []
+    for i in range(7):
+        date = today - timedelta(days=i)
+        day = stats_by_day.get(date, empty_day)
+        daily_stats.append({
+            'date': date.isoformat(),
+            'patients': day.patient_count,
+            'revenue': day.revenue
+        })
+    today_stats = stats_by_day.get(today, empty_day)
+
+    # Get recent bills (last 5)
+    recent_bills = Bill.objects.with_details().order_by('-date')[:5]
+
+    # Get recent patients (last 5)
+    recent_patients = Patient.objects.order_by('-last_visit')[:5]
+
+    # Prepare response data
+    data = {
+        'totalPatients': total_patients,
+        'totalBills': totals['total_bills'],
+        'totalRevenue': totals['total_revenue'],
+        'todayPatients': today_stats.patient_count,
+        'todayBills': today_stats.bill_count,
+        'todayRevenue': today_stats.revenue,
+        'recentBills': BillSerializer(recent_bills, many=True).data,
+        'recentPatients': PatientSerializer(recent_patients, many=True).data,
+        'dailyStats': daily_stats
+    }
+    return data
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def get_dashboard_data(request):
     logger.info("Dashboard API called")
     try:
-        # Get today's date
-        today = timezone.now().date()
-        
-        # Get bills from today
-        logger.info(f"Getting bills for today: {today}")
-        today_bills = Bill.objects.filter(date__date=today)
-        logger.info(f"Found {today_bills.count()} bills for today")
-        
-        today_revenue = 0
-        for bill in today_bills:
-            try:
-                logger.info(f"Processing bill {bill.id}, grand_total: {bill.grand_total}, type: {type(bill.grand_total)}")
-                if isinstance(bill.grand_total, (int, float)):
-                    today_revenue += bill.grand_total
-                else:
-                    today_revenue += float(bill.grand_total)
-            except (ValueError, TypeError) as e:
-                logger.error(f"Error processing bill {bill.id}: {str(e)}")
-                # Skip bills with invalid grand_total
-                pass
-        
-        # Get unique patients from today's bills
-        today_patient_ids = set(today_bills.values_list('patient_id', flat=True))
-        today_patient_count = len(today_patient_ids)
-        
-        # Get total counts
-        total_patients = Patient.objects.count()
-        total_bills = Bill.objects.count()
-        
-        # Calculate total revenue safely
-        logger.info("Calculating total revenue")
-        all_bills = Bill.objects.all()
-        logger.info(f"Total bills in database: {all_bills.count()}")
-        
-        total_revenue = 0
-        for bill in all_bills:
-            try:
-                if isinstance(bill.grand_total, (int, float)):
-                    total_revenue += bill.grand_total
-                else:
-                    total_revenue += float(bill.grand_total)
-            except (ValueError, TypeError) as e:
-                logger.error(f"Error calculating total revenue for bill {bill.id}: {str(e)}")
-                # Skip bills with invalid grand_total
-                pass
-        
-        # Get recent bills (last 5)
-        recent_bills = Bill.objects.order_by('-date')[:5]
-        
-        # Get recent patients (last 5)
-        recent_patients = Patient.objects.order_by('-last_visit')[:5]
-        
-        # Get daily stats for the last 7 days
-        daily_stats = []
-        for i in range(7):
-            date = today - timedelta(days=i)
-            day_bills = Bill.objects.filter(date__date=date)
-            day_patient_ids = set(day_bills.values_list('patient_id', flat=True))
-            
-            # Calculate daily revenue safely
-            day_revenue = 0
-            for bill in day_bills:
-                try:
-                    if isinstance(bill.grand_total, (int, float)):
-                        day_revenue += bill.grand_total
-                    else:
-                        day_revenue += float(bill.grand_total)
-                except (ValueError, TypeError):
-                    # Skip bills with invalid grand_total
-                    pass
-            
-            daily_stats.append({
-                'date': date.isoformat(),
-                'patients': len(day_patient_ids),
-                'revenue': day_revenue
-            })
-        
-        # Prepare response data
-        data = {
-            'totalPatients': total_patients,
-            'totalBills': total_bills,
-            'totalRevenue': total_revenue,
-            'todayPatients': today_patient_count,
-            'todayBills': today_bills.count(),
-            'todayRevenue': today_revenue,
-            'recentBills': BillSerializer(recent_bills, many=True).data,
-            'recentPatients': PatientSerializer(recent_patients, many=True).data,
-            'dailyStats': daily_stats
-        }
-        
+        # Payloads are cached per day and per dashboard version; signals.py
+        # bumps the version whenever a bill, bill item or patient changes
+        today = timezone.localdate()
+        data = cache_utils.get_or_build(
+            cache_utils.DASHBOARD_NAMESPACE,
+            lambda: build_dashboard_data(today),
+            timeout=settings.DASHBOARD_CACHE_TIMEOUT,
+            suffix=today.isoformat(),
+        )
         return Response(data)
     except Exception as e:
         logger.error(f"Error in dashboard API: {str(e)}")
@@ -393,6 +451,201 @@ def get_dashboard_data(request):
         )
 
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search_medical_records(request):
+    query = request.query_params.get('q', '').strip()
+    if not query:
+        return Response({"error": "q is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+    paginator = MedicalRecordSearchPagination()
+    page = paginator.paginate_queryset(MedicalRecordSearch(query), request)
+    results = []
+    for match in page:
+        record = match['record']
+        data = MedicalRecordSerializer(record).data
+        data['patient'] = {'id': record.patient_id, 'name': record.patient.name}
+        data['rank'] = round(match['rank'], 4)
+        data['highlight'] = {
+            'diagnosis': match['diagnosis_highlight'],
+            'snippet': match['snippet'],
+        }
+        results.append(data)
+    return paginator.get_paginated_response(results)
+
+
+@api_view(['GET'])
+@permission_classes([AllowAny])
+def medical_report_file(request, pk, variant):
+    """A medical report's file, thumbnail or preview, for a signed-in user or
+    the holder of a signed link from the report's serializer."""
+    if variant not in media.REPORT_FILE_FIELDS:
+        raise NotFound()
+    if not request.user.is_authenticated and not media.signature_is_valid(
+        pk, variant, request.query_params.get('expires'), request.query_params.get('signature')
+    ):
+        return Response({"error": "Authentication or a valid signed link is required"}, status=status.HTTP_403_FORBIDDEN)
+
+    report = MedicalReport.objects.select_related('blob').filter(pk=pk).first()
+    if report is None or not getattr(report, variant):
+        raise NotFound()
+    return media.serve_report_file(request, report, variant)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def export_bills(request):
+    # `format` is taken by DRF's content negotiation, hence `output`
+    kind = request.query_params.get('type', 'bills')
+    export_format = request.query_params.get('output', 'csv')
+    start = parse_day(request.query_params.get('start', ''))
+    end = parse_day(request.query_params.get('end', ''))
+
+    if kind not in exports.EXPORT_COLUMNS:
+        return Response(
+            {"error": f"type must be one of: {', '.join(exports.EXPORT_COLUMNS)}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if export_format not in exports.EXPORT_FORMATS:
+        return Response(
+            {"error": f"output must be one of: {', '.join(exports.EXPORT_FORMATS)}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    if start is None or end is None or end < start:
+        return Response(
+            {"error": "start and end are required (YYYY-MM-DD format), with end on or after start"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    logger.info(f"Exporting {kind} from {start} to {end} as {export_format}")
+    response = StreamingHttpResponse(
+        exports.export_lines(kind, export_format, start, end),
+        content_type=exports.EXPORT_FORMATS[export_format],
+    )
+    filename = exports.export_filename(kind, export_format, start, end)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+class UploadSessionViewSet(viewsets.ViewSet):
+    """Chunked, resumable uploads of medical report files.
+
+    POST /uploads/ declares the file and returns an upload id. Each PUT to
+    /uploads/<id>/ appends a chunk at the offset given in the Upload-Offset
+    header, with its SHA-256 in a Content-Digest header. After a dropped
+    connection, GET /uploads/<id>/ says where to resume. POST
+    /uploads/<id>/complete/ then files the upload as a medical report.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get_session(self, request, pk):
+        try:
+            return UploadSession.objects.select_related('patient').get(pk=pk, created_by=request.user)
+        except UploadSession.DoesNotExist:
+            raise NotFound('Upload not found')
+
+    def session_response(self, session, status_code=status.HTTP_200_OK):
+        response = Response({
+            'id': str(session.pk),
+            'filename': session.filename,
+            'size': session.size,
+            'offset': session.received,
+            'complete': session.report_id is not None,
+            'chunkSize': settings.UPLOAD_MAX_CHUNK_SIZE,
+            'expiresAt': uploads.expires_at(session),
+        }, status=status_code)
+        response['Upload-Offset'] = str(session.received)
+        return response
+
+    def create(self, request):
+        filename = request.data.get('filename', '')
+        try:
+            size = int(request.data.get('size'))
+            patient = Patient.objects.get(pk=request.data.get('patientId'))
+        except (TypeError, ValueError, Patient.DoesNotExist):
+            return Response(
+                {"error": "patientId of an existing patient and the file size are required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not filename or size <= 0 or size > settings.UPLOAD_MAX_FILE_SIZE:
+            return Response(
+                {"error": f"A filename and a size of 1 to {settings.UPLOAD_MAX_FILE_SIZE} bytes are required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        report_type = request.data.get('type')
+        if report_type not in ('image', 'document'):
+            # Determine type based on file extension
+            if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
+                report_type = 'image'
+            else:
+                report_type = 'document'
+
+        session = UploadSession.objects.create(
+            patient=patient,
+            created_by=request.user,
+            filename=filename[:255],
+            title=request.data.get('title') or filename[:200],
+            type=report_type,
+            uploaded_by=request.data.get('uploadedBy', request.user.username),
+            size=size,
+        )
+        logger.info(f"Upload {session.pk} of {size} bytes started for patient {patient.pk}")
+        return self.session_response(session, status.HTTP_201_CREATED)
+
+    def retrieve(self, request, pk=None):
+        return self.session_response(self.get_session(request, pk))
+
+    def append(self, request, pk=None):
+        session = self.get_session(request, pk)
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+            length = int(request.headers.get('Content-Length', ''))
+        except ValueError:
+            return Response(
+                {"error": "Upload-Offset and Content-Length headers are required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        digest = uploads.parse_content_digest(request.headers.get('Content-Digest'))
+        if digest is None:
+            return Response(
+                {"error": "A Content-Digest header with a sha-256 digest is required"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            session = uploads.append_chunk(session, offset, request.stream, length, digest)
+        except uploads.UploadError as e:
+            response = Response({"error": str(e)}, status=e.status_code)
+            if isinstance(e, uploads.OffsetMismatch):
+                response['Upload-Offset'] = str(e.received)
+            return response
+        return self.session_response(session)
+
+    def complete(self, request, pk=None):
+        session = self.get_session(request, pk)
+        try:
+            report = uploads.complete_upload(session)
+        except uploads.UploadError as e:
+            return Response({"error": str(e)}, status=e.status_code)
+
+        if not report.fileUrl:
+            # Set the fileUrl to the file's URL for frontend compatibility
+            report.fileUrl = media.report_file_url(report, request=request, signed=False)
+            report.save(update_fields=['fileUrl'])
+        logger.info(f"Upload {session.pk} completed as medical report {report.pk}")
+        return Response(
+            {'medicalReport': MedicalReportSerializer(report).data, 'patientId': session.patient_id},
+            status=status.HTTP_201_CREATED
+        )
+
+    def destroy(self, request, pk=None):
+        session = self.get_session(request, pk)
+        if session.report_id is None:
+            uploads.discard_upload(session)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
 class CreateBillView(generics.CreateAPIView):
     permission_classes = [IsAuthenticated]
     serializer_class = CreateBillRequestSerializer
@@ -411,67 +664,122 @@ class CreateBillView(generics.CreateAPIView):
             )
         
         data = serializer.validated_data
-        patient_id = data['patientId']
-        items_data = data['items']
-        discount_type = data['discountType']
-        discount_value = data['discountValue']
         
         try:
-            patient = Patient.objects.get(id=patient_id)
+            patient = Patient.objects.get(id=data['patientId'])
         except Patient.DoesNotExist:
             return Response(
                 {'error': 'Patient not found'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
         
-        # Calculate bill totals
-        subtotal = 0
-        bill_items = []
-        
-        for item in items_data:
-            try:
-                service = Service.objects.get(id=item['serviceId'])
-            except Service.DoesNotExist:
-                return Response(
-                    {'error': f'Service with ID {item["serviceId"]} not found'},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-            
-            quantity = item.get('quantity', 1)
-            item_total = service.price * quantity
-            subtotal += item_total
-            
-            bill_items.append({
-                'service': service,
-                'quantity': quantity,
-                'price': service.price,
-                'total': item_total
-            })
-        
-        if discount_type == 'percentage':
-            discount_amount = (subtotal * discount_value) / 100
-        else:
-            discount_amount = discount_value
-        
-        grand_total = subtotal - discount_amount
-        
-        # Create the bill
-        bill = Bill.objects.create(
-            patient=patient,
-            discount_type=discount_type,
-            discount_value=discount_value,
-            discount_amount=discount_amount,
-            grand_total=grand_total,
-            created_by=request.user,
-            notes=data.get('notes', '')
-        )
-        
-        # Create bill items
-        for item in bill_items:
-            BillItem.objects.create(bill=bill, **item)
+        # One lookup for every service on the bill, totals computed once
+        services = Service.objects.in_bulk(billing.service_ids(data['items']))
+        try:
+            bill, bill_items = billing.build_bill(patient, data, services, request.user)
+        except billing.UnknownService as e:
+            return Response({'error': str(e)}, status=status.HTTP_404_NOT_FOUND)
+        
+        # Create the bill and its items together or not at all
+        with transaction.atomic():
+            bill.save()
+            for item in bill_items:
+                item.bill = bill
+            BillItem.objects.bulk_create(bill_items)
+        prefetch_related_objects([bill], bill_items_prefetch())
         
         return Response(
             BillSerializer(bill, context={'request': request}).data,
             status=status.HTTP_201_CREATED
         )
 
+
+
+
+class BulkCreateBillView(generics.GenericAPIView):
+    """Create many bills in one request, e.g. when a camp clinic uploads the
+    bills it collected offline.
+
+    Accepts a list of CreateBillRequestSerializer payloads (or {"bills": [...]})
+    and reports a result per entry; invalid entries are skipped without
+    affecting the others.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = CreateBillRequestSerializer
+    max_bills = 500
+
+    def post(self, request, *args, **kwargs):
+        entries = request.data.get('bills') if isinstance(request.data, dict) else request.data
+        if not isinstance(entries, list) or not entries:
+            return Response(
+                {'error': 'Expected a non-empty list of bills'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(entries) > self.max_bills:
+            return Response(
+                {'error': f'At most {self.max_bills} bills can be created per request'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        logger.info(f"Received bulk bill creation request with {len(entries)} bills")
+
+        results = [None] * len(entries)
+        validated = []
+        for index, entry in enumerate(entries):
+            serializer = self.get_serializer(data=entry)
+            if serializer.is_valid():
+                validated.append((index, serializer.validated_data))
+            else:
+                results[index] = {'index': index, 'status': 'error', 'error': 'Invalid bill', 'details': serializer.errors}
+
+        # Shared lookups for every patient and service in the batch
+        patients = Patient.objects.in_bulk({data['patientId'] for _, data in validated})
+        services = Service.objects.in_bulk(
+            set().union(*(billing.service_ids(data['items']) for _, data in validated))
+        )
+
+        prepared = []
+        for index, data in validated:
+            patient = patients.get(data['patientId'])
+            if patient is None:
+                results[index] = {'index': index, 'status': 'error', 'error': 'Patient not found'}
+                continue
+            try:
+                prepared.append((index, billing.build_bill(patient, data, services, request.user)))
+            except billing.UnknownService as e:
+                results[index] = {'index': index, 'status': 'error', 'error': str(e)}
+
+        if prepared:
+            numbers = allocate_bill_numbers(len(prepared))
+            for (_, (bill, _)), number in zip(prepared, numbers):
+                bill.bill_number = number
+            errors = billing.insert_bills([entry for _, entry in prepared])
+
+            created = {}
+            for (index, (bill, _)), error in zip(prepared, errors):
+                if error is None:
+                    created[bill.pk] = index
+                else:
+                    logger.error(f"Error creating bill {index} in bulk request: {str(error)}")
+                    results[index] = {'index': index, 'status': 'error', 'error': str(error)}
+
+            bills = Bill.objects.with_details().filter(pk__in=created)
+            for bill in bills:
+                index = created[bill.pk]
+                results[index] = {
+                    'index': index,
+                    'status': 'created',
+                    'bill': BillSerializer(bill, context={'request': request}).data,
+                }
+
+        created_count = sum(1 for result in results if result['status'] == 'created')
+        if created_count == len(results):
+            response_status = status.HTTP_201_CREATED
+        elif created_count:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({
+            'created': created_count,
+            'failed': len(results) - created_count,
+            'results': results,
+        }, status=response_status)
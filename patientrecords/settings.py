@@ -50,6 +50,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'kistrecords.metrics.MetricsMiddleware',   # First, so that it times everything below
+    'kistrecords.profiling.SQLProfilerMiddleware',   # Only active with SQL_PROFILER on
     'corsheaders.middleware.CorsMiddleware',   # CORS middleware should be as high as possible
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -114,6 +116,122 @@ DATABASES = {
     'default': dj_database_url.config(default=config("DATABASE_URL"))
 }
 
+# Trigram lookups used by patient search (kistrecords/search.py)
+if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
+    INSTALLED_APPS.append('django.contrib.postgres')
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Use a shared backend (e.g. Redis or Memcached) in production so that all
+# workers see the same cached dashboard and its invalidations.
+
+CACHES = {
+    'default': {
+        'BACKEND': config("CACHE_BACKEND", default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config("CACHE_LOCATION", default='kistrecords'),
+    }
+}
+
+# Seconds a computed dashboard payload may be served before it is rebuilt,
+# independently of the write-driven invalidation
+DASHBOARD_CACHE_TIMEOUT = config("DASHBOARD_CACHE_TIMEOUT", default=60, cast=int)
+
+# Seconds a serialized patient chart is kept; charts are cached per version, so
+# this only bounds memory use, never staleness
+PATIENT_CHART_CACHE_TIMEOUT = config("PATIENT_CHART_CACHE_TIMEOUT", default=300, cast=int)
+
+
+# Bill numbering
+# Numbers look like BILL-042, or BILL-2026-042 when BILL_NUMBER_PER_YEAR is on.
+# Each worker reserves BILL_NUMBER_BLOCK_SIZE numbers at a time.
+
+BILL_NUMBER_PREFIX = config("BILL_NUMBER_PREFIX", default='BILL')
+BILL_NUMBER_PER_YEAR = config("BILL_NUMBER_PER_YEAR", default=False, cast=bool)
+BILL_NUMBER_BLOCK_SIZE = config("BILL_NUMBER_BLOCK_SIZE", default=20, cast=int)
+
+
+# Invoice PDFs
+# Rendered invoices are kept on disk under a hash of their contents, so a
+# reprint of an unchanged bill is a file read. Each server process renders in
+# INVOICE_RENDER_WORKERS processes (0 renders inline) and lets at most
+# INVOICE_RENDER_QUEUE more requests wait before answering 503. Text that
+# Helvetica cannot show, such as Devanagari, is set in the TrueType fonts
+# INVOICE_FONT and INVOICE_BOLD_FONT; the defaults are where Debian and Ubuntu
+# install them (package fonts-noto-core). `manage.py check` warns if they are
+# missing, in which case such text prints as blanks.
+
+INVOICE_CACHE_DIR = config("INVOICE_CACHE_DIR", default=str(BASE_DIR / 'invoice_cache'))
+INVOICE_CLINIC_NAME = config("INVOICE_CLINIC_NAME", default='')
+INVOICE_FONT = config(
+    "INVOICE_FONT", default='/usr/share/fonts/truetype/noto/NotoSansDevanagari-Regular.ttf'
+)
+INVOICE_BOLD_FONT = config(
+    "INVOICE_BOLD_FONT", default='/usr/share/fonts/truetype/noto/NotoSansDevanagari-Bold.ttf'
+)
+INVOICE_RENDER_WORKERS = config("INVOICE_RENDER_WORKERS", default=2, cast=int)
+INVOICE_RENDER_QUEUE = config("INVOICE_RENDER_QUEUE", default=8, cast=int)
+INVOICE_RENDER_TIMEOUT = config("INVOICE_RENDER_TIMEOUT", default=30, cast=int)
+
+
+# Background jobs
+# Jobs are rows in the kistrecords Job table, run by `manage.py run_jobs`,
+# which also queues the periodic pruning tasks (uploads, invoice cache, revoked
+# tokens, finished jobs), so at least one worker must always be running.
+# Workers renew the lock on the jobs they run several times per
+# JOB_LOCK_TIMEOUT; a job whose lock is older than that is assumed to have lost
+# its worker and is queued again, or failed if that was its last attempt.
+# Finished jobs are deleted after JOB_RETENTION_DAYS.
+
+JOB_LOCK_TIMEOUT = config("JOB_LOCK_TIMEOUT", default=900, cast=int)
+JOB_RETENTION_DAYS = config("JOB_RETENTION_DAYS", default=14, cast=int)
+
+
+# Chunked uploads
+# Medical report files can be uploaded in chunks of up to UPLOAD_MAX_CHUNK_SIZE
+# bytes (see kistrecords/uploads.py). Partial files are kept in UPLOAD_TEMP_DIR,
+# which should be on the same filesystem as MEDIA_ROOT so that a finished
+# upload is moved into place rather than copied.
+
+UPLOAD_TEMP_DIR = config("UPLOAD_TEMP_DIR", default=str(BASE_DIR / 'upload_sessions'))
+UPLOAD_MAX_CHUNK_SIZE = config("UPLOAD_MAX_CHUNK_SIZE", default=8 * 1024 * 1024, cast=int)
+UPLOAD_MAX_FILE_SIZE = config("UPLOAD_MAX_FILE_SIZE", default=2 * 1024 ** 3, cast=int)
+UPLOAD_SESSION_TTL_HOURS = config("UPLOAD_SESSION_TTL_HOURS", default=24, cast=int)
+
+
+# Authentication
+# Users behind access tokens are kept in a per-process cache for up to
+# USER_CACHE_TTL seconds (0 disables it), and reloaded as soon as they are saved.
+# It is only used when CACHES is shared between workers.
+
+USER_CACHE_TTL = config("USER_CACHE_TTL", default=60, cast=int)
+USER_CACHE_SIZE = config("USER_CACHE_SIZE", default=1024, cast=int)
+
+
+# Metrics
+# Per URL name request metrics are served in Prometheus format at /metrics,
+# to scrapers sending `Authorization: Bearer <METRICS_TOKEN>`. Without a token
+# /metrics answers 404 unless DEBUG is on.
+# With several server processes (gunicorn workers), set METRICS_DIR to a
+# directory they share and empty it whenever the server is restarted.
+
+METRICS_TOKEN = config("METRICS_TOKEN", default='')
+METRICS_DIR = config("METRICS_DIR", default='') or None
+METRICS_FLUSH_INTERVAL = config("METRICS_FLUSH_INTERVAL", default=5, cast=float)
+
+
+# SQL profiler
+# For development and staging: with SQL_PROFILER on, each request logs queries
+# taking SQL_SLOW_QUERY_MS or more, and query shapes run at least
+# SQL_REPEATED_QUERY_THRESHOLD times (N+1 patterns), with the project line
+# that ran them, to the kistrecords.sql logger. SQL_PROFILER_RAISE turns the
+# repeated queries into an error instead, e.g. for end-to-end tests.
+
+SQL_PROFILER = config("SQL_PROFILER", default=False, cast=bool)
+SQL_SLOW_QUERY_MS = config("SQL_SLOW_QUERY_MS", default=100, cast=float)
+SQL_REPEATED_QUERY_THRESHOLD = config("SQL_REPEATED_QUERY_THRESHOLD", default=5, cast=int)
+SQL_PROFILER_RAISE = config("SQL_PROFILER_RAISE", default=False, cast=bool)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -156,6 +274,18 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Report files are served by kistrecords after an access check, not from
+# MEDIA_URL, which should not be exposed by the front proxy in production.
+# With MEDIA_SENDFILE set to 'x-accel-redirect' (nginx) or 'x-sendfile'
+# (Apache, lighttpd) the proxy sends the bytes itself; for nginx, map
+# MEDIA_SENDFILE_PREFIX to MEDIA_ROOT in an `internal` location. X-Sendfile
+# needs local files, so with remote storage (S3 and the like) files are
+# streamed by kistrecords instead. Links handed to the browser are signed and
+# valid for at least MEDIA_URL_LIFETIME seconds.
+MEDIA_SENDFILE = config("MEDIA_SENDFILE", default='') or None
+MEDIA_SENDFILE_PREFIX = config("MEDIA_SENDFILE_PREFIX", default='/protected-media/')
+MEDIA_URL_LIFETIME = config("MEDIA_URL_LIFETIME", default=12 * 60 * 60, cast=int)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -167,7 +297,7 @@ AUTH_USER_MODEL = 'kistrecords.CustomUser'
 # Rest Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'kistrecords.authentication.CachedJWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
@@ -18,11 +18,13 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
+from kistrecords.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('kistrecords.urls')),
     path('api-auth/', include('rest_framework.urls')),  # Browsable API auth
+    path('metrics', metrics_view, name='metrics'),
 ]
 
 # Serve media files in development